@@ -0,0 +1,937 @@
+#!/usr/bin/env python2
+
+"""A script to time db_hooks, txn_safety and lock_util, without appengine.
+
+db_hooks runs on every get and put, and lock_util and txn_safety on
+most requests, so it's worth knowing what they cost -- and checking
+that a change to them didn't make that worse.  But it's hard to time
+them on appengine, where datastore and memcache latency swamps
+everything else, and they won't even import without the SDK.
+
+So this script runs them on top of fake_appengine/, an in-memory fake
+of the bits of the SDK they use, where every rpc finishes right away.
+That means the numbers below are the cost of our own code (and of the
+fake), not of the datastore.  Compare them with the "unpatched" rows,
+which time the fake on its own.
+
+We time, in order:
+   1. db and ndb gets, puts and queries before db_hooks is installed
+   2. the same, once db_hooks is installed but has no hooks
+   3. the same, with txn_safety's hooks, each run as its own request
+      through TransactionSafetyMiddleware and LockUtilMiddleware
+   4. lock_util's locks, semaphores and rate-limits, and the user-lock
+      nonce lookup txn_safety does on every get and put
+   5. db_hooks running hooks of our own, on big gets, queries and
+      puts: a hook that takes one model at a time, and a batch hook
+
+Each stage changes global state, so you can't run stage 2 without
+stage 1 having run first; if you pass a pattern, we run everything
+but print only the benchmarks whose names contain it.
+
+Then we simulate some contended-lock scenarios, in virtual time (see
+"Lock simulations" below), and print how long requests waited for
+their locks and how many memcache operations that took.  Last, we
+time a scan-and-put of 100,000 db entities, with and without
+db_hooks' streaming (see "Streaming" below).
+
+Usage: benchmark_supporting_files.py [--number N] [--repeat R] [pattern]
+"""
+
+import argparse
+import contextlib
+import heapq
+import math
+import os
+import resource
+import sys
+import time
+
+
+_FAKE_APPENGINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'fake_appengine')
+
+# How many entities we get or put in the *_multi and query benchmarks.
+_BATCH_SIZE = 100
+
+# How many entities we get in the benchmarks of hook dispatch, where
+# the per-model costs are what we're after.
+_BIG_BATCH_SIZE = 1000
+
+# The hook sets of the hooks stage 5 turns on one at a time.
+_HOOK_SETS = ('txn_safety', 'per-model hooks', 'batch hooks')
+
+
+def _time(fn, number, repeat):
+    """Return the fastest time for one call of fn, in microseconds."""
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        for _ in xrange(number):
+            fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / number * 1e6
+
+
+def _datastore_benchmarks(db, ndb, NdbModel, DbModel, get_before_put=False):
+    """Return a list of (name, function) pairs that hit the datastore.
+
+    NdbModel must already have _BATCH_SIZE entities, with ids 0
+    through _BATCH_SIZE - 1, and DbModel the same with key-names
+    '0' through str(_BATCH_SIZE - 1).
+
+    If get_before_put is true, the put benchmarks get the entities
+    first, in the same request, as txn_safety wants for models written
+    under a user lock.
+    """
+    ndb_keys = [ndb.Key(NdbModel, i) for i in xrange(_BATCH_SIZE)]
+    ndb_key = ndb_keys[0]
+    ndb_entities = ndb.get_multi(ndb_keys)
+    db_keys = [db.Key.from_path(DbModel.kind(), str(i))
+               for i in xrange(_BATCH_SIZE)]
+    db_key = db_keys[0]
+    db_entities = db.get(db_keys)
+
+    if get_before_put:
+        puts = [
+            ('ndb Key.get+Model.put', lambda: ndb_key.get().put()),
+            ('ndb get_multi+put_multi(%s)' % _BATCH_SIZE,
+             lambda: ndb.put_multi(ndb.get_multi(ndb_keys))),
+            ('db get+Model.put', lambda: db.get(db_key).put()),
+            ('db get+put(%s)' % _BATCH_SIZE,
+             lambda: db.put(db.get(db_keys))),
+        ]
+    else:
+        puts = [
+            ('ndb Model.put', lambda: ndb_entities[0].put()),
+            ('ndb put_multi(%s)' % _BATCH_SIZE,
+             lambda: ndb.put_multi(ndb_entities)),
+            ('db Model.put', lambda: db_entities[0].put()),
+            ('db put(%s)' % _BATCH_SIZE, lambda: db.put(db_entities)),
+        ]
+
+    return puts + [
+        ('ndb Key.get', lambda: ndb_key.get()),
+        ('ndb get_multi(%s)' % _BATCH_SIZE, lambda: ndb.get_multi(ndb_keys)),
+        ('ndb Query.fetch(%s)' % _BATCH_SIZE,
+         lambda: NdbModel.query().fetch()),
+        ('db get', lambda: db.get(db_key)),
+        ('db get(%s)' % _BATCH_SIZE, lambda: db.get(db_keys)),
+        ('db Query.fetch(%s)' % _BATCH_SIZE,
+         lambda: DbModel.all().fetch(_BATCH_SIZE)),
+    ]
+
+
+@contextlib.contextmanager
+def _hooks_disabled(db_hooks, hook_sets):
+    """Like db_hooks.hooks_disabled, but for several hook sets at once."""
+    if not hook_sets:
+        yield
+        return
+    with db_hooks.hooks_disabled(hook_sets[0]):
+        with _hooks_disabled(db_hooks, hook_sets[1:]):
+            yield
+
+
+def _with_only_hooks(db_hooks, hook_set, fn):
+    """Return a function that calls fn with only hook_set's hooks on.
+
+    If hook_set is None, fn runs with no hooks at all.
+    """
+    others = tuple(other for other in _HOOK_SETS if other != hook_set)
+
+    def run():
+        with _hooks_disabled(db_hooks, others):
+            fn()
+
+    return run
+
+
+class _RequestApp(object):
+    """A WSGI app that calls self.fn() -- whatever that is right now."""
+    def __init__(self, start_request=lambda: None):
+        self.start_request = start_request
+        self.fn = None
+
+    def __call__(self, environ, start_response):
+        self.start_request()
+        self.fn()
+        return []
+
+
+def _run_as_request(wsgi_app, request_app, fn):
+    """Return a function that calls fn in its own request to wsgi_app.
+
+    request_app is the _RequestApp at the bottom of wsgi_app.
+    """
+    def run():
+        request_app.fn = fn
+        for _ in wsgi_app({}, lambda status, headers: None):
+            pass
+
+    return run
+
+
+def _benchmarks():
+    """Yield (stage, name, function) for each benchmark, in order.
+
+    We install db_hooks and txn_safety's hooks as we go, so callers
+    must time each benchmark before asking for the next one.
+    """
+    sys.path.insert(0, _FAKE_APPENGINE_DIR)
+    # lock_util puts these in its lock values, and complains without them.
+    os.environ.setdefault('INSTANCE_ID', 'benchmark-instance')
+    os.environ.setdefault('REQUEST_LOG_ID', 'benchmark-request')
+    from google.appengine.ext import db
+    from google.appengine.ext import ndb
+
+    import db_hooks
+    import lock_util
+    import txn_safety
+
+    class NdbModel(ndb.Model):
+        """A model from a third-party library: no txn-safety policy."""
+        pass
+
+    class DbModel(db.Model):
+        pass
+
+    @txn_safety.written_with_user_lock_model(lambda self: self.user)
+    class NdbUserModel(ndb.Model):
+        pass
+
+    @txn_safety.written_with_user_lock_model(lambda self: self.user)
+    class DbUserModel(db.Model):
+        pass
+
+    @txn_safety.written_with_user_lock_model(lambda self: self.user)
+    class NdbRefetchModel(ndb.Model):
+        """Entities to re-fetch under their user locks, for two users."""
+        pass
+
+    for i in xrange(_BATCH_SIZE):
+        NdbModel(id=i, value=i).put()
+        DbModel(key_name=str(i), value=i).put()
+        NdbUserModel(id=i, user='u1').put()
+        DbUserModel(key_name=str(i), user='u1').put()
+    refetch_keys = [NdbRefetchModel(id=i, user='u%s' % (3 + i % 2)).put()
+                    for i in xrange(50)]
+
+    class BigNdbModel(ndb.Model):
+        pass
+
+    class BigDbModel(db.Model):
+        pass
+
+    for i in xrange(_BIG_BATCH_SIZE):
+        BigNdbModel(id=i, value=i).put()
+        BigDbModel(key_name=str(i), value=i).put()
+    big_ndb_keys = [ndb.Key(BigNdbModel, i) for i in xrange(_BIG_BATCH_SIZE)]
+    big_db_keys = [db.Key.from_path(BigDbModel.kind(), str(i))
+                   for i in xrange(_BIG_BATCH_SIZE)]
+    big_ndb_entities = ndb.get_multi(big_ndb_keys)
+    big_db_entities = db.get(big_db_keys)
+
+    for (name, fn) in _datastore_benchmarks(db, ndb, NdbModel, DbModel):
+        yield ('unpatched', name, fn)
+
+    db_hooks._ensure_db_hooks_installed()
+    for (name, fn) in _datastore_benchmarks(db, ndb, NdbModel, DbModel):
+        yield ('db_hooks, no hooks', name, fn)
+
+    def start_request():
+        txn_safety._set_transaction_safety_enforcement_policy('ts-enforce-all')
+
+    # The user-lock models' puts need u1's lock, so every request
+    # holds it.  We construct the middleware just once, since
+    # TransactionSafetyMiddleware() adds txn_safety's hooks each time.
+    request_app = _RequestApp(start_request)
+    wsgi_app = txn_safety.TransactionSafetyMiddleware(
+        lock_util.LockUtilMiddleware(request_app))
+
+    def with_user_lock(fn):
+        def run():
+            with lock_util.user_write_lock('u1'):
+                fn()
+
+        return _run_as_request(wsgi_app, request_app, run)
+
+    yield ('txn_safety', '(empty request)', with_user_lock(lambda: None))
+    for (name, fn) in _datastore_benchmarks(db, ndb, NdbModel, DbModel):
+        yield ('txn_safety', name + ' (no policy)', with_user_lock(fn))
+    for (name, fn) in _datastore_benchmarks(db, ndb,
+                                            NdbUserModel, DbUserModel,
+                                            get_before_put=True):
+        yield ('txn_safety', name + ' (user lock)', with_user_lock(fn))
+
+    # Re-fetching entities of two users under their user locks, one at
+    # a time and all at once.  Each request gets the entities first,
+    # without a lock, so they all need re-fetching.
+    def fetch_one_at_a_time(n):
+        def run():
+            for entity in ndb.get_multi(refetch_keys[:n]):
+                with lock_util.fetch_under_user_write_lock(entity):
+                    pass
+
+        return run
+
+    def fetch_all_at_once(n):
+        def run():
+            entities = ndb.get_multi(refetch_keys[:n])
+            with lock_util.fetch_multi_under_user_write_lock(entities):
+                pass
+
+        return run
+
+    for n in (1, 10, 50):
+        yield ('txn_safety', 'fetch_under_user_write_lock x%s' % n,
+               _run_as_request(wsgi_app, request_app, fetch_one_at_a_time(n)))
+        yield ('txn_safety', 'fetch_multi_under_user_write_lock(%s)' % n,
+               _run_as_request(wsgi_app, request_app, fetch_all_at_once(n)))
+
+    def global_lock():
+        lock_util.acquire_global_lock('benchmark')
+        lock_util.release_global_lock('benchmark')
+
+    def reacquire_global_lock():
+        lock_util.acquire_global_lock('benchmark')
+        for _ in xrange(10):
+            lock_util.acquire_global_lock('benchmark')
+        lock_util.release_global_lock('benchmark')
+
+    def user_write_lock():
+        with lock_util.user_write_lock('u2'):
+            pass
+
+    def semaphore():
+        with lock_util.global_semaphore('benchmark', 5):
+            pass
+
+    def rate_limit():
+        lock_util.take_rate_limit_token('benchmark', rate=1e9, burst=1e9)
+
+    request_app = _RequestApp()
+    wsgi_app = lock_util.LockUtilMiddleware(request_app)
+    for (name, fn) in (('(empty request)', lambda: None),
+                       ('acquire+release global lock', global_lock),
+                       ('acquire+10 re-acquires+release global lock',
+                        reacquire_global_lock),
+                       ('user_write_lock', user_write_lock),
+                       ('global_semaphore(5)', semaphore),
+                       ('take_rate_limit_token', rate_limit)):
+        yield ('lock_util', name, _run_as_request(wsgi_app, request_app, fn))
+
+    # txn_safety looks up the user lock's nonce on every get and put of
+    # a user-lock model, so we time that on its own, outside a request,
+    # while holding u3's lock.
+    def nonce_lookup(lock_id, scope):
+        nonce = lock_util.nonce_of_user_write_lock_held_by_request
+        return lambda: nonce(lock_id, scope)
+
+    lock_util.acquire_user_write_lock('u3')
+    for (variant, lock_id, scope) in (('held', 'u3', None),
+                                      ('not held', 'u4', None),
+                                      ('scoped, not held', 'u4', 'scope')):
+        yield ('lock_util', 'user-lock nonce lookup (%s)' % variant,
+               nonce_lookup(lock_id, scope))
+    lock_util.release_user_write_lock('u3')
+
+    # txn_safety's hooks are still installed, but we turn them off
+    # here, so these rows time only db_hooks and the hooks below.
+    def per_model_get_hook(model):
+        pass
+
+    def batch_get_hook(models):
+        pass
+
+    def per_model_put_hook(model):
+        pass
+
+    def batch_put_hook(models):
+        pass
+
+    db_hooks.add_after_get_hook(per_model_get_hook,
+                                hook_set='per-model hooks')
+    db_hooks.add_after_get_batch_hook(batch_get_hook, hook_set='batch hooks')
+    db_hooks.add_before_put_hook(per_model_put_hook,
+                                 hook_set='per-model hooks')
+    db_hooks.add_before_put_batch_hook(batch_put_hook,
+                                       hook_set='batch hooks')
+
+    def get_multi_async():
+        for future in ndb.get_multi_async(big_ndb_keys):
+            future.get_result()
+
+    hook_benchmarks = [
+        ('ndb Query.fetch(%s)' % _BIG_BATCH_SIZE,
+         lambda: BigNdbModel.query().fetch()),
+        ('db get(%s)' % _BIG_BATCH_SIZE, lambda: db.get(big_db_keys)),
+        ('ndb get_multi(%s)' % _BIG_BATCH_SIZE,
+         lambda: ndb.get_multi(big_ndb_keys)),
+        ('ndb get_multi_async(%s)' % _BIG_BATCH_SIZE, get_multi_async),
+        ('ndb put_multi(%s)' % _BIG_BATCH_SIZE,
+         lambda: ndb.put_multi(big_ndb_entities)),
+        ('db put(%s)' % _BIG_BATCH_SIZE, lambda: db.put(big_db_entities)),
+    ]
+    for (name, fn) in hook_benchmarks:
+        for (hook_set, variant) in ((None, 'no hooks'),
+                                    ('per-model hooks', 'per-model hook'),
+                                    ('batch hooks', 'batch hook')):
+            yield ('db_hooks, hooks', '%s (%s)' % (name, variant),
+                   _with_only_hooks(db_hooks, hook_set, fn))
+
+# --------------- Lock simulations
+# The timings above are for uncontended locks.  They can't tell us how
+# lock_util behaves when lots of requests want the same lock: who
+# waits how long, and how many memcache operations that takes.  For
+# that, we simulate requests -- each in its own instance, or sharing
+# them -- in virtual time.  A simulated request is a generator that
+# yields how long it wants to sleep, just like lock_util's acquisition
+# steps (which it usually wraps), so we run all the requests in one
+# thread, waking each when its sleep is over, and swapping in its
+# environment and lock_util state as we go.
+
+
+class _SimClock(object):
+    """Stands in for lock_util's time module: sleeping takes no time."""
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def _counting_lock_backend(lock_util):
+    """Return an InProcessLockBackend that counts its rpcs.
+
+    .rpcs is the total, and .calls maps each method name to its count.
+    """
+    backend = lock_util.InProcessLockBackend()
+    backend.rpcs = 0
+    backend.calls = {}
+    # The _SimRequest that is running, if any, whose rpcs we also count.
+    backend.request = None
+
+    def counted(method):
+        def run(*args, **kwargs):
+            backend.rpcs += 1
+            backend.calls[method.__name__] = (
+                backend.calls.get(method.__name__, 0) + 1)
+            if backend.request is not None:
+                backend.request.rpcs += 1
+            return method(*args, **kwargs)
+
+        return run
+
+    # The non-async methods call these, so we count them too.
+    for name in ('get_multi_async', 'set_multi_async', 'add_multi_async',
+                 'cas_multi_async', 'delete_multi_async',
+                 'offset_multi_async'):
+        setattr(backend, name, counted(getattr(backend, name)))
+    return backend
+
+
+class _SimRequest(object):
+    def __init__(self, lock_util, steps, instance_id, request_id,
+                 queue_name):
+        self.steps = steps
+        self.instance_id = instance_id
+        self.request_id = request_id
+        self.queue_name = queue_name
+        self.context = lock_util._RequestContext()
+        self.rpcs = 0       # how many backend rpcs this request has done
+
+
+def _new_instance_state():
+    """Return the lock_util globals that each instance has its own of."""
+    return {'_local_locks': {},
+            '_last_instance_heartbeat': 0,
+            '_heartbeat_leases': {},
+            '_heartbeat_thread': None}
+
+
+class _Simulation(object):
+    """Runs simulated requests against lock_util, in virtual time.
+
+    Add requests with add_request(), then call run().  The
+    simulation's clock and counting lock-backend, and its heartbeat
+    ttl, are installed in lock_util only while run() runs.  Instead
+    of a heartbeat thread, an instance that holds locks gets a
+    simulated request that runs the thread's steps.
+    """
+    def __init__(self, heartbeat_ttl=None):
+        import lock_util
+
+        self.lock_util = lock_util
+        self.clock = _SimClock()
+        self.backend = _counting_lock_backend(lock_util)
+        self.heartbeat_ttl = heartbeat_ttl
+        self._instances = {}     # instance id -> its lock_util state
+        self._deaths = {}        # instance id -> when it dies
+        self._wakeups = []       # a heap of (time, seq, request)
+        self._seq = 0
+
+    def add_request(self, start, steps, instance_id=None, queue_name=None):
+        """Start a request `start` seconds into the simulation.
+
+        steps is a generator that does what the request does, yielding
+        how long to sleep whenever it wants to wait.  Each request is
+        in its own instance unless you give an instance_id.  A
+        queue_name makes it a batch (taskqueue) request.  Returns the
+        request's _SimRequest.
+        """
+        self._seq += 1
+        request = _SimRequest(self.lock_util, steps,
+                              instance_id or 'sim-instance-%s' % self._seq,
+                              'sim-request-%s' % self._seq, queue_name)
+        self._wake_at(self.clock.now + start, request)
+        return request
+
+    def kill_instance(self, instance_id, when):
+        """Kill an instance `when` seconds into the simulation.
+
+        Its requests, and its heartbeat, never run again.
+        """
+        self._deaths[instance_id] = self.clock.now + when
+
+    def _ensure_heartbeat_thread(self):
+        """Replaces lock_util._ensure_heartbeat_thread() while we run."""
+        lock_util = self.lock_util
+        if lock_util._heartbeat_thread is None:
+            instance_id = os.environ['INSTANCE_ID']
+            lock_util._heartbeat_thread = self.add_request(
+                0, lock_util._heartbeat_steps(instance_id),
+                instance_id=instance_id)
+
+    def _wake_at(self, when, request):
+        self._seq += 1
+        heapq.heappush(self._wakeups, (when, self._seq, request))
+
+    def _switch_to(self, request):
+        lock_util = self.lock_util
+        os.environ['INSTANCE_ID'] = request.instance_id
+        os.environ['REQUEST_LOG_ID'] = request.request_id
+        if request.queue_name:
+            os.environ['HTTP_X_APPENGINE_QUEUENAME'] = request.queue_name
+        else:
+            os.environ.pop('HTTP_X_APPENGINE_QUEUENAME', None)
+        lock_util._request_local.context = request.context
+        self.backend.request = request
+        instance = self._instances.setdefault(request.instance_id,
+                                              _new_instance_state())
+        for (name, value) in instance.iteritems():
+            setattr(lock_util, name, value)
+        return instance
+
+    def _switch_from(self, instance):
+        self.backend.request = None
+        for name in instance:
+            instance[name] = getattr(self.lock_util, name)
+
+    def run(self):
+        lock_util = self.lock_util
+        saved_environ = dict(os.environ)
+        saved_state = dict((name, getattr(lock_util, name))
+                           for name in ['time', '_lock_backend',
+                                        '_instance_heartbeat_ttl',
+                                        '_ensure_heartbeat_thread'] +
+                           _new_instance_state().keys())
+        saved_context = lock_util._request_local.context
+        lock_util.time = self.clock
+        lock_util._lock_backend = self.backend
+        lock_util._instance_heartbeat_ttl = self.heartbeat_ttl
+        lock_util._ensure_heartbeat_thread = self._ensure_heartbeat_thread
+        try:
+            while self._wakeups:
+                (when, _, request) = heapq.heappop(self._wakeups)
+                if when >= self._deaths.get(request.instance_id, when + 1):
+                    continue
+                self.clock.now = max(self.clock.now, when)
+                instance = self._switch_to(request)
+                try:
+                    delay = next(request.steps)
+                except StopIteration:
+                    # The end of the request: LockUtilMiddleware's job.
+                    lock_util.resolve_all_rpcs()
+                else:
+                    self._wake_at(self.clock.now + delay, request)
+                self._switch_from(instance)
+        finally:
+            os.environ.clear()
+            os.environ.update(saved_environ)
+            for (name, value) in saved_state.iteritems():
+                setattr(lock_util, name, value)
+            lock_util._request_local.context = saved_context
+
+
+def _sim_acquire(sim, key, results, label=None, lock_timeout=60,
+                 wait_timeout=30, queued=False, hold=1):
+    """Simulated request steps: acquire key's lock, hold it, release it.
+
+    We append (label, how long we waited for the lock) to results as
+    soon as we get the lock, or (label, None) if we time out.  We use
+    acquire_global_lock_async()'s steps, which poll for other requests
+    in our instance instead of blocking on them.
+    """
+    lock_util = sim.lock_util
+    start = sim.clock.time()
+    try:
+        for delay in lock_util._acquire_global_lock_steps(
+                key, lock_timeout, wait_timeout, queued, wait_locally=False):
+            yield delay
+    except lock_util.LockAcquireFailure:
+        results.append((label, None))
+        return
+    results.append((label, sim.clock.time() - start))
+    yield hold
+    lock_util.release_global_lock(key)
+
+
+def _percentile(values, percent):
+    """Return the nearest-rank percentile of values (0 if there are none)."""
+    if not values:
+        return 0
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def _wait_results(results):
+    """Summarize _sim_acquire()'s results."""
+    waits = [wait for (_, wait) in results if wait is not None]
+    return [('acquired', len(waits)),
+            ('timeouts', len(results) - len(waits)),
+            ('mean wait', sum(waits) / max(len(waits), 1)),
+            ('p50 wait', _percentile(waits, 50)),
+            ('p99 wait', _percentile(waits, 99)),
+            ('max wait', max(waits or [0]))]
+
+
+def _fairness_scenario(queued, waiters):
+    """waiters requests from many instances pile up waiting for one lock.
+
+    Racing waiters each poll once a second, so whoever happens to poll
+    first after a release wins, however long the others have waited.
+    Queued waiters get the lock in the order they asked for it.
+
+    Besides the waits, we report how many grants were out of arrival
+    order, the starvation -- the most times any one waiter saw a
+    later arrival get the lock first -- and what it all cost in
+    backend rpcs per acquisition.  (With fewer than 100 waiters, the
+    p99 wait is just the max.)
+    """
+    sim = _Simulation()
+    results = []
+    for i in xrange(waiters):
+        sim.add_request(0.15 * i, _sim_acquire(sim, 'fairness', results,
+                                               label=i, queued=queued,
+                                               wait_timeout=120, hold=0.7))
+    sim.run()
+    grants = [i for (i, wait) in results if wait is not None]
+    out_of_order = sum(1 for (n, i) in enumerate(grants) if n != i)
+    overtaken = [sum(1 for later in grants[:n] if later > i)
+                 for (n, i) in enumerate(grants)]
+    return _wait_results(results) + [
+        ('out-of-order grants', out_of_order),
+        ('max starvation (times overtaken)', max(overtaken or [0])),
+        ('rpcs/acquire', float(sim.backend.rpcs) / max(len(grants), 1))]
+
+
+def _reacquire_scenario(contended):
+    """A request acquires a lock, then re-acquires it ten times.
+
+    If contended, another request holds the lock for its first 3
+    seconds.  We count the backend rpcs of our request alone.
+    """
+    sim = _Simulation()
+    lock_util = sim.lock_util
+    rpcs = []
+
+    def request():
+        for _ in xrange(11):
+            for delay in lock_util._acquire_global_lock_steps(
+                    'reacquire', 60, 30, False, wait_locally=False):
+                yield delay
+            rpcs.append(me.rpcs)
+        lock_util.release_global_lock('reacquire')
+
+    if contended:
+        sim.add_request(0, _sim_acquire(sim, 'reacquire', [], hold=3))
+    me = sim.add_request(0.5, request())
+    sim.run()
+    return [('rpcs to acquire', rpcs[0]),
+            ('rpcs for 10 re-acquires', rpcs[-1] - rpcs[0])]
+
+
+def _local_arbitration_scenario(same_instance):
+    """8 requests each acquire one lock 5 times, holding it for 10ms.
+
+    When the requests share an instance, only one of them at a time
+    polls memcache; the others wait for it locally.  (These are
+    acquire_global_lock_async()'s steps, which poll for the local
+    holder every _LOCAL_LOCK_POLL_INTERVAL.  acquire_global_lock()
+    blocks on a condition variable instead, and gets the lock handed
+    to it directly, which we can't simulate in one thread.)
+    """
+    sim = _Simulation()
+    results = []
+
+    def request():
+        for _ in xrange(5):
+            for delay in _sim_acquire(sim, 'arbitration', results,
+                                      hold=0.01):
+                yield delay
+
+    for i in xrange(8):
+        sim.add_request(0, request(),
+                        instance_id='sim-instance' if same_instance else None)
+    start = sim.clock.time()
+    sim.run()
+    return _wait_results(results) + [
+        ('total time', sim.clock.time() - start),
+        ('rpcs', sim.backend.rpcs)]
+
+
+def _request_deadline_scenario(time_left, enforced, held=True):
+    """A request with time_left seconds to live waits for a lock.
+
+    If held, another request holds the lock for 30 seconds, and we wait
+    with the default wait_timeout (10 seconds, for interactive
+    requests).  If not enforced, lock_util doesn't know the request's
+    deadline, which is how every request behaved before
+    set_request_deadline().  Even with no time left to wait, a request
+    should still get a free lock right away.
+    """
+    sim = _Simulation()
+    lock_util = sim.lock_util
+    waited = []
+    got_lock = []
+
+    def request():
+        start = sim.clock.time()
+        if enforced:
+            lock_util.set_request_deadline(start + time_left)
+        try:
+            for delay in lock_util._acquire_global_lock_steps(
+                    'deadline', None, None, False, wait_locally=False):
+                yield delay
+            got_lock.append(True)
+        except lock_util.LockAcquireFailure:
+            pass
+        waited.append(sim.clock.time() - start)
+
+    if held:
+        sim.add_request(0, _sim_acquire(sim, 'deadline', [], hold=30))
+    sim.add_request(1, request())
+    sim.run()
+    return [('got the lock', bool(got_lock)),
+            ('waited', waited[0]),
+            ('past the deadline', waited[0] > time_left)]
+
+
+def _rpc_queue_scenario():
+    """One request acquires and releases 1,000 locks over 20 keys.
+
+    Every other acquisition is queued.  Each acquisition queues rpcs to
+    resolve at the end of the request: the racing ones an
+    ".interactive" marker write, the queued ones an advance of the
+    queue.  We report how long that queue got.
+    """
+    sim = _Simulation()
+    lock_util = sim.lock_util
+    peak = [0]
+
+    def request():
+        for i in xrange(1000):
+            key = 'rpc-queue-%s' % (i % 20)
+            for delay in lock_util._acquire_global_lock_steps(
+                    key, 60, 10, i % 2 == 1, wait_locally=False):
+                yield delay
+            lock_util.release_global_lock(key)
+            peak[0] = max(peak[0],
+                          len(lock_util._request_local.context.rpc_queue))
+
+    sim.add_request(0, request())
+    sim.run()
+    return [('peak pending rpcs', peak[0]),
+            ('rpcs', sim.backend.rpcs),
+            ('interactive-marker sets',
+             sim.backend.calls.get('set_multi_async', 0))]
+
+
+def _liveness_scenario(heartbeat_ttl, queued, holder_dies):
+    """An instance holds a lock for 15s, with a 20s lease.
+
+    Another instance starts waiting for the lock half a second in.  If
+    holder_dies, the holder's instance dies a second in, still holding
+    the lock, and we report how long after its death the waiter got
+    the lock.  Otherwise, we report whether the waiter broke the lock
+    of the live holder, which doesn't call into lock_util while it
+    holds the lock.
+    """
+    sim = _Simulation(heartbeat_ttl)
+    results = []
+    sim.add_request(0, _sim_acquire(sim, 'liveness', [], lock_timeout=20,
+                                    hold=15),
+                    instance_id='holder')
+    sim.add_request(0.5, _sim_acquire(sim, 'liveness', results,
+                                      wait_timeout=60, queued=queued,
+                                      hold=0))
+    if holder_dies:
+        sim.kill_instance('holder', 1)
+    sim.run()
+    (_, wait) = results[0]
+    acquired_at = 0.5 + wait
+    if holder_dies:
+        return [('acquired after the death', acquired_at - 1)]
+    return [('acquired after', acquired_at),
+            ('broke a live lock', acquired_at < 15)]
+
+
+# --------------- Streaming
+# db_hooks.set_streaming_chunk_size() is meant for mapreduce-style
+# loops that read every entity of a kind and write them back.  Those
+# are too slow to time a few hundred times over, so we time one, and
+# report it alongside the simulations.
+
+# How many entities the scan-and-put reads and writes.
+_SCAN_SIZE = 100000
+
+
+def _scan_and_put_scenarios():
+    """Yield (variant, results) for a scan-and-put, chunked and not.
+
+    We read all _SCAN_SIZE entities with db.Query.run(), change each
+    one, and db.put() a generator of them, with the batch hooks of
+    stage 5 on.  Besides the throughput, we report the biggest put,
+    which is how many models the loop held at once, and how much the
+    process's peak memory grew.  The chunked run goes first, since
+    the peak only ever goes up.
+    """
+    from google.appengine.ext import db
+
+    import db_hooks
+
+    class ScanModel(db.Model):
+        pass
+
+    largest_put = [0]
+
+    def note_put(models):
+        largest_put[0] = max(largest_put[0], len(models))
+
+    db_hooks.add_before_put_batch_hook(note_put, hook_set='batch hooks')
+
+    def touched():
+        for model in ScanModel.all().run(batch_size=1000):
+            model.value += 1
+            yield model
+
+    # We write the entities in chunks too, so setting them up doesn't
+    # raise the peak memory.
+    db_hooks.set_streaming_chunk_size(1000)
+    with db_hooks.hooks_disabled():
+        db.put(ScanModel(key_name=str(i), value=i)
+               for i in xrange(_SCAN_SIZE))
+
+    for chunk_size in (1000, None):
+        db_hooks.set_streaming_chunk_size(chunk_size)
+        largest_put[0] = 0
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        with _hooks_disabled(db_hooks, ('txn_safety', 'per-model hooks')):
+            db.put(touched())
+        elapsed = time.time() - start
+        # ru_maxrss is in kilobytes, on linux.
+        rss_growth = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss -
+                      start_rss) / 1024.0
+        yield ('chunk size %s' % chunk_size,
+               [('seconds', elapsed),
+                ('entities/sec', int(_SCAN_SIZE / elapsed)),
+                ('largest put', largest_put[0]),
+                ('peak memory growth (MB)', rss_growth)])
+    db_hooks.set_streaming_chunk_size(None)
+
+
+def _scenarios():
+    """Yield (scenario, variant, results) for each simulation.
+
+    results is a list of (name, value) pairs.  Call this only after
+    running _benchmarks(), which sets up the fake appengine.
+    """
+    for waiters in (10, 100):
+        for queued in (False, True):
+            yield ('lock fairness',
+                   '%s waiters, %s' % (waiters,
+                                       'queued' if queued else 'racing'),
+                   _fairness_scenario(queued, waiters))
+    for same_instance in (False, True):
+        yield ('local arbitration',
+               'one instance' if same_instance else '8 instances',
+               _local_arbitration_scenario(same_instance))
+    for (time_left, enforced, held) in ((8, False, True), (8, True, True),
+                                        (4, True, True), (4, True, False)):
+        yield ('request deadline',
+               '%ss left%s%s' % (time_left, '' if enforced else ', ignored',
+                                 '' if held else ', lock free'),
+               _request_deadline_scenario(time_left, enforced, held))
+    yield ('end-of-request rpcs', '1000 acquires', _rpc_queue_scenario())
+    for (heartbeat_ttl, queued, holder_dies) in ((None, False, True),
+                                                 (3, False, True),
+                                                 (3, True, True),
+                                                 (3, False, False)):
+        yield ('dead lock holder' if holder_dies else 'idle lock holder',
+               '%s%s' % ('ttl=%s' % heartbeat_ttl if heartbeat_ttl
+                         else 'no heartbeat',
+                         ', queued' if queued else ''),
+               _liveness_scenario(heartbeat_ttl, queued, holder_dies))
+    for contended in (False, True):
+        yield ('lock re-acquire',
+               'contended' if contended else 'uncontended',
+               _reacquire_scenario(contended))
+    for (variant, results) in _scan_and_put_scenarios():
+        yield ('scan-and-put', variant, results)
+
+
+def _format_results(results):
+    return ', '.join('%s=%s' % (name, '%.2f' % value
+                                if isinstance(value, float) else value)
+                     for (name, value) in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0])
+    parser.add_argument('--number', type=int, default=200,
+                        help='How many times to call each benchmark per '
+                        'timing (default %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='How many timings to take the best of '
+                        '(default %(default)s)')
+    parser.add_argument('pattern', nargs='?', default='',
+                        help='Only print benchmarks whose names contain '
+                        'this')
+    args = parser.parse_args()
+
+    print '%-20s %-45s %10s' % ('stage', 'benchmark', 'usec/call')
+    for (stage, name, fn) in _benchmarks():
+        if args.pattern not in name:
+            continue
+        usec = _time(fn, args.number, args.repeat)
+        print '%-20s %-45s %10.1f' % (stage, name, usec)
+
+    print
+    print '%-20s %-25s %s' % ('scenario', 'variant', 'results')
+    for (scenario, variant, results) in _scenarios():
+        if args.pattern not in scenario + ' ' + variant:
+            continue
+        print '%-20s %-25s %s' % (scenario, variant,
+                                  _format_results(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,84 +8,749 @@ supports db models.  For consistency, we do our own hooking even for
 ndb.
 
 The key methods here are add_before_put_hook and add_after_get_hook.
+If your hook can handle all the models being put (or gotten) at once
+more efficiently than one at a time, use add_before_put_batch_hook (or
+add_after_get_batch_hook) instead.
+
+For work that should only happen once a write has really happened --
+invalidating a cache, say -- there are also add_after_put_hook, which
+runs once the put is done, and add_after_commit_hook, which for puts
+in a transaction waits until the transaction commits (and never runs
+if it doesn't).  Both have batch versions too.
+
+Hooks cost something on every get and put, so there are two ways to
+avoid paying for them when they aren't needed.  Hooks can be given a
+model_filter, in which case model classes that no hook is interested
+in skip hook dispatch entirely.  And hooks_disabled() turns off some
+or all hooks for the current request; when no hooks are active, the
+wrapped get and put methods call straight through to the datastore.
+
+To find out how much time your hooks themselves are taking, wrap your
+WSGI app in HookTimingMiddleware, which logs per-hook call counts and
+times for each request.  Timing is off unless you ask for it, and when
+it's off the hooks are called directly, at no extra cost.
+
+For big scans, see set_streaming_chunk_size(), which has the hooks
+run on query results (and generators passed to db.put) a chunk at a
+time.
+
+Hooks that need to remember something about an entity between its
+get and its put should keep it in entity_hook_state(entity), rather
+than in an attribute on the entity.
 """
 
+import contextlib
 import functools
+import itertools
+import json
 import logging
+import os
+import threading
+import time
+import weakref
 
 from google.appengine.api import datastore
 from google.appengine.api import datastore_types
+from google.appengine.datastore import datastore_rpc
 from google.appengine.ext import db
 from google.appengine.ext import ndb
 
 
+# These take a list of models; see add_before_put_batch_hook,
+# add_after_get_batch_hook, add_after_put_batch_hook and
+# add_after_commit_batch_hook.
 _put_hooks = []
 _get_hooks = []
+_after_put_hooks = []
+_after_commit_hooks = []
 _db_hooks_installed = False
 
+# The model_filter of each hook (None if it doesn't have one), and the
+# hook-set each hook was registered under.
+_put_model_filters = []
+_get_model_filters = []
+_after_put_model_filters = []
+_after_commit_model_filters = []
+_hook_set_of = {}
+
+# The name we report each hook's timings under; see set_hook_timing().
+_hook_name_of = {}
+_time_hooks = False
+
+# See set_streaming_chunk_size().
+_streaming_chunk_size = None
+
+# True if we know whenever datastore's current connection changes;
+# see _current_connection().
+_tracking_connections = False
+
+# What _hook_state's hook lists are set to while we're inside a hooked
+# method, so methods it calls don't run the hooks again.
+_NO_HOOKS = ()
+
+# The smallest the entity-state table gets before we sweep it; see
+# _sweep_entity_states().
+_MIN_ENTITY_STATES_SWEEP_SIZE = 1000
+
+
+class _HookState(threading.local):
+    # The hooks that are active for the current request.  These are the
+    # global lists above, except inside hooks_disabled(), or while
+    # we're running a method we've hooked.
+    put_hooks = _put_hooks
+    get_hooks = _get_hooks
+    after_put_hooks = _after_put_hooks
+    after_commit_hooks = _after_commit_hooks
+
+    # The connection datastore._GetConnection() would return, or None
+    # if we don't know; the connection stack it was on top of; and
+    # whether it's transactional.  See _current_connection().
+    connection = None
+    connection_stack = None
+    in_transaction = False
+
+    # How many times this thread has run the get hooks on a batch; see
+    # _wrap_up_get_or_insert_async().
+    get_hook_runs = 0
+
+    def __init__(self):
+        # Map from hook-name to [calls, models, seconds] for the
+        # current request, if timing is on.  See hook_timings().
+        self.timings = {}
+
+        # Map from id(entity) to the entity's EntityHookState, for the
+        # current request.  See entity_hook_state().
+        self.entity_states = {}
+        # When entity_states gets this big, we sweep out the states of
+        # entities that have gone away; see _sweep_entity_states().
+        self.entity_states_sweep_size = _MIN_ENTITY_STATES_SWEEP_SIZE
+
+        # Map from transactional connection to the _AfterPuts of the
+        # puts made in its transaction, whose after-commit hooks run
+        # when it commits.  See _wrap_up_transaction().
+        self.puts_awaiting_commit = {}
+
+
+_hook_state = _HookState()
+
+
+class EntityHookState(weakref.ref):
+    """What our hooks remember about one entity during a request.
+
+    db_hooks sets transaction_at_request_time, the transaction (or
+    None) that was active when the get that returned the entity was
+    made, and get_hook_run, the _hook_state.get_hook_runs of the
+    hook run that last saw the entity.  The other fields belong to
+    txn_safety.  A field that has
+    never been set raises AttributeError, so hasattr() tells you
+    whether it was.
+
+    This is also a weak reference to the entity (so it's one object
+    per entity, not two), but only entity_hook_state() needs that.
+    """
+    __slots__ = ('entity_id', 'transaction_at_request_time', 'get_hook_run',
+                 'get_nonce', 'user_lock_nonce', 'has_been_put')
+
+
+def entity_hook_state(entity, create=True):
+    """Return entity's EntityHookState for the current request.
+
+    If the entity doesn't have one yet, we make one, unless create is
+    False, in which case we return None.
+
+    These live in a side table rather than on the entity, so they
+    don't grow every entity's __dict__ or get pickled along with it.
+    The table only holds weak references to entities, and
+    clear_entity_hook_states() empties it at the end of the request.
+    (We key it on id(entity) since ndb models aren't hashable.)
+    """
+    entity_id = id(entity)
+    entity_states = _hook_state.entity_states
+    state = entity_states.get(entity_id)
+    if state is not None and state() is entity:
+        return state
+    if not create:
+        return None
+    if len(entity_states) >= _hook_state.entity_states_sweep_size:
+        _sweep_entity_states()
+    state = EntityHookState(entity)
+    state.entity_id = entity_id
+    entity_states[entity_id] = state
+    return state
+
+
+def _sweep_entity_states():
+    """Drop the states of entities that have been garbage-collected.
+
+    A weakref callback could do this as each entity goes away, but
+    that costs a python function call per entity, which adds up for
+    big scans.  Instead we sweep whenever the table has doubled in
+    size since the last sweep, which is O(1) per state, amortized.
+    (A dead state is harmless until then: entity_hook_state() checks
+    that a state's entity is the one it was asked about, so if the id
+    is reused, the new entity's state replaces it.)
+    """
+    entity_states = _hook_state.entity_states
+    for (entity_id, state) in entity_states.items():
+        if state() is None:
+            del entity_states[entity_id]
+    _hook_state.entity_states_sweep_size = max(
+        _MIN_ENTITY_STATES_SWEEP_SIZE, 2 * len(entity_states))
+
+
+def clear_entity_hook_states():
+    """Forget the hook state of every entity; call this between requests."""
+    _hook_state.entity_states.clear()
+    _hook_state.entity_states_sweep_size = _MIN_ENTITY_STATES_SWEEP_SIZE
+
+
+def clear_puts_awaiting_commit():
+    """Forget the puts of unfinished transactions; call this between requests.
+
+    A put made in a transaction we didn't see start -- because it
+    was started some way we don't hook -- waits for a commit we'll
+    never see, so without this it would stay around forever.
+    """
+    _hook_state.puts_awaiting_commit.clear()
+
+
+class _TypeCache(dict):
+    """A dict that computes (and remembers) fn(type) for missing types."""
+    def __init__(self, fn):
+        super(_TypeCache, self).__init__()
+        self.fn = fn
+
+    def __missing__(self, item_type):
+        value = self[item_type] = self.fn(item_type)
+        return value
+
+
+def _wanted_by_some_hook(model_class, model_filters):
+    return any(model_filter is None or model_filter(model_class)
+               for model_filter in model_filters)
+
+
+# Maps each model class to True if no put hook wants to see it.
+_skips_put_hooks = _TypeCache(
+    lambda model_class: not _wanted_by_some_hook(model_class,
+                                                 _put_model_filters))
+
+# Maps each model class to True if no after-put or after-commit hook
+# wants to see it.
+_skips_after_put_hooks = _TypeCache(
+    lambda model_class: not _wanted_by_some_hook(
+        model_class, _after_put_model_filters + _after_commit_model_filters))
+
 # Placeholder value used when `transaction` cannot yet be fetched
 _TRANSACTION_STATE_NOT_EVALUATED = object()
 
 
-def _transaction_object():
-    """Return the transaction this entity is currently under, or None."""
+def current_transaction():
+    """Return the datastore transaction we're currently in, or None.
+
+    The transaction lives on datastore's current connection; see
+    _current_connection().  It may be None even inside a transaction,
+    if the SDK hasn't begun the transaction yet, which it can put off
+    until the first rpc made in it.
+    """
+    return getattr(_current_connection(), 'transaction', None)
+
+
+def _current_transactional_connection():
+    """Return datastore's current connection if it's transactional.
+
+    Otherwise -- outside a transaction -- return None.  Unlike
+    current_transaction(), this works even before the transaction
+    has begun.
+    """
+    connection = _current_connection()
+    if isinstance(connection, datastore_rpc.TransactionalConnection):
+        return connection
+    return None
+
+
+def _current_connection():
+    """Return datastore._GetConnection(), or None if it's not working.
+
+    datastore._GetConnection() is slow enough to matter when we call
+    it for every put.  So once the db hooks are installed, we
+    remember the connection it returned, and forget it whenever db
+    or ndb change the current connection (which they do on entering
+    and leaving a transaction).
+
+    datastore also starts a new connection stack at the start of each
+    request, without telling us, and a request thread can be reused
+    for another request.  So we only trust the connection we
+    remembered while it's on the stack datastore is using.  Even
+    then, a new request that hasn't used the datastore yet still has
+    the last request's stack, until datastore notices -- by way of an
+    environment variable -- that the request has changed; if we
+    remembered a transactional connection, we check that variable
+    too.  (Outside a transaction, the last request's connection is as
+    good as a new one.)
+    """
+    connection = _hook_state.connection
+    if (connection is not None and
+            _hook_state.connection_stack is
+            datastore._thread_local.connection_stack and
+            (not _hook_state.in_transaction or
+             os.environ.get(datastore._ENV_KEY))):
+        return connection
     try:
-        return getattr(datastore._GetConnection(), 'transaction', None)
+        connection = datastore._GetConnection()
     except Exception as e:
-        # Probably means the internal _GetConnection() function went away.
-        logging.error("datastore._GetConnection() isn't working!: %s" % e)
+        # Probably means the internal _GetConnection() function went
+        # away.
+        logging.error("datastore._GetConnection() isn't working!: %s"
+                      % e)
         return None
+    if _tracking_connections:
+        _hook_state.connection = connection
+        _hook_state.connection_stack = datastore._thread_local.connection_stack
+        _hook_state.in_transaction = isinstance(
+            connection, datastore_rpc.TransactionalConnection)
+    return connection
 
 
-def _wrap_up_put(func):
-    """Wrap a put method to invoke the put hooks before a real put()."""
+def _wrap_up_connection_change(func):
+    """Wrap a datastore function that changes the current connection."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _hook_state.connection = None
+
+    return wrapper
+
+
+def _track_connections():
+    """Have _current_connection() notice when the connection changes.
+
+    db's transactions push a transactional connection onto
+    datastore's connection stack, and pops it after; ndb's
+    transactions _SetConnection() one and then set the old one back.
+    If this SDK doesn't have those functions -- or the connection
+    stack, and the environment variable that says whether it belongs
+    to this request -- we can't tell when the connection changes, so
+    _current_connection() won't remember it.
+    """
+    global _tracking_connections
+    names = ('_SetConnection', '_PushConnection', '_PopConnection')
+    if not (all(hasattr(datastore, name) for name in names) and
+            hasattr(datastore, '_thread_local') and
+            hasattr(datastore, '_ENV_KEY')):
+        logging.warning("Can't track datastore connections; db_hooks "
+                        "will call datastore._GetConnection() every time")
+        return
+    for name in names:
+        setattr(datastore, name,
+                _wrap_up_connection_change(getattr(datastore, name)))
+    _tracking_connections = True
+
+
+def _run_put_hooks(put_hooks, models):
+    models = [model for model in models if not _skips_put_hooks[type(model)]]
+    if models:
+        for hook in put_hooks:
+            hook(models)
+
+
+class _ChunkedPutRpc(object):
+    """Stands in for the rpc of a db.put_async() we did in chunks.
+
+    All but the last chunk's rpc have already been resolved, giving
+    keys; get_result() returns those keys plus the last chunk's.
+    """
+    def __init__(self, keys, last_rpc):
+        self._keys = keys
+        self._last_rpc = last_rpc
+
+    def wait(self):
+        if self._last_rpc is not None:
+            self._last_rpc.wait()
+
+    def check_success(self):
+        self.get_result()
+
+    def get_result(self):
+        if self._last_rpc is not None:
+            self._keys.extend(self._last_rpc.get_result())
+            self._last_rpc = None
+        return self._keys
+
+
+def _put_in_chunks(func, put_hooks, runs_after_put_hooks, models,
+                   args, kwargs):
+    """Run the put hooks on, and put, an iterator of models a chunk at a time.
+
+    We keep at most two chunks' rpcs outstanding, so we never have
+    more than two chunks of models in memory.  The after-put hooks
+    run on each chunk as its rpc is resolved.
+    """
+    keys = []
+    rpc = None
+    while True:
+        chunk = list(itertools.islice(models, _streaming_chunk_size))
+        if not chunk:
+            break
+        if put_hooks:
+            _run_put_hooks(put_hooks, chunk)
+        next_rpc = func(chunk, *args, **kwargs)
+        if runs_after_put_hooks:
+            _dispatch_after_put_hooks(chunk, next_rpc)
+        if rpc is not None:
+            keys.extend(rpc.get_result())
+        rpc = next_rpc
+    return _ChunkedPutRpc(keys, rpc)
+
+
+def _wrap_up_put(func, streams=False):
+    """Wrap a put method to invoke the put hooks before a real put().
+
+    It also arranges for the after-put hooks to run on whatever func
+    returns; see _dispatch_after_put_hooks().
+
+    If streams is True, func is db.put_async, and we pass it iterators
+    a chunk at a time; see set_streaming_chunk_size().
+    """
     @functools.wraps(func)
     def wrapper(model_or_models, *args, **kwargs):
-        for hook in _put_hooks:
-            if hasattr(model_or_models, '__iter__'):
-                # We explicitly list-ify here, because model_or_models could be
-                # a generator, and we don't want to exhaust the generator then
-                # pass the exhausted generator to the real put method.
-                model_or_models = list(model_or_models)
-                for model in model_or_models:
-                    hook(model)
-            else:
-                hook(model_or_models)
-
-        return func(model_or_models, *args, **kwargs)
+        put_hooks = _hook_state.put_hooks
+        runs_after_put_hooks = bool(_hook_state.after_put_hooks or
+                                    _hook_state.after_commit_hooks)
+        if (streams and _streaming_chunk_size and
+                hasattr(model_or_models, '__iter__') and
+                iter(model_or_models) is model_or_models):
+            return _put_in_chunks(func, put_hooks, runs_after_put_hooks,
+                                  model_or_models, args, kwargs)
+
+        if not (put_hooks or runs_after_put_hooks):
+            return func(model_or_models, *args, **kwargs)
+
+        if hasattr(model_or_models, '__iter__'):
+            # We explicitly list-ify here, because model_or_models could be
+            # a generator, and we don't want to exhaust the generator then
+            # pass the exhausted generator to the real put method.
+            model_or_models = models = list(model_or_models)
+            if put_hooks:
+                _run_put_hooks(put_hooks, models)
+        else:
+            models = [model_or_models]
+            if put_hooks and not _skips_put_hooks[type(model_or_models)]:
+                for hook in put_hooks:
+                    hook(models)
+
+        ret = func(model_or_models, *args, **kwargs)
+        if runs_after_put_hooks:
+            _dispatch_after_put_hooks(models, ret)
+        return ret
 
     return wrapper
 
 
-def _run_get_hooks(model_or_models, transaction):
-    """Run the get hooks on all the models contained in model_or_models.
+def _run_after_hooks(hooks, models):
+    """Run after-put or after-commit hooks, logging rather than raising errors.
 
-    Different db/ndb methods return models in different ways. This method deals
-    with that variety.
+    The models have already been written, so there's nothing for an
+    exception to stop -- and for an async put, whoever would see it
+    might not be the code that did the put.
+    """
+    for hook in hooks:
+        try:
+            hook(models)
+        except Exception:
+            logging.exception('db_hooks: error in hook %s'
+                              % _hook_name_of.get(_untimed_hook(hook)))
 
-    See _wrap_up_nonclassmethod_get.__doc__ for information on the transaction
-    argument.
+
+class _AfterPut(object):
+    """Runs the after-put hooks on the models of one put, once it's done.
+
+    If the put was made in a transaction, _finish_transaction() runs
+    the after-commit hooks on the models when the transaction commits;
+    otherwise we run them right after the after-put hooks.  Either
+    way, models whose put failed are left out.
+
+    We take the hook lists as they were when the put was made, so
+    hooks_disabled() around a put covers its after-put hooks too.
     """
-    if isinstance(model_or_models, (db.Model, ndb.Model)):
-        # This prevents double runs in cases where we hook one method that
-        # calls a different method we hook (e.g. db.Model.get_or_insert calls
-        # db.get).
-        if hasattr(model_or_models, '_db_util_get_hooks_run'):
+    def __init__(self, models, futures, rpc, connection):
+        self.models = models
+        self.futures = futures      # one per model, for ndb puts
+        self.rpc = rpc              # for db.put_async
+        self.connection = connection    # transactional, or None
+        self.after_put_hooks = _hook_state.after_put_hooks
+        self.after_commit_hooks = _hook_state.after_commit_hooks
+        self.num_done = 0           # futures[:num_done] are all done
+        self.done = False
+
+    def run_if_futures_done(self):
+        # Futures don't become un-done, so we needn't look at the
+        # first num_done futures again.
+        while (self.num_done < len(self.futures) and
+               self.futures[self.num_done].done()):
+            self.num_done += 1
+        if self.num_done == len(self.futures):
+            self.run()
+
+    def run(self, succeeded=True):
+        """Run the hooks, unless we already have."""
+        if self.done:
             return
+        self.done = True
+        if not succeeded:
+            self.models = []
+        elif self.futures is not None:
+            self.models = [model for (model, future)
+                           in zip(self.models, self.futures)
+                           if future.get_exception() is None]
+        if not self.models:
+            return
+        _run_after_hooks(self.after_put_hooks, self.models)
+        if self.connection is None:
+            _run_after_hooks(self.after_commit_hooks, self.models)
+
+    def finish(self):
+        """Wait for the put, and run the hooks if they haven't run yet.
+
+        We need this when the transaction commits, since no one may
+        ever resolve a db rpc, and an ndb future's callbacks may not
+        have been called yet.
+        """
+        if self.futures is not None:
+            ndb.Future.wait_all(self.futures)
+        elif self.rpc is not None:
+            try:
+                self.rpc.get_result()
+            except Exception:
+                # Our wrapped get_result already noted the failure.
+                pass
+        self.run()
+
+
+def _wrap_up_put_future_get_result(get_result, after_put):
+    """Wrap an ndb put future's get_result to run the after-put hooks.
+
+    The future's callbacks only run the next time something runs the
+    event loop, so without this, a synchronous put wouldn't have run
+    the hooks by the time it returned.
+    """
+    def wrapper():
+        ret = get_result()
+        if not after_put.done:
+            after_put.run_if_futures_done()
+        return ret
+
+    return wrapper
+
+
+def _wrap_up_put_rpc_get_result(get_result, after_put):
+    """Wrap a db put rpc's get_result to run the after-put hooks."""
+    def wrapper():
+        try:
+            ret = get_result()
+        except Exception:
+            after_put.run(succeeded=False)
+            raise
+        after_put.run()
+        return ret
+
+    return wrapper
 
-        model_or_models._db_util_get_hooks_run = True
 
-        # If `transaction` has the placeholder value because it hasn't been
-        # fetched by this point, then fetch it now.
-        if transaction is _TRANSACTION_STATE_NOT_EVALUATED:
-            transaction = _transaction_object()
+def _dispatch_after_put_hooks(models, ret):
+    """Arrange for the after-put hooks to run once a put is done.
 
-        model_or_models._transaction_at_request_time = transaction
+    ret is what the put method returned.  If it's a key, or a list of
+    keys, the put is done and we run the hooks now.  If it's an ndb
+    future, or a list of them, we add a callback, so the hooks run
+    from the event loop as soon as the put finishes -- whether or not
+    anyone waits on it -- and also wrap their get_result, in case
+    someone asks for the result before the event loop gets to the
+    callback.  And if it's a db rpc, which doesn't take callbacks, we
+    wrap its get_result, so the hooks run when the put is resolved.
+    (Or when its transaction commits; see _AfterPut.)
+    """
+    if isinstance(ret, ndb.Future):
+        futures = [ret]
+    elif isinstance(ret, list) and ret and isinstance(ret[0], ndb.Future):
+        futures = ret
+    else:
+        futures = None
 
-        for hook in _get_hooks:
-            hook(model_or_models)
+    if futures is not None:
+        wanted = [(model, future) for (model, future) in zip(models, futures)
+                  if not _skips_after_put_hooks[type(model)]]
+        if not wanted:
+            return
+        (models, futures) = (list(pair) for pair in zip(*wanted))
+    else:
+        models = [model for model in models
+                  if not _skips_after_put_hooks[type(model)]]
+        if not models:
+            return
+
+    rpc = ret if futures is None and hasattr(ret, 'get_result') else None
+    connection = _current_transactional_connection()
+    after_put = _AfterPut(models, futures, rpc, connection)
+    if connection is not None and after_put.after_commit_hooks:
+        _hook_state.puts_awaiting_commit.setdefault(
+            connection, []).append(after_put)
+
+    if futures is not None:
+        for future in futures:
+            future.add_callback(after_put.run_if_futures_done)
+            future.get_result = _wrap_up_put_future_get_result(
+                future.get_result, after_put)
+    elif rpc is not None:
+        rpc.get_result = _wrap_up_put_rpc_get_result(rpc.get_result,
+                                                     after_put)
+    else:
+        after_put.run()
+
+
+def _run_after_commit_hooks(after_puts):
+    """Run the after-commit hooks on everything put in a transaction.
+
+    Each hook runs once, on all the models it should see.  (Puts made
+    inside hooks_disabled() may have had different hooks.)  A model
+    that was put more than once is only passed once.
+    """
+    batches = {}
+    for after_put in after_puts:
+        after_put.finish()
+        hooks = after_put.after_commit_hooks
+        (_, models) = batches.setdefault(id(hooks), (hooks, []))
+        models.extend(after_put.models)
+
+    for (hooks, models) in batches.itervalues():
+        seen = set()
+        models = [model for model in models
+                  if id(model) not in seen and not seen.add(id(model))]
+        if models:
+            _run_after_hooks(hooks, models)
+
+
+def _finish_transaction(attempts, outer_connection, committed):
+    """Run or drop the after-commit hooks of a transaction's puts.
+
+    attempts is the transactional connection each try of the
+    transaction ran in; only the last one can have committed.
+    """
+    puts_awaiting_commit = _hook_state.puts_awaiting_commit
+    for (i, connection) in enumerate(attempts):
+        if connection is None or connection is outer_connection:
+            # We joined a transaction that was already going on; its
+            # own wrapper will take care of it.
+            continue
+        after_puts = puts_awaiting_commit.pop(connection, None)
+        if after_puts and committed and i == len(attempts) - 1:
+            _run_after_commit_hooks(after_puts)
+
+
+def _wrap_up_transaction(func, callback_index):
+    """Wrap a function that runs a callback in a transaction.
+
+    When the transaction commits, we run the after-commit hooks on
+    everything that was put in it; if it fails, we forget those puts.
+    func may call the callback more than once, when the transaction
+    has to be retried, so we note which transaction each try runs in.
+    We go by each try's transactional connection rather than its
+    transaction, since the transaction may not have begun -- and so
+    be None -- when the callback starts.  callback_index is where the
+    callback is in func's arguments.
+
+    If func returns an ndb future, as ndb.Context.transaction does, we
+    wait for that to finish before deciding whether it committed.  As
+    for puts, we both add a callback to it and wrap its get_result,
+    and whichever comes first runs the hooks.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _after_commit_hooks:
+            return func(*args, **kwargs)
+
+        outer_connection = _current_transactional_connection()
+        attempts = []
+        callback = args[callback_index]
+
+        def hooked_callback(*callback_args, **callback_kwargs):
+            attempts.append(_current_transactional_connection())
+            return callback(*callback_args, **callback_kwargs)
+
+        args = (args[:callback_index] + (hooked_callback,) +
+                args[callback_index + 1:])
+        try:
+            ret = func(*args, **kwargs)
+        except Exception:
+            _finish_transaction(attempts, outer_connection, False)
+            raise
+
+        if isinstance(ret, ndb.Future):
+            get_result = ret.get_result
+
+            def finish():
+                if attempts:
+                    _finish_transaction(attempts, outer_connection,
+                                        ret.get_exception() is None)
+                    del attempts[:]
+
+            def hooked_get_result():
+                try:
+                    return get_result()
+                finally:
+                    finish()
+
+            ret.add_callback(finish)
+            ret.get_result = hooked_get_result
+        else:
+            _finish_transaction(attempts, outer_connection, True)
+        return ret
+
+    return wrapper
 
-    elif isinstance(model_or_models, (list, tuple)):
+
+# How _models_needing_get_hooks treats objects of each type.  We cache
+# this per type, since get results are almost always a long list of
+# objects of a single type.
+_MODEL = 'model'
+# Keys, None for missing entities, and models no get hook wants to see.
+_NOT_A_MODEL = 'not a model'
+_SEQUENCE = 'sequence'
+_UNEXPECTED = 'unexpected'
+_kind_of_type = {}
+
+
+def _classify_type(item_type):
+    if issubclass(item_type, (db.Model, ndb.Model)):
+        if _wanted_by_some_hook(item_type, _get_model_filters):
+            kind = _MODEL
+        else:
+            kind = _NOT_A_MODEL
+    elif (item_type is type(None) or
+            issubclass(item_type, (ndb.Key, datastore_types.Key))):
+        kind = _NOT_A_MODEL
+    elif issubclass(item_type, (list, tuple)):
+        kind = _SEQUENCE
+    else:
+        kind = _UNEXPECTED
+    _kind_of_type[item_type] = kind
+    return kind
+
+
+def _models_needing_get_hooks(model_or_models, models):
+    """Append the models in model_or_models to models, flattening lists.
+
+    Different db/ndb methods return models in different ways. This method
+    deals with that variety.
+    """
+    item_type = type(model_or_models)
+    kind = _kind_of_type.get(item_type) or _classify_type(item_type)
+    if kind is _MODEL:
+        models.append(model_or_models)
+
+    elif kind is _SEQUENCE:
         if not model_or_models:
             # Empty! Nothing to do here!
             return
@@ -93,21 +758,60 @@ def _run_get_hooks(model_or_models, transaction):
         # Special case: ndb.Query.fetch_page returns a (results, cursor,
         # more tuple).
         if isinstance(model_or_models[-1], bool):
-            return _run_get_hooks(model_or_models[0], transaction=transaction)
-        for model in model_or_models:
-            _run_get_hooks(model, transaction=transaction)
+            _models_needing_get_hooks(model_or_models[0], models)
+            return
+        last_type = None
+        for item in model_or_models:
+            # Only look up the kind when the type changes.
+            if type(item) is not last_type:
+                last_type = type(item)
+                kind = (_kind_of_type.get(last_type) or
+                        _classify_type(last_type))
+            if kind is _MODEL:
+                models.append(item)
+            elif kind is not _NOT_A_MODEL:
+                _models_needing_get_hooks(item, models)
+
+    elif kind is _UNEXPECTED:
+        logging.error("Tried to run get hooks on unexpected type %s (%s)",
+                      model_or_models, type(model_or_models))
 
-    elif model_or_models is None:
-        # Nothing came back from the datastore, so nothing to hook.
-        pass
+    # Otherwise, nothing came back from the datastore, or it was a
+    # keys-only query; either way, hooks don't need to run.
 
-    elif isinstance(model_or_models, (ndb.Key, datastore_types.Key)):
-        # Keys only query; hooks don't need to run.
-        pass
 
-    else:
-        logging.error("Tried to run get hooks on unexpected type %s (%s)",
-                      model_or_models, type(model_or_models))
+def _run_get_hooks(model_or_models, transaction):
+    """Run the get hooks on all the models contained in model_or_models.
+
+    We collect all the models first, so we can give them to the hooks
+    as a single batch.
+
+    See _wrap_up_nonclassmethod_get.__doc__ for information on the transaction
+    argument.
+    """
+    get_hooks = _hook_state.get_hooks
+    if not get_hooks:
+        return
+
+    models = []
+    _models_needing_get_hooks(model_or_models, models)
+    if not models:
+        return
+
+    # If `transaction` has the placeholder value because it hasn't been
+    # fetched by this point, then fetch it now.  It's the same for all
+    # the models, so we only need to do this once.
+    if transaction is _TRANSACTION_STATE_NOT_EVALUATED:
+        transaction = current_transaction()
+
+    hook_run = _hook_state.get_hook_runs = _hook_state.get_hook_runs + 1
+    for model in models:
+        state = entity_hook_state(model)
+        state.transaction_at_request_time = transaction
+        state.get_hook_run = hook_run
+
+    for hook in get_hooks:
+        hook(models)
 
 
 def _run_hooks_iter(iterator, transaction):
@@ -121,6 +825,37 @@ def _run_hooks_iter(iterator, transaction):
         yield result
 
 
+def _run_hooks_chunked_iter(iterator, transaction, chunk_size):
+    """Like _run_hooks_iter, but runs the hooks chunk_size results at a time.
+
+    We return an itertools.chain, so iterating over the results of a
+    chunk doesn't go through a python generator.
+    """
+    def hooked_chunks():
+        while True:
+            chunk = list(itertools.islice(iterator, chunk_size))
+            if not chunk:
+                return
+            _run_get_hooks(chunk, transaction=transaction)
+            yield chunk
+
+    return itertools.chain.from_iterable(hooked_chunks())
+
+
+def _wrap_up_get_result(get_result, transaction):
+    """Wrap a future's get_result to invoke the get hooks on its result.
+
+    This is called for every async get, so we don't bother with
+    functools.wraps, which is slow.
+    """
+    def wrapper():
+        ret = get_result()
+        _run_get_hooks(ret, transaction=transaction)
+        return ret
+
+    return wrapper
+
+
 def _wrap_up_nonclassmethod_get(func,
                                 transaction=_TRANSACTION_STATE_NOT_EVALUATED):
     """Wrap a get method to invoke the get hooks.
@@ -129,14 +864,28 @@ def _wrap_up_nonclassmethod_get(func,
 
     transaction: This is the transaction that was active (if any) when an
     asynchronous request was made. This information is passed along and
-    eventually accessible on the model instance as
-    _transaction_at_request_time. If the request was not asynchronous,
-    TRANSACTION_STATE_NOT_EVALUATED is used as a placeholder, and transaction
-    is given a value later.
+    eventually accessible as the model's
+    entity_hook_state().transaction_at_request_time. If the request was not
+    asynchronous, TRANSACTION_STATE_NOT_EVALUATED is used as a placeholder,
+    and transaction is given a value later.
+
+    While func runs, we turn off the get hooks, so that if func calls
+    another get method we hook (e.g. db.Model.get_or_insert calls
+    db.get), the hooks only run once, on what func returns.  This
+    means func must not wait on ndb futures, since ndb would run other
+    tasklets, and their gets, while it waits.
     """
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        ret = func(*args, **kwargs)
+        get_hooks = _hook_state.get_hooks
+        if not get_hooks:
+            return func(*args, **kwargs)
+
+        _hook_state.get_hooks = _NO_HOOKS
+        try:
+            ret = func(*args, **kwargs)
+        finally:
+            _hook_state.get_hooks = get_hooks
 
         if (not isinstance(ret, (db.Model, ndb.Model))
             and hasattr(ret, 'get_result')):
@@ -160,12 +909,17 @@ def _wrap_up_nonclassmethod_get(func,
             #   val = future.get_result()
             #   self._help_tasklet_along(ns, ds_conn, gen, val)
             #
-            cur_transaction = _transaction_object()
+            cur_transaction = current_transaction()
 
-            ret.get_result = _wrap_up_nonclassmethod_get(
-                    ret.get_result, transaction=cur_transaction)
+            ret.get_result = _wrap_up_get_result(ret.get_result,
+                                                 cur_transaction)
         elif (not isinstance(ret, (db.Model, ndb.Model))
                 and hasattr(ret, 'next')):
+            if _streaming_chunk_size:
+                # Chunks line up with the datastore's batches, if we
+                # know how big those are.
+                chunk_size = kwargs.get('batch_size') or _streaming_chunk_size
+                return _run_hooks_chunked_iter(ret, transaction, chunk_size)
             return _run_hooks_iter(ret, transaction=transaction)
         else:
             _run_get_hooks(ret, transaction=transaction)
@@ -189,6 +943,196 @@ def _wrap_up_get(func):
         return _wrap_up_nonclassmethod_get(func)
 
 
+def _wrap_up_get_or_insert_async(func):
+    """Wrap ndb.Model.get_or_insert_async to invoke the get hooks once.
+
+    get_or_insert_async gets the entity, and if it's not there, gets it
+    again in a transaction, creating it if it's still missing.  We make
+    the first get with the hooks off, like any nested get, but the
+    transaction runs later, from the event loop, with the hooks on.  So
+    if another request creates the entity between the two gets, the
+    transactional get hooks it, and we mustn't hook it again.  We tell
+    by whether a hook run has seen the entity since we were called.
+    """
+    @functools.wraps(func)
+    def wrapper(cls, *args, **kwargs):
+        get_hooks = _hook_state.get_hooks
+        if not get_hooks:
+            return func(cls, *args, **kwargs)
+
+        last_hook_run = _hook_state.get_hook_runs
+        _hook_state.get_hooks = _NO_HOOKS
+        try:
+            future = func(cls, *args, **kwargs)
+        finally:
+            _hook_state.get_hooks = get_hooks
+
+        # As in _wrap_up_nonclassmethod_get, we want the transaction
+        # that was active when the call was made.
+        transaction = current_transaction()
+        get_result = future.get_result
+
+        def hooked_get_result():
+            entity = get_result()
+            state = entity_hook_state(entity, create=False)
+            if (state is None or
+                    getattr(state, 'get_hook_run', 0) <= last_hook_run):
+                _run_get_hooks(entity, transaction=transaction)
+            return entity
+
+        future.get_result = hooked_get_result
+        return future
+
+    return classmethod(wrapper)
+
+
+def _wrap_up_query_iterator_init(func):
+    """Mark ndb query iterators that a hooked method will run hooks for.
+
+    ndb.Query.fetch_page_async gets its results via a QueryIterator,
+    but only calls next() on it after fetch_page_async has returned,
+    when our guard against running hooks twice is no longer in place.
+    So we note that the iterator was created inside a hooked method,
+    and have next() skip the hooks for it.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        func(self, *args, **kwargs)
+        self._db_hooks_run_by_caller = not _hook_state.get_hooks
+
+    return wrapper
+
+
+def _wrap_up_query_iterator_next(func):
+    """Wrap QueryIterator.next to invoke the get hooks.
+
+    Unlike _wrap_up_get, this doesn't turn off the hooks while func
+    runs, since next() waits on an ndb future.
+    """
+    @functools.wraps(func)
+    def wrapper(self):
+        ret = func(self)
+        if not getattr(self, '_db_hooks_run_by_caller', False):
+            _run_get_hooks(ret, transaction=_TRANSACTION_STATE_NOT_EVALUATED)
+        return ret
+
+    return wrapper
+
+
+class _HookedFutureBatch(object):
+    """Runs the get hooks on the results of ndb.get_multi_async() at once.
+
+    We wrap the get_result of each future that get_multi_async
+    returns.  The first time one is called after all the futures are
+    done, we run the hooks on all their results together.  If someone
+    asks for a result before then, we just run the hooks on that one
+    result, so that no one ever sees an entity the hooks haven't run
+    on.  Either way, the hooks run exactly once for each entity.
+    """
+    def __init__(self, futures, transaction):
+        self.futures = futures
+        self.get_results = [future.get_result for future in futures]
+        self.hooked = [False] * len(futures)
+        self.all_hooked = False
+        self.num_done = 0       # futures[:num_done] are all done
+        self.transaction = transaction
+        for (i, future) in enumerate(futures):
+            future.get_result = self._hooked_get_result(i)
+
+    def _all_done(self):
+        # Futures don't become un-done, so we needn't look at the
+        # first num_done futures again.
+        while (self.num_done < len(self.futures) and
+               self.futures[self.num_done].done()):
+            self.num_done += 1
+        return self.num_done == len(self.futures)
+
+    def _run_hooks_on_all(self):
+        self.all_hooked = True
+        results = []
+        for (i, get_result) in enumerate(self.get_results):
+            if not self.hooked[i]:
+                try:
+                    results.append(get_result())
+                except Exception:
+                    # The caller will see this when they ask for this
+                    # result; there's nothing for the hooks to do.
+                    pass
+        _run_get_hooks(results, transaction=self.transaction)
+
+    def _hooked_get_result(self, i):
+        def get_result():
+            ret = self.get_results[i]()
+            if not self.all_hooked:
+                if self._all_done():
+                    self._run_hooks_on_all()
+                elif not self.hooked[i]:
+                    self.hooked[i] = True
+                    _run_get_hooks(ret, transaction=self.transaction)
+            return ret
+
+        return get_result
+
+
+def _wrap_up_get_multi_async(func):
+    """Wrap ndb.get_multi_async to invoke the get hooks once per call.
+
+    Without this, each of the Key.get_async calls it makes would run
+    the hooks separately.
+    """
+    @functools.wraps(func)
+    def wrapper(keys, **ctx_options):
+        get_hooks = _hook_state.get_hooks
+        if not get_hooks:
+            return func(keys, **ctx_options)
+
+        # See _wrap_up_nonclassmethod_get for why we want this now.
+        transaction = current_transaction()
+        _hook_state.get_hooks = _NO_HOOKS
+        try:
+            futures = func(keys, **ctx_options)
+        finally:
+            _hook_state.get_hooks = get_hooks
+        _HookedFutureBatch(futures, transaction)
+        return futures
+
+    return wrapper
+
+
+def _wrap_up_put_multi_async(func):
+    """Wrap ndb.put_multi_async to invoke the put hooks once per call.
+
+    We run the hooks on all the entities, then turn them off while
+    put_multi_async calls put_async() on each entity.  Likewise, the
+    after-put hooks run once, when all the puts are done.
+    """
+    @functools.wraps(func)
+    def wrapper(entities, **ctx_options):
+        put_hooks = _hook_state.put_hooks
+        after_put_hooks = _hook_state.after_put_hooks
+        after_commit_hooks = _hook_state.after_commit_hooks
+        if not (put_hooks or after_put_hooks or after_commit_hooks):
+            return func(entities, **ctx_options)
+
+        entities = list(entities)
+        if put_hooks:
+            _run_put_hooks(put_hooks, entities)
+        _hook_state.put_hooks = _NO_HOOKS
+        _hook_state.after_put_hooks = _NO_HOOKS
+        _hook_state.after_commit_hooks = _NO_HOOKS
+        try:
+            futures = func(entities, **ctx_options)
+        finally:
+            _hook_state.put_hooks = put_hooks
+            _hook_state.after_put_hooks = after_put_hooks
+            _hook_state.after_commit_hooks = after_commit_hooks
+        if after_put_hooks or after_commit_hooks:
+            _dispatch_after_put_hooks(entities, futures)
+        return futures
+
+    return wrapper
+
+
 def _ensure_db_hooks_installed():
     """Idempotently ensure that the DB hooks are installed (monkeypatched)."""
     global _db_hooks_installed
@@ -199,12 +1143,49 @@ def _ensure_db_hooks_installed():
 
     _db_hooks_installed = True
 
+    _track_connections()
+
     # This is the minimal subset of methods that need wrapping for all puts
     # - the other methods of putting a model go through one of these codepaths.
     ndb.Model.put_async = _wrap_up_put(ndb.Model.put_async)
     ndb.Model.put = _wrap_up_put(ndb.Model.put)
     db.Model.put = _wrap_up_put(db.Model.put)
-    db.put_async = _wrap_up_put(db.put_async)
+    db.put_async = _wrap_up_put(db.put_async, streams=True)
+
+    # ndb's multi-methods call the single-entity methods; we hook them
+    # separately so the hooks run once per call, not once per entity.
+    # ndb.put_multi and ndb.get_multi call the unwrapped versions of
+    # the async methods, so we redefine them, the same way ndb does,
+    # in terms of the wrapped ones.  (db.put and db.get already take
+    # lists, so there's nothing to do for them.)
+    put_multi_async = _wrap_up_put_multi_async(ndb.put_multi_async)
+    get_multi_async = _wrap_up_get_multi_async(ndb.get_multi_async)
+
+    @functools.wraps(ndb.put_multi)
+    def put_multi(entities, **ctx_options):
+        return [future.get_result()
+                for future in put_multi_async(entities, **ctx_options)]
+
+    @functools.wraps(ndb.get_multi)
+    def get_multi(keys, **ctx_options):
+        return [future.get_result()
+                for future in get_multi_async(keys, **ctx_options)]
+
+    ndb.put_multi_async = put_multi_async
+    ndb.get_multi_async = get_multi_async
+    ndb.put_multi = put_multi
+    ndb.get_multi = get_multi
+
+    # For the after-commit hooks.  Every db transaction, however it's
+    # started -- db.run_in_transaction and its variants, @db.transactional,
+    # datastore.RunInTransaction -- goes through
+    # datastore.RunInTransactionOptions, which they look up when they're
+    # called, so wrapping it covers them all, even aliases taken before
+    # we got here.  Likewise, every ndb transaction goes through
+    # Context.transaction.
+    datastore.RunInTransactionOptions = _wrap_up_transaction(
+        datastore.RunInTransactionOptions, 1)
+    ndb.Context.transaction = _wrap_up_transaction(ndb.Context.transaction, 1)
 
     # We try to keep this to as small a set as possible that covers all of the
     # methods of retrieving an entity for efficiency and to minimize the number
@@ -214,20 +1195,36 @@ def _ensure_db_hooks_installed():
     db.Query.run = _wrap_up_get(db.Query.run)
 
     ndb.Key.get_async = _wrap_up_get(ndb.Key.get_async)
-    ndb.Model.get_or_insert = _wrap_up_get(ndb.Model.get_or_insert)
-    ndb.Model.get_or_insert_async = _wrap_up_get(ndb.Model.get_or_insert_async)
+    ndb.Model.get_or_insert_async = _wrap_up_get_or_insert_async(
+        ndb.Model.get_or_insert_async.im_func)
     ndb.Query.fetch_async = _wrap_up_get(ndb.Query.fetch_async)
     ndb.Query.fetch_page_async = _wrap_up_get(ndb.Query.fetch_page_async)
-    ndb.QueryIterator.next = _wrap_up_get(ndb.QueryIterator.next)
+    ndb.QueryIterator.__init__ = _wrap_up_query_iterator_init(
+        ndb.QueryIterator.__init__)
+    ndb.QueryIterator.next = _wrap_up_query_iterator_next(
+        ndb.QueryIterator.next)
+
+    # ndb.Model.get_or_insert waits on a future, so we can't wrap it
+    # with _wrap_up_get.  Instead, like ndb.put_multi above, we have it
+    # call the wrapped get_or_insert_async.
+    @functools.wraps(ndb.Model.get_or_insert.im_func)
+    def get_or_insert(*args, **kwds):
+        (cls, args) = (args[0], args[1:])
+        return cls.get_or_insert_async(*args, **kwds).get_result()
+
+    ndb.Model.get_or_insert = classmethod(get_or_insert)
 
     def wrap_map_async(func):
         @functools.wraps(func)
         def wrapper(self, callback, *args, **kwargs):
+            if not _hook_state.get_hooks:
+                return func(self, callback, *args, **kwargs)
+
             # We want to know which transaction was active at the time when the
             # request was made, not when the future from the request is
             # resolved. See comment in _wrap_up_nonclassmethod_get for more
             # information.
-            cur_transaction = _transaction_object()
+            cur_transaction = current_transaction()
 
             def hooked_callback(*args):
                 # ndb.Query.map_async has two signatures for callbacks. The
@@ -253,7 +1250,116 @@ def _ensure_db_hooks_installed():
     ndb.Query.map_async = wrap_map_async(ndb.Query.map_async)
 
 
-def add_before_put_hook(callback):
+def _hook_name(callback):
+    return '%s.%s' % (getattr(callback, '__module__', None),
+                      getattr(callback, '__name__', callback))
+
+
+def _timed_hook(hook):
+    """Return a version of hook that records how long it takes."""
+    name = _hook_name_of[hook]
+
+    def timed_hook(models):
+        start = time.time()
+        try:
+            hook(models)
+        finally:
+            timings = _hook_state.timings
+            stats = timings.get(name)
+            if stats is None:
+                stats = timings[name] = [0, 0, 0.0]
+            stats[0] += 1
+            stats[1] += len(models)
+            stats[2] += time.time() - start
+
+    timed_hook.untimed_hook = hook
+    return timed_hook
+
+
+def _untimed_hook(hook):
+    return getattr(hook, 'untimed_hook', hook)
+
+
+def set_hook_timing(enabled):
+    """Turn on (or off) timing of every hook.
+
+    While this is on, we count how many times each hook is called in
+    each request, on how many models, and how long it takes; see
+    hook_timings().  While it's off, the hooks are called directly,
+    so this costs nothing.
+
+    HookTimingMiddleware calls this for you.
+    """
+    global _time_hooks
+    _time_hooks = enabled
+    for hooks in (_put_hooks, _get_hooks,
+                  _after_put_hooks, _after_commit_hooks):
+        for (i, hook) in enumerate(hooks):
+            hook = _untimed_hook(hook)
+            hooks[i] = _timed_hook(hook) if enabled else hook
+
+
+def set_streaming_chunk_size(chunk_size):
+    """Have big scans and puts run the hooks a chunk at a time.
+
+    Normally, iterating over a db query (db.Query.run(), or a for loop
+    over a db.Query) runs the get hooks on each result as it's
+    returned.  With a chunk size set, we instead read chunk_size
+    results at a time -- or the query's batch_size, if it has one --
+    and run the hooks on all of them at once, which is much cheaper
+    for batch hooks.  The catch is that we may read up to a chunk's
+    worth of results that the caller never looks at.
+
+    Likewise, db.put() and db.put_async() normally read all of a
+    generator of models into a list before running the put hooks and
+    doing the put.  With a chunk size set, we run the hooks on, and
+    put, chunk_size models at a time, so memory use doesn't grow with
+    the number of models.  (Which also keeps each put RPC under the
+    datastore's limit on entities per put.)  Unlike a normal put, a
+    hook raising an exception, or a put failing, can leave earlier
+    chunks already written.  Lists and tuples are put all at once, as
+    before.
+
+    ndb queries aren't affected: ndb fetches results through
+    QueryIterator.next() one at a time.  For big ndb scans, loop over
+    fetch_page() instead, which runs the hooks on each page at once.
+
+    Pass in None to turn this off again.
+    """
+    global _streaming_chunk_size
+    _streaming_chunk_size = chunk_size
+
+
+def hook_timings():
+    """Return the hook timings for the current request.
+
+    This is a map from hook-name to a dict with the number of 'calls'
+    to the hook, the total number of 'models' passed to it, and the
+    total 'seconds' spent in it.  Hook-names look like
+    'before_put: txn_safety._examine_put_state' (or 'after_get: ...',
+    'after_put: ...' or 'after_commit: ...').  The map is empty
+    unless set_hook_timing() is on.
+    """
+    return dict((name, {'calls': calls, 'models': models,
+                        'seconds': seconds})
+                for (name, (calls, models, seconds))
+                in _hook_state.timings.iteritems())
+
+
+def reset_hook_timings():
+    """Forget the hook timings collected so far in this request."""
+    _hook_state.timings = {}
+
+
+def _add_hook(hooks, model_filters, callback, hook_set, model_filter, name):
+    _ensure_db_hooks_installed()
+    _hook_name_of[callback] = name
+    _hook_set_of[callback] = hook_set
+    hooks.append(_timed_hook(callback) if _time_hooks else callback)
+    model_filters.append(model_filter)
+
+
+def add_before_put_hook(callback, hook_set=None, model_filter=None):
     """Register a function to be called before any entity is put().
 
     This will be invoked during the execution of any of the following methods,
@@ -268,12 +1374,41 @@ def add_before_put_hook(callback):
     - ndb.put_multi_async
     - ndb.Model.put
     - ndb.Model.put_async
+
+    hook_set, if given, is a name you can pass to hooks_disabled() to
+    turn this hook off.
+
+    model_filter, if given, is a function that takes a model class and
+    returns whether this hook cares about models of that class.  Models
+    of a class that no hook cares about skip the hooks altogether.
+    This is only an optimization: the callback may still be called on
+    models it doesn't care about, if some other hook cares about them.
+    model_filter is called once per class, so it shouldn't depend on
+    anything that changes.
     """
-    _ensure_db_hooks_installed()
-    _put_hooks.append(callback)
+    def batch_callback(models):
+        for model in models:
+            callback(model)
+
+    _add_hook(_put_hooks, _put_model_filters, batch_callback, hook_set,
+              model_filter, 'before_put: %s' % _hook_name(callback))
+    _skips_put_hooks.clear()
 
 
-def add_after_get_hook(callback):
+def add_before_put_batch_hook(callback, hook_set=None, model_filter=None):
+    """Like add_before_put_hook, but called once per put with all the models.
+
+    The callback's only argument will be a list of the models about to
+    be put, even if only one model is being put.  It must not modify
+    the list.  This saves a function call per model, which adds up
+    for large puts.
+    """
+    _add_hook(_put_hooks, _put_model_filters, callback, hook_set,
+              model_filter, 'before_put: %s' % _hook_name(callback))
+    _skips_put_hooks.clear()
+
+
+def add_after_get_hook(callback, hook_set=None, model_filter=None):
     """Registers a function to be called after any model is fetched.
 
     This will be invoked immediately after the execution of any of the
@@ -314,6 +1449,162 @@ def add_after_get_hook(callback):
     - ndb.Query.map_async
     - ndb.get_multi
     - ndb.get_multi_async
+
+    hook_set and model_filter are as for add_before_put_hook.
     """
-    _ensure_db_hooks_installed()
-    _get_hooks.append(callback)
+    def batch_callback(models):
+        for model in models:
+            callback(model)
+
+    _add_hook(_get_hooks, _get_model_filters, batch_callback, hook_set,
+              model_filter, 'after_get: %s' % _hook_name(callback))
+    _kind_of_type.clear()
+
+
+def add_after_get_batch_hook(callback, hook_set=None, model_filter=None):
+    """Like add_after_get_hook, but called with all the models at once.
+
+    The callback's only argument will be a list of the models that
+    were just retrieved -- all the results of a query, say -- even if
+    only one model was retrieved.  It must not modify the list.
+    """
+    _add_hook(_get_hooks, _get_model_filters, callback, hook_set,
+              model_filter, 'after_get: %s' % _hook_name(callback))
+    _kind_of_type.clear()
+
+
+def add_after_put_hook(callback, hook_set=None, model_filter=None):
+    """Register a function to be called after any entity has been put().
+
+    This covers the same methods as add_before_put_hook.  The callback
+    is called once the put is done: for a synchronous put, before the
+    put method returns; for an ndb future, from the event loop as soon
+    as the future finishes; and for db.put_async, when the rpc is
+    resolved (or the transaction it's in commits).  It isn't called
+    for models whose put failed.  The callback's only argument will be
+    the model that was put.
+
+    For a put in a transaction, this is called before the transaction
+    commits, and even if it's rolled back; see add_after_commit_hook.
+
+    Exceptions the callback raises are logged, not raised, since the
+    put has already happened.
+
+    hook_set and model_filter are as for add_before_put_hook.
+    """
+    def batch_callback(models):
+        for model in models:
+            callback(model)
+
+    _add_hook(_after_put_hooks, _after_put_model_filters, batch_callback,
+              hook_set, model_filter, 'after_put: %s' % _hook_name(callback))
+    _skips_after_put_hooks.clear()
+
+
+def add_after_put_batch_hook(callback, hook_set=None, model_filter=None):
+    """Like add_after_put_hook, but called once per put with all the models.
+
+    The callback's only argument will be a list of the models that
+    were put, even if only one model was put.  It must not modify the
+    list.
+    """
+    _add_hook(_after_put_hooks, _after_put_model_filters, callback,
+              hook_set, model_filter, 'after_put: %s' % _hook_name(callback))
+    _skips_after_put_hooks.clear()
+
+
+def add_after_commit_hook(callback, hook_set=None, model_filter=None):
+    """Register a function to be called once any entity's put is committed.
+
+    For a put outside a transaction, this is just like an after-put
+    hook.  For a put in a transaction, the callback is called when the
+    transaction commits, with all the other models put in it, and not
+    at all if the transaction fails or is retried.  (Only for
+    transactions started through datastore.RunInTransactionOptions,
+    as all of db's are, or by ndb; we can't see when anything else
+    commits.)
+
+    Like add_after_put_hook, the callback's only argument will be the
+    model, and exceptions it raises are logged, not raised.
+
+    hook_set and model_filter are as for add_before_put_hook.
+    """
+    def batch_callback(models):
+        for model in models:
+            callback(model)
+
+    _add_hook(_after_commit_hooks, _after_commit_model_filters,
+              batch_callback, hook_set, model_filter,
+              'after_commit: %s' % _hook_name(callback))
+    _skips_after_put_hooks.clear()
+
+
+def add_after_commit_batch_hook(callback, hook_set=None, model_filter=None):
+    """Like add_after_commit_hook, but called with all the models at once.
+
+    The callback's only argument will be a list of the models that
+    were put -- everything put in the transaction, for a transaction
+    -- even if only one model was put.  It must not modify the list.
+    """
+    _add_hook(_after_commit_hooks, _after_commit_model_filters, callback,
+              hook_set, model_filter,
+              'after_commit: %s' % _hook_name(callback))
+    _skips_after_put_hooks.clear()
+
+
+@contextlib.contextmanager
+def hooks_disabled(hook_set=None):
+    """Inside this context, don't run the hooks registered under hook_set.
+
+    If hook_set is None, don't run any hooks at all: get() and put()
+    call straight through to the datastore, as if we had never
+    installed the hooks.  This only affects the current thread -- that
+    is, the current request.
+
+    An async get only runs the get hooks if they are active both when
+    it is started and when its results are fetched.  A put's
+    after-put and after-commit hooks are the ones that were active
+    when the put was made.
+    """
+    names = ('put_hooks', 'get_hooks', 'after_put_hooks',
+             'after_commit_hooks')
+    old_hooks = [getattr(_hook_state, name) for name in names]
+    for (name, hooks) in zip(names, old_hooks):
+        if hook_set is None:
+            setattr(_hook_state, name, [])
+        else:
+            setattr(_hook_state, name,
+                    [hook for hook in hooks
+                     if _hook_set_of[_untimed_hook(hook)] != hook_set])
+    try:
+        yield
+    finally:
+        for (name, hooks) in zip(names, old_hooks):
+            setattr(_hook_state, name, hooks)
+
+
+# The prefix of the log line written by HookTimingMiddleware.
+HOOK_TIMINGS_LOG_PREFIX = 'db_hooks timings: '
+
+
+class HookTimingMiddleware(object):
+    """Wrap your WSGI app with this to log how long db_hooks hooks take.
+
+    At the end of each request that ran any hooks, we log a line with
+    HOOK_TIMINGS_LOG_PREFIX followed by hook_timings() as json.
+    """
+    def __init__(self, app):
+        self.app = app
+        set_hook_timing(True)
+
+    def __call__(self, environ, start_response):
+        reset_hook_timings()
+        try:
+            for retval in self.app(environ, start_response):
+                yield retval
+        finally:
+            timings = hook_timings()
+            if timings:
+                logging.info(HOOK_TIMINGS_LOG_PREFIX +
+                             json.dumps(timings, sort_keys=True))
+            reset_hook_timings()
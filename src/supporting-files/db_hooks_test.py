@@ -0,0 +1,551 @@
+"""Tests for db_hooks.py, run on top of fake_appengine/.
+
+Run these from this directory with
+    python -m unittest discover -p '*_test.py'
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'fake_appengine'))
+
+from google.appengine.api import datastore
+from google.appengine.datastore import datastore_rpc
+from google.appengine.ext import db
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb import tasklets
+
+import db_hooks
+
+
+# An alias taken before any test has installed db_hooks.
+_early_run_in_transaction_options = db.run_in_transaction_options
+
+
+class NdbModel(ndb.Model):
+    pass
+
+
+class DbModel(db.Model):
+    pass
+
+
+def _run_event_loop():
+    while tasklets.get_event_loop().run0():
+        pass
+
+
+def _recorder(batches):
+    """Return a batch hook that appends each batch it's given to batches."""
+    def record(models):
+        batches.append(list(models))
+
+    return record
+
+
+def _key_of(model):
+    if isinstance(model, ndb.Model):
+        return model.key
+    return model.key()
+
+
+class _DbHooksTestCase(unittest.TestCase):
+    """Installs fresh hooks that record every batch they're called with.
+
+    db_hooks has no way to remove a hook, so we empty its hook lists,
+    and put back whatever was there (say, txn_safety's hooks) when
+    we're done.
+    """
+    _HOOK_LISTS = ('_put_hooks', '_get_hooks', '_after_put_hooks',
+                   '_after_commit_hooks', '_put_model_filters',
+                   '_get_model_filters', '_after_put_model_filters',
+                   '_after_commit_model_filters')
+
+    def setUp(self):
+        self.saved_hook_lists = [list(getattr(db_hooks, name))
+                                 for name in self._HOOK_LISTS]
+        for name in self._HOOK_LISTS:
+            del getattr(db_hooks, name)[:]
+        self._clear_type_caches()
+        datastore.reset()
+
+        self.get_batches = []
+        self.put_batches = []
+        self.after_put_batches = []
+        self.after_commit_batches = []
+        db_hooks.add_after_get_batch_hook(_recorder(self.get_batches))
+        db_hooks.add_before_put_batch_hook(_recorder(self.put_batches))
+        db_hooks.add_after_put_batch_hook(
+            _recorder(self.after_put_batches))
+        db_hooks.add_after_commit_batch_hook(
+            _recorder(self.after_commit_batches))
+
+    def tearDown(self):
+        db_hooks.set_streaming_chunk_size(None)
+        db_hooks.clear_entity_hook_states()
+        db_hooks.clear_puts_awaiting_commit()
+        for (name, saved) in zip(self._HOOK_LISTS, self.saved_hook_lists):
+            getattr(db_hooks, name)[:] = saved
+        self._clear_type_caches()
+        _run_event_loop()
+
+    def _clear_type_caches(self):
+        db_hooks._kind_of_type.clear()
+        db_hooks._skips_put_hooks.clear()
+        db_hooks._skips_after_put_hooks.clear()
+
+    def assertHookedOnce(self, batches, models, msg=None):
+        """Assert that the hook saw each of models exactly once."""
+        hooked = sorted(repr(_key_of(model))
+                        for batch in batches for model in batch)
+        self.assertEqual(sorted(repr(_key_of(model)) for model in models),
+                         hooked, msg)
+
+
+class GetHooksRunOnceTest(_DbHooksTestCase):
+    def setUp(self):
+        super(GetHooksRunOnceTest, self).setUp()
+        with db_hooks.hooks_disabled():
+            self.ndb_keys = ndb.put_multi([NdbModel(id=i, value=i)
+                                           for i in xrange(5)])
+            self.db_keys = db.put([DbModel(key_name=str(i), value=i)
+                                   for i in xrange(5)])
+
+    def test_ndb_key_get(self):
+        model = self.ndb_keys[0].get()
+        self.assertHookedOnce(self.get_batches, [model])
+
+    def test_ndb_get_multi(self):
+        models = ndb.get_multi(self.ndb_keys)
+        self.assertEqual(1, len(self.get_batches))
+        self.assertHookedOnce(self.get_batches, models)
+
+    def test_ndb_get_multi_async(self):
+        futures = ndb.get_multi_async(self.ndb_keys)
+        _run_event_loop()
+        models = [future.get_result() for future in futures]
+        # Asking for the same results again doesn't re-run the hooks.
+        models = [future.get_result() for future in futures]
+        self.assertEqual(1, len(self.get_batches))
+        self.assertHookedOnce(self.get_batches, models)
+
+    def test_ndb_get_multi_async_result_before_the_rest_are_done(self):
+        futures = ndb.get_multi_async(self.ndb_keys)
+        # Nothing's done yet, but one result is asked for before the
+        # others; whatever order things happen in, each entity is
+        # hooked exactly once.
+        first = futures[0].get_result()
+        models = [first] + [future.get_result() for future in futures[1:]]
+        self.assertHookedOnce(self.get_batches, models)
+
+    def test_ndb_fetch(self):
+        models = NdbModel.query().fetch()
+        self.assertEqual(5, len(models))
+        self.assertEqual(1, len(self.get_batches))
+        self.assertHookedOnce(self.get_batches, models)
+
+    def test_ndb_fetch_page(self):
+        (models, cursor, more) = NdbModel.query().fetch_page(3)
+        (rest, _, _) = NdbModel.query().fetch_page(3, start_cursor=cursor)
+        self.assertTrue(more)
+        self.assertEqual(2, len(self.get_batches))
+        self.assertHookedOnce(self.get_batches, models + rest)
+
+    def test_ndb_iter(self):
+        models = list(NdbModel.query().iter())
+        self.assertEqual(5, len(models))
+        self.assertHookedOnce(self.get_batches, models)
+
+    def test_ndb_map(self):
+        models = NdbModel.query().map(lambda model: model)
+        self.assertHookedOnce(self.get_batches, models)
+
+    def test_ndb_get_or_insert(self):
+        existing = NdbModel.get_or_insert(0)
+        inserted = NdbModel.get_or_insert('new', value=-1)
+        self.assertHookedOnce(self.get_batches, [existing, inserted])
+
+    def test_ndb_get_or_insert_async_racing_another_insert(self):
+        future = NdbModel.get_or_insert_async('raced')
+        # Run get_or_insert_async's first get, which finds nothing ...
+        tasklets.get_event_loop().run0()
+        # ... and then have another request create the entity, so the
+        # transactional get finds it.
+        datastore._entities[ndb.Key(NdbModel, 'raced')._pair] = {}
+        model = future.get_result()
+        self.assertHookedOnce(self.get_batches, [model])
+        # Asking again doesn't re-run the hooks, either.
+        future.get_result()
+        self.assertHookedOnce(self.get_batches, [model])
+
+    def test_db_get(self):
+        model = db.get(self.db_keys[0])
+        models = db.get(self.db_keys)
+        self.assertHookedOnce(self.get_batches, [model] + models)
+
+    def test_db_get_async(self):
+        rpc = db.get_async(self.db_keys)
+        models = rpc.get_result()
+        self.assertHookedOnce(self.get_batches, models)
+
+    def test_db_get_or_insert(self):
+        existing = DbModel.get_or_insert('0')
+        inserted = DbModel.get_or_insert('new', value=-1)
+        self.assertHookedOnce(self.get_batches, [existing, inserted])
+
+    def test_db_query_fetch(self):
+        models = DbModel.all().fetch(10)
+        self.assertEqual(5, len(models))
+        self.assertHookedOnce(self.get_batches, models)
+
+    def test_db_query_run(self):
+        models = list(DbModel.all().run())
+        self.assertEqual(5, len(models))
+        self.assertHookedOnce(self.get_batches, models)
+
+    def test_db_query_run_chunked(self):
+        db_hooks.set_streaming_chunk_size(2)
+        models = list(DbModel.all())
+        self.assertEqual([2, 2, 1], [len(batch)
+                                     for batch in self.get_batches])
+        self.assertHookedOnce(self.get_batches, models)
+
+    def test_db_query_fetch_chunked(self):
+        db_hooks.set_streaming_chunk_size(2)
+        models = DbModel.all().fetch(10)
+        self.assertHookedOnce(self.get_batches, models)
+
+    def test_hooks_disabled(self):
+        with db_hooks.hooks_disabled():
+            ndb.get_multi(self.ndb_keys)
+            db.get(self.db_keys)
+            list(DbModel.all())
+        self.assertEqual([], self.get_batches)
+
+
+class PutHooksRunOnceTest(_DbHooksTestCase):
+    def assertPutHooksRanOnce(self, models):
+        self.assertHookedOnce(self.put_batches, models)
+        self.assertHookedOnce(self.after_put_batches, models)
+        self.assertHookedOnce(self.after_commit_batches, models)
+
+    def test_ndb_put(self):
+        model = NdbModel(id=1)
+        model.put()
+        self.assertPutHooksRanOnce([model])
+
+    def test_ndb_put_multi(self):
+        models = [NdbModel(id=i) for i in xrange(5)]
+        ndb.put_multi(models)
+        self.assertEqual(1, len(self.put_batches))
+        self.assertEqual(1, len(self.after_put_batches))
+        self.assertPutHooksRanOnce(models)
+
+    def test_ndb_put_multi_async(self):
+        models = [NdbModel(id=i) for i in xrange(5)]
+        futures = ndb.put_multi_async(models)
+        # The after-put hooks run from the event loop, without anyone
+        # asking for the results.
+        _run_event_loop()
+        self.assertPutHooksRanOnce(models)
+        for future in futures:
+            future.get_result()
+        self.assertPutHooksRanOnce(models)
+
+    def test_db_put(self):
+        model = DbModel(key_name='one')
+        model.put()
+        models = [DbModel(key_name=str(i)) for i in xrange(5)]
+        db.put(models)
+        self.assertPutHooksRanOnce([model] + models)
+
+    def test_db_put_generator(self):
+        models = [DbModel(key_name=str(i)) for i in xrange(5)]
+        keys = db.put(model for model in models)
+        self.assertEqual([model.key() for model in models], keys)
+        self.assertEqual(1, len(self.put_batches))
+        self.assertPutHooksRanOnce(models)
+
+    def test_db_put_generator_chunked(self):
+        db_hooks.set_streaming_chunk_size(2)
+        models = [DbModel(key_name=str(i)) for i in xrange(5)]
+        keys = db.put(model for model in models)
+        self.assertEqual([model.key() for model in models], keys)
+        self.assertEqual([2, 2, 1], [len(batch)
+                                     for batch in self.put_batches])
+        self.assertPutHooksRanOnce(models)
+
+    def test_db_put_async_generator_chunked(self):
+        db_hooks.set_streaming_chunk_size(2)
+        models = [DbModel(key_name=str(i)) for i in xrange(5)]
+        rpc = db.put_async(iter(models))
+        self.assertEqual([model.key() for model in models],
+                         rpc.get_result())
+        self.assertPutHooksRanOnce(models)
+
+    def test_chunking_leaves_lists_alone(self):
+        db_hooks.set_streaming_chunk_size(2)
+        models = [DbModel(key_name=str(i)) for i in xrange(5)]
+        db.put(models)
+        self.assertEqual(1, len(self.put_batches))
+        self.assertPutHooksRanOnce(models)
+
+    def test_hooks_disabled(self):
+        with db_hooks.hooks_disabled():
+            ndb.put_multi([NdbModel(id=i) for i in xrange(5)])
+            db.put(DbModel(key_name=str(i)) for i in xrange(5))
+        self.assertEqual([], self.put_batches)
+        self.assertEqual([], self.after_put_batches)
+        self.assertEqual([], self.after_commit_batches)
+
+
+class AfterCommitHooksTest(_DbHooksTestCase):
+    def put_in_transaction(self, models, fail=False):
+        """Return a transaction callback that puts models.
+
+        The after-commit hooks mustn't have run by the time it's done.
+        """
+        def txn():
+            db.put(models)
+            self.assertHookedOnce(self.after_put_batches, models)
+            self.assertEqual([], self.after_commit_batches)
+            if fail:
+                raise RuntimeError('rolled back')
+
+        return txn
+
+    def test_db_commit(self):
+        models = [DbModel(key_name=str(i)) for i in xrange(3)]
+        db.run_in_transaction(self.put_in_transaction(models))
+        self.assertEqual(1, len(self.after_commit_batches))
+        self.assertHookedOnce(self.after_commit_batches, models)
+
+    def test_db_rollback(self):
+        models = [DbModel(key_name=str(i)) for i in xrange(3)]
+        with self.assertRaises(RuntimeError):
+            db.run_in_transaction(self.put_in_transaction(models,
+                                                          fail=True))
+        self.assertEqual([], self.after_commit_batches)
+        self.assertEqual({}, db_hooks._hook_state.puts_awaiting_commit)
+
+    def test_every_way_into_a_db_transaction(self):
+        @db.transactional
+        def decorated(txn):
+            txn()
+
+        @db.transactional(xg=True)
+        def decorated_with_options(txn):
+            txn()
+
+        entry_points = (
+            ('datastore.RunInTransaction', datastore.RunInTransaction),
+            ('datastore.RunInTransactionOptions',
+             lambda txn: datastore.RunInTransactionOptions(None, txn)),
+            ('datastore.RunInTransactionCustomRetries',
+             lambda txn: datastore.RunInTransactionCustomRetries(3, txn)),
+            ('db.run_in_transaction', db.run_in_transaction),
+            ('db.run_in_transaction_options',
+             lambda txn: db.run_in_transaction_options(None, txn)),
+            ('db.run_in_transaction_custom_retries',
+             lambda txn: db.run_in_transaction_custom_retries(3, txn)),
+            ('db.transactional', decorated),
+            ('db.transactional(xg=True)', decorated_with_options),
+            ('an alias taken before db_hooks was installed',
+             lambda txn: _early_run_in_transaction_options(None, txn)))
+        for (name, run_in_transaction) in entry_points:
+            del self.after_put_batches[:]
+            del self.after_commit_batches[:]
+            models = [DbModel(key_name='%s %s' % (name, i))
+                      for i in xrange(2)]
+            run_in_transaction(self.put_in_transaction(models))
+            self.assertHookedOnce(self.after_commit_batches, models, name)
+            self.assertEqual({}, db_hooks._hook_state.puts_awaiting_commit,
+                             name)
+
+    def test_forgets_unfinished_transactions_between_requests(self):
+        # A transaction we can't see the end of, as if it were started
+        # some way we don't hook.
+        datastore._PushConnection(datastore_rpc.TransactionalConnection())
+        try:
+            DbModel(key_name='never committed').put()
+        finally:
+            datastore._PopConnection()
+        self.assertEqual(1, len(db_hooks._hook_state.puts_awaiting_commit))
+        db_hooks.clear_puts_awaiting_commit()
+        self.assertEqual({}, db_hooks._hook_state.puts_awaiting_commit)
+        self.assertEqual([], self.after_commit_batches)
+
+    def test_ndb_commit(self):
+        models = [NdbModel(id=i) for i in xrange(3)]
+
+        def txn():
+            ndb.put_multi(models)
+            self.assertEqual([], self.after_commit_batches)
+
+        ndb.transaction(txn)
+        self.assertEqual(1, len(self.after_commit_batches))
+        self.assertHookedOnce(self.after_commit_batches, models)
+
+    def test_ndb_rollback(self):
+        def txn():
+            NdbModel(id=1).put()
+            raise RuntimeError('rolled back')
+
+        future = ndb.transaction_async(txn)
+        with self.assertRaises(RuntimeError):
+            future.get_result()
+        self.assertEqual([], self.after_commit_batches)
+        self.assertEqual({}, db_hooks._hook_state.puts_awaiting_commit)
+
+    def test_nested_async_transactions(self):
+        outer = NdbModel(id='outer')
+        inner = NdbModel(id='inner')
+
+        @ndb.tasklet
+        def inner_txn():
+            yield inner.put_async()
+
+        @ndb.tasklet
+        def outer_txn():
+            yield outer.put_async()
+            # This joins the outer transaction, so its puts are
+            # committed -- and hooked -- along with the outer ones.
+            yield ndb.transaction_async(inner_txn)
+            self.assertEqual([], self.after_commit_batches)
+
+        ndb.transaction_async(outer_txn).get_result()
+        self.assertEqual(1, len(self.after_commit_batches))
+        self.assertHookedOnce(self.after_commit_batches, [outer, inner])
+
+    def test_retried_transaction(self):
+        attempts = []
+
+        def run_with_one_retry(callback):
+            """Like db.run_in_transaction, if the first commit failed."""
+            for _ in xrange(2):
+                datastore._PushConnection(
+                    datastore_rpc.TransactionalConnection())
+                try:
+                    callback()
+                finally:
+                    datastore._PopConnection()
+
+        def txn():
+            model = DbModel(key_name='attempt %s' % len(attempts))
+            attempts.append(model)
+            model.put()
+
+        db_hooks._wrap_up_transaction(run_with_one_retry, 0)(txn)
+        self.assertHookedOnce(self.after_put_batches, attempts)
+        self.assertHookedOnce(self.after_commit_batches, attempts[1:])
+
+    def test_transaction_that_has_not_begun(self):
+        # The SDK can put off beginning a transaction until its first
+        # rpc, so the transaction is None when the callback starts.
+        models = [DbModel(key_name=str(i)) for i in xrange(3)]
+
+        def txn():
+            datastore._GetConnection().transaction = None
+            db.put(models)
+            self.assertEqual([], self.after_commit_batches)
+
+        db.run_in_transaction(txn)
+        self.assertHookedOnce(self.after_commit_batches, models)
+
+    def test_hooks_disabled(self):
+        hooked = DbModel(key_name='hooked')
+        not_hooked = DbModel(key_name='not hooked')
+
+        def txn():
+            with db_hooks.hooks_disabled():
+                not_hooked.put()
+            hooked.put()
+
+        db.run_in_transaction(txn)
+        with db_hooks.hooks_disabled():
+            db.run_in_transaction(lambda: DbModel(key_name='also not').put())
+        self.assertHookedOnce(self.after_put_batches, [hooked])
+        self.assertHookedOnce(self.after_commit_batches, [hooked])
+
+
+class EntityHookStateTest(unittest.TestCase):
+    def tearDown(self):
+        db_hooks.clear_entity_hook_states()
+
+    def test_state_belongs_to_one_entity(self):
+        model = NdbModel(id=1)
+        db_hooks.entity_hook_state(model).get_nonce = 1
+        self.assertEqual(1, db_hooks.entity_hook_state(model).get_nonce)
+        self.assertIsNone(db_hooks.entity_hook_state(NdbModel(id=1),
+                                                     create=False))
+
+    def test_forgets_entities_that_have_gone_away(self):
+        live = [NdbModel(id=i) for i in xrange(10)]
+        for model in live:
+            db_hooks.entity_hook_state(model).get_nonce = model.key.id()
+        for i in xrange(10 * db_hooks._MIN_ENTITY_STATES_SWEEP_SIZE):
+            db_hooks.entity_hook_state(NdbModel(id=i))
+        self.assertLessEqual(len(db_hooks._hook_state.entity_states),
+                             2 * db_hooks._MIN_ENTITY_STATES_SWEEP_SIZE)
+        for model in live:
+            self.assertEqual(model.key.id(),
+                             db_hooks.entity_hook_state(model).get_nonce)
+
+
+class CurrentTransactionTest(unittest.TestCase):
+    def setUp(self):
+        db_hooks._ensure_db_hooks_installed()
+
+    def tearDown(self):
+        self.start_new_request()
+        datastore._GetConnection()
+
+    def start_new_request(self):
+        """Do what appengine does when this thread gets a new request."""
+        os.environ.pop(datastore._ENV_KEY, None)
+
+    def test_follows_transactions(self):
+        self.assertIsNone(db_hooks.current_transaction())
+        transactions = []
+
+        def txn():
+            transactions.append(db_hooks.current_transaction())
+
+        db.run_in_transaction(txn)
+        ndb.transaction(txn)
+        self.assertIsNotNone(transactions[0])
+        self.assertIsNotNone(transactions[1])
+        self.assertIsNone(db_hooks.current_transaction())
+
+    def _leave_a_transaction_open(self):
+        """End a request in a transaction, as an abandoned tasklet can."""
+        datastore._PushConnection(datastore_rpc.TransactionalConnection())
+        self.assertIsNotNone(db_hooks.current_transaction())
+
+    def test_new_request_on_the_same_thread(self):
+        self._leave_a_transaction_open()
+        self.start_new_request()
+        self.assertIsNone(db_hooks.current_transaction())
+
+    def test_new_request_that_has_used_the_datastore(self):
+        self._leave_a_transaction_open()
+        self.start_new_request()
+        datastore._GetConnection()
+        self.assertIsNone(db_hooks.current_transaction())
+
+    def test_transaction_in_a_new_request(self):
+        self._leave_a_transaction_open()
+        self.start_new_request()
+        transactions = []
+        db.run_in_transaction(
+            lambda: transactions.append(db_hooks.current_transaction()))
+        self.assertIsNotNone(transactions[0])
+        self.assertIs(datastore._GetConnection().__class__,
+                      datastore_rpc.Connection)
+        self.assertIsNone(db_hooks.current_transaction())
+
+
+if __name__ == '__main__':
+    unittest.main()
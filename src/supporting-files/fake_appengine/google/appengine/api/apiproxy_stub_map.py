@@ -0,0 +1,29 @@
+"""Fake of google.appengine.api.apiproxy_stub_map: just UserRPC."""
+
+
+class UserRPC(object):
+    """An rpc that has already finished, with a result or an exception."""
+    def __init__(self, result=None, exception=None):
+        self._result = result
+        self._exception = exception
+
+    def wait(self):
+        pass
+
+    def check_success(self):
+        if self._exception is not None:
+            raise self._exception
+
+    def get_result(self):
+        self.check_success()
+        return self._result
+
+    @classmethod
+    def wait_all(cls, rpcs):
+        pass
+
+    @classmethod
+    def wait_any(cls, rpcs):
+        for rpc in rpcs:
+            return rpc
+        return None
@@ -0,0 +1,105 @@
+"""Fake of google.appengine.api.datastore: the connection and transactions.
+
+In a transaction, db and ndb both make the current connection -- the
+one _GetConnection() returns -- a datastore_rpc.TransactionalConnection.
+"""
+
+import functools
+import itertools
+import os
+import threading
+
+from google.appengine.datastore import datastore_rpc
+
+
+# The entities in the datastore, as a map from (kind, id-or-name) to a
+# dict of the entity's attributes.  db and ndb both keep theirs here.
+_entities = {}
+_ids = itertools.count(1)
+
+
+def reset():
+    """Empty the datastore."""
+    _entities.clear()
+
+
+def _AllocateId():
+    return next(_ids)
+
+
+# As in the real SDK, each thread has a stack of connections, which
+# we reset at the start of each request (noticed via an environment
+# variable, which is reset between requests); the top one is the
+# current connection.  RunInTransactionOptions pushes a transactional
+# connection, and ndb's transactions _SetConnection() one.
+_ENV_KEY = '__DATASTORE_CONNECTION_INITIALIZED__'
+_thread_local = threading.local()
+
+
+def _InitConnection():
+    if os.getenv(_ENV_KEY) and hasattr(_thread_local, 'connection_stack'):
+        return
+    _thread_local.connection_stack = [datastore_rpc.Connection()]
+    os.environ[_ENV_KEY] = '1'
+
+
+def _GetConnection():
+    _InitConnection()
+    return _thread_local.connection_stack[-1]
+
+
+def _SetConnection(connection):
+    _InitConnection()
+    _thread_local.connection_stack[-1] = connection
+
+
+def _PushConnection(new_connection):
+    _InitConnection()
+    _thread_local.connection_stack.append(new_connection)
+
+
+def _PopConnection():
+    assert len(_thread_local.connection_stack) >= 2
+    return _thread_local.connection_stack.pop()
+
+
+def IsInTransaction():
+    return isinstance(_GetConnection(),
+                      datastore_rpc.TransactionalConnection)
+
+
+def RunInTransaction(function, *args, **kwargs):
+    return RunInTransactionOptions(None, function, *args, **kwargs)
+
+
+def RunInTransactionCustomRetries(retries, function, *args, **kwargs):
+    return RunInTransactionOptions(None, function, *args, **kwargs)
+
+
+def Transactional(_func=None, **kwargs):
+    """Decorate a function to run in a transaction; kwargs are ignored."""
+    if _func is None:
+        return lambda func: Transactional(func, **kwargs)
+
+    @functools.wraps(_func)
+    def transactional_wrapper(*args, **kwds):
+        return RunInTransactionOptions(None, _func, *args, **kwds)
+
+    return transactional_wrapper
+
+
+def RunInTransactionOptions(options, function, *args, **kwargs):
+    """Run function in a transaction -- or the current one, if there is one.
+
+    As in the real SDK, every other way of running a transaction in db
+    or datastore calls this.  Nothing is isolated or rolled back, and
+    options are ignored; we only make a transactional connection the
+    current one while function runs.
+    """
+    if IsInTransaction():
+        return function(*args, **kwargs)
+    _PushConnection(datastore_rpc.TransactionalConnection())
+    try:
+        return function(*args, **kwargs)
+    finally:
+        _PopConnection()
@@ -0,0 +1,42 @@
+"""Fake of google.appengine.api.datastore_types: just Key."""
+
+
+class Key(object):
+    """A db key: a kind and a key-name or numeric id.  No parents."""
+    def __init__(self, kind, id_or_name):
+        self._kind = kind
+        self._id_or_name = id_or_name
+
+    @classmethod
+    def from_path(cls, kind, id_or_name):
+        return cls(kind, id_or_name)
+
+    def kind(self):
+        return self._kind
+
+    def id(self):
+        if isinstance(self._id_or_name, (int, long)):
+            return self._id_or_name
+        return None
+
+    def name(self):
+        if isinstance(self._id_or_name, basestring):
+            return self._id_or_name
+        return None
+
+    def id_or_name(self):
+        return self._id_or_name
+
+    def __eq__(self, other):
+        return (isinstance(other, Key) and
+                (self._kind, self._id_or_name) ==
+                (other._kind, other._id_or_name))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self._kind, self._id_or_name))
+
+    def __repr__(self):
+        return 'datastore_types.Key(%r, %r)' % (self._kind, self._id_or_name)
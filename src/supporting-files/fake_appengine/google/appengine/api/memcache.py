@@ -0,0 +1,178 @@
+"""Fake of google.appengine.api.memcache, backed by a dict."""
+
+import threading
+import time as _time
+
+from google.appengine.api import apiproxy_stub_map
+
+
+STORED = 1
+NOT_STORED = 2
+ERROR = 3
+EXISTS = 4
+
+DELETE_NETWORK_FAILURE = 0
+DELETE_ITEM_MISSING = 1
+DELETE_SUCCESSFUL = 2
+
+# Map from (namespace, key) to (value, expiration time or 0, cas-id).
+_data = {}
+_lock = threading.Lock()
+_next_cas_id = [0]
+
+
+def reset():
+    """Empty memcache."""
+    with _lock:
+        _data.clear()
+
+
+def create_rpc(deadline=None, callback=None):
+    return apiproxy_stub_map.UserRPC()
+
+
+def _expiration(time):
+    # As with real memcache, large times are absolute timestamps.
+    if not time:
+        return 0
+    if time > 86400 * 30:
+        return time
+    return _time.time() + time
+
+
+def _live_item(full_key):
+    item = _data.get(full_key)
+    if item is not None and item[1] and item[1] <= _time.time():
+        del _data[full_key]
+        return None
+    return item
+
+
+def _store(full_key, value, time):
+    _next_cas_id[0] += 1
+    _data[full_key] = (value, _expiration(time), _next_cas_id[0])
+
+
+class Client(object):
+    def __init__(self):
+        # Map from (namespace, key) to the cas-id we last saw for it.
+        self._cas_ids = {}
+
+    def get_multi_async(self, keys, key_prefix='', namespace=None,
+                        for_cas=False, rpc=None):
+        retval = {}
+        with _lock:
+            for key in keys:
+                full_key = (namespace, key_prefix + key)
+                item = _live_item(full_key)
+                if item is not None:
+                    retval[key] = item[0]
+                    if for_cas:
+                        self._cas_ids[full_key] = item[2]
+        return apiproxy_stub_map.UserRPC(retval)
+
+    def _update_multi_async(self, mapping, time, key_prefix, namespace,
+                            should_store):
+        retval = {}
+        with _lock:
+            for (key, value) in mapping.iteritems():
+                full_key = (namespace, key_prefix + key)
+                status = should_store(full_key, _live_item(full_key))
+                if status == STORED:
+                    _store(full_key, value, time)
+                retval[key] = status
+        return apiproxy_stub_map.UserRPC(retval)
+
+    def set_multi_async(self, mapping, time=0, key_prefix='',
+                        min_compress_len=0, namespace=None, rpc=None):
+        return self._update_multi_async(
+            mapping, time, key_prefix, namespace,
+            lambda full_key, item: STORED)
+
+    def add_multi_async(self, mapping, time=0, key_prefix='',
+                        min_compress_len=0, namespace=None, rpc=None):
+        return self._update_multi_async(
+            mapping, time, key_prefix, namespace,
+            lambda full_key, item: STORED if item is None else NOT_STORED)
+
+    def replace_multi_async(self, mapping, time=0, key_prefix='',
+                            min_compress_len=0, namespace=None, rpc=None):
+        return self._update_multi_async(
+            mapping, time, key_prefix, namespace,
+            lambda full_key, item: NOT_STORED if item is None else STORED)
+
+    def cas_multi_async(self, mapping, time=0, key_prefix='',
+                        min_compress_len=0, namespace=None, rpc=None):
+        def should_store(full_key, item):
+            if item is None or full_key not in self._cas_ids:
+                return NOT_STORED
+            if item[2] != self._cas_ids[full_key]:
+                return EXISTS
+            return STORED
+
+        return self._update_multi_async(mapping, time, key_prefix,
+                                        namespace, should_store)
+
+    def delete_multi_async(self, keys, seconds=0, key_prefix='',
+                           namespace=None, rpc=None):
+        retval = []
+        with _lock:
+            for key in keys:
+                full_key = (namespace, key_prefix + key)
+                if _live_item(full_key) is None:
+                    retval.append(DELETE_ITEM_MISSING)
+                else:
+                    del _data[full_key]
+                    retval.append(DELETE_SUCCESSFUL)
+        return apiproxy_stub_map.UserRPC(retval)
+
+    def offset_multi_async(self, mapping, key_prefix='', namespace=None,
+                           initial_value=None, rpc=None):
+        retval = {}
+        with _lock:
+            for (key, delta) in mapping.iteritems():
+                full_key = (namespace, key_prefix + key)
+                item = _live_item(full_key)
+                if item is None:
+                    if initial_value is None:
+                        retval[key] = None
+                        continue
+                    item = (initial_value, 0, None)
+                value = max(0, int(item[0]) + delta)
+                # Unlike set(), this keeps the old expiration time.
+                _next_cas_id[0] += 1
+                _data[full_key] = (value, item[1], _next_cas_id[0])
+                retval[key] = value
+        return apiproxy_stub_map.UserRPC(retval)
+
+    def get(self, key, namespace=None, for_cas=False):
+        return self.get_multi_async([key], namespace=namespace,
+                                    for_cas=for_cas).get_result().get(key)
+
+    def set(self, key, value, time=0, namespace=None):
+        return self.set_multi_async({key: value}, time=time,
+                                    namespace=namespace
+                                    ).get_result()[key] == STORED
+
+    def add(self, key, value, time=0, namespace=None):
+        return self.add_multi_async({key: value}, time=time,
+                                    namespace=namespace
+                                    ).get_result()[key] == STORED
+
+    def delete(self, key, seconds=0, namespace=None):
+        return self.delete_multi_async(
+            [key], seconds=seconds, namespace=namespace).get_result()[0]
+
+    def incr(self, key, delta=1, namespace=None, initial_value=None):
+        return self.offset_multi_async(
+            {key: delta}, namespace=namespace,
+            initial_value=initial_value).get_result()[key]
+
+
+# The module-level functions, like the real memcache has.
+_client = Client()
+get = _client.get
+set = _client.set
+add = _client.add
+delete = _client.delete
+incr = _client.incr
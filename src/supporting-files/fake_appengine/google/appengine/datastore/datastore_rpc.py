@@ -0,0 +1,21 @@
+"""Fake of google.appengine.datastore.datastore_rpc: the connections.
+
+A TransactionalConnection's transaction is what db_hooks and
+txn_safety look at.  As in the real SDK, the transaction may be None
+until the transaction has actually begun, which the real SDK can put
+off until the first rpc made in the transaction.
+"""
+
+
+class Transaction(object):
+    """Stands in for a datastore transaction; only its identity matters."""
+    pass
+
+
+class Connection(object):
+    pass
+
+
+class TransactionalConnection(Connection):
+    def __init__(self):
+        self.transaction = Transaction()
@@ -0,0 +1,241 @@
+"""Fake of google.appengine.ext.db; see fake_appengine/README.
+
+Models are plain objects: every attribute not starting with '_' is
+stored.  Like the real db, put() and get() are implemented in terms
+of put_async() and get_async(), but Model.put() is not.
+"""
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore
+from google.appengine.api import datastore_types
+
+
+Key = datastore_types.Key
+
+
+class Error(Exception):
+    pass
+
+
+class BadArgumentError(Error):
+    pass
+
+
+class NotSavedError(Error):
+    pass
+
+
+# Map from kind to model class.
+_kind_map = {}
+
+
+class _PropertiedClass(type):
+    def __init__(cls, name, bases, dct):
+        super(_PropertiedClass, cls).__init__(name, bases, dct)
+        _kind_map[cls.kind()] = cls
+
+
+class Model(object):
+    __metaclass__ = _PropertiedClass
+
+    def __init__(self, key_name=None, **kwds):
+        if key_name is not None:
+            self._key = Key(self.kind(), key_name)
+        else:
+            self._key = None
+        self.__dict__.update(kwds)
+
+    @classmethod
+    def kind(cls):
+        return cls.__name__
+
+    def key(self):
+        if self._key is None:
+            raise NotSavedError('%s has not been put()' % self.kind())
+        return self._key
+
+    def is_saved(self):
+        return self._key is not None
+
+    def put(self, **kwargs):
+        return _put_models([self])[0]
+
+    def delete(self, **kwargs):
+        delete(self.key())
+
+    @classmethod
+    def get(cls, keys, **kwargs):
+        return get(keys, **kwargs)
+
+    @classmethod
+    def get_by_key_name(cls, key_names, **kwargs):
+        if isinstance(key_names, basestring):
+            return get(Key(cls.kind(), key_names), **kwargs)
+        return get([Key(cls.kind(), name) for name in key_names], **kwargs)
+
+    @classmethod
+    def get_by_id(cls, ids, **kwargs):
+        if isinstance(ids, (int, long)):
+            return get(Key(cls.kind(), ids), **kwargs)
+        return get([Key(cls.kind(), id) for id in ids], **kwargs)
+
+    @classmethod
+    def get_or_insert(cls, key_name, **kwds):
+        def txn():
+            entity = cls.get_by_key_name(key_name)
+            if entity is None:
+                entity = cls(key_name=key_name, **kwds)
+                entity.put()
+            return entity
+
+        return run_in_transaction(txn)
+
+    @classmethod
+    def all(cls, keys_only=False):
+        return Query(cls, keys_only=keys_only)
+
+
+def _load(key):
+    """Return a new model for the entity with the given key, or None."""
+    values = datastore._entities.get((key.kind(), key.id_or_name()))
+    if values is None:
+        return None
+    cls = _kind_map[key.kind()]
+    model = cls.__new__(cls)
+    model.__dict__.update(values)
+    model._key = key
+    return model
+
+
+def _put_models(models):
+    keys = []
+    for model in models:
+        if model._key is None:
+            model._key = Key(model.kind(), datastore._AllocateId())
+        values = dict((name, value)
+                      for (name, value) in model.__dict__.iteritems()
+                      if not name.startswith('_'))
+        datastore._entities[(model._key.kind(),
+                             model._key.id_or_name())] = values
+        keys.append(model._key)
+    return keys
+
+
+def _normalize(arg, types):
+    """Return (arg as a list, whether arg was a list), like the real db."""
+    if isinstance(arg, types):
+        return ([arg], False)
+    if isinstance(arg, basestring):
+        raise BadArgumentError('Expected %s, got %r' % (types, arg))
+    arg = list(arg)
+    for item in arg:
+        if not isinstance(item, types):
+            raise BadArgumentError('Expected %s, got %r' % (types, item))
+    return (arg, True)
+
+
+def put_async(models, **kwargs):
+    (models, multiple) = _normalize(models, Model)
+    keys = _put_models(models)
+    return apiproxy_stub_map.UserRPC(keys if multiple else keys[0])
+
+
+def put(models, **kwargs):
+    return put_async(models, **kwargs).get_result()
+
+
+def get_async(keys, **kwargs):
+    (keys, multiple) = _normalize(keys, Key)
+    models = [_load(key) for key in keys]
+    return apiproxy_stub_map.UserRPC(models if multiple else models[0])
+
+
+def get(keys, **kwargs):
+    return get_async(keys, **kwargs).get_result()
+
+
+def delete_async(keys, **kwargs):
+    (keys, _) = _normalize(keys, Key)
+    for key in keys:
+        datastore._entities.pop((key.kind(), key.id_or_name()), None)
+    return apiproxy_stub_map.UserRPC(None)
+
+
+def delete(keys, **kwargs):
+    return delete_async(keys, **kwargs).get_result()
+
+
+def run_in_transaction(function, *args, **kwargs):
+    return datastore.RunInTransaction(function, *args, **kwargs)
+
+
+def run_in_transaction_options(options, function, *args, **kwargs):
+    return datastore.RunInTransactionOptions(options, function,
+                                             *args, **kwargs)
+
+
+def run_in_transaction_custom_retries(retries, function, *args, **kwargs):
+    return datastore.RunInTransactionCustomRetries(retries, function,
+                                                   *args, **kwargs)
+
+
+transactional = datastore.Transactional
+
+
+def is_in_transaction():
+    return datastore.IsInTransaction()
+
+
+class Query(object):
+    """A query on one kind.  Only equality filters are supported."""
+    def __init__(self, model_class, keys_only=False):
+        self._kind = model_class.kind()
+        self._keys_only = keys_only
+        self._filters = []
+
+    def filter(self, property_operator, value):
+        name = property_operator.strip()
+        if name.endswith('='):
+            name = name[:-1].strip()
+        self._filters.append((name, value))
+        return self
+
+    def order(self, property):
+        return self     # we return results in key order, regardless
+
+    def _matching_keys(self):
+        keys = []
+        for ((kind, id_or_name), values) in datastore._entities.items():
+            if kind == self._kind and all(values.get(name) == value
+                                          for (name, value) in self._filters):
+                keys.append(Key(kind, id_or_name))
+        keys.sort(key=Key.id_or_name)
+        return keys
+
+    def _results(self, keys):
+        for key in keys:
+            if self._keys_only:
+                yield key
+            else:
+                model = _load(key)
+                if model is not None:
+                    yield model
+
+    def run(self, limit=None, offset=0, batch_size=20, **kwargs):
+        keys = self._matching_keys()[offset:]
+        if limit is not None:
+            keys = keys[:limit]
+        return self._results(keys)
+
+    def __iter__(self):
+        return self.run()
+
+    def fetch(self, limit, offset=0, **kwargs):
+        return list(self.run(limit=limit, offset=offset, **kwargs))
+
+    def get(self, **kwargs):
+        results = self.fetch(1, **kwargs)
+        return results[0] if results else None
+
+    def count(self, limit=None, **kwargs):
+        return len(self._matching_keys()[:limit])
@@ -0,0 +1,5 @@
+"""Fake of google.appengine.ext.ndb; see fake_appengine/README."""
+
+from google.appengine.ext.ndb.tasklets import *
+from google.appengine.ext.ndb.context import *
+from google.appengine.ext.ndb.model import *
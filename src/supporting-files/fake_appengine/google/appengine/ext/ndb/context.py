@@ -0,0 +1,44 @@
+"""Fake of ndb's Context: just enough to run transactions."""
+
+import threading
+
+from google.appengine.api import datastore
+from google.appengine.datastore import datastore_rpc
+from google.appengine.ext.ndb import tasklets
+
+
+__all__ = ['Context', 'get_context']
+
+
+class Context(object):
+    @tasklets.tasklet
+    def transaction(self, callback, **ctx_options):
+        """Run callback in a transaction, or the current one if there is one.
+
+        Nothing is isolated or rolled back.  As in the real ndb, the
+        transaction's connection is the datastore's current one until
+        callback finishes, even while other tasklets run.
+        """
+        old_connection = datastore._GetConnection()
+        if not datastore.IsInTransaction():
+            datastore._SetConnection(
+                datastore_rpc.TransactionalConnection())
+        try:
+            result = callback()
+            if isinstance(result, tasklets.Future):
+                result = yield result
+        finally:
+            datastore._SetConnection(old_connection)
+        raise tasklets.Return(result)
+
+
+class _ContextState(threading.local):
+    def __init__(self):
+        self.context = Context()
+
+
+_state = _ContextState()
+
+
+def get_context():
+    return _state.context
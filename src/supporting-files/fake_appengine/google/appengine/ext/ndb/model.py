@@ -0,0 +1,351 @@
+"""Fake of ndb's keys, models, queries and transactions.
+
+Models are plain objects: every attribute not starting with '_',
+except key, is stored.  Queries return all the entities of a kind, in
+key order; they don't take filters.
+
+Like the real ndb, the module-level *_multi functions call the
+*_multi_async functions in this module, not whatever is in the ndb
+package; Model.put() and get_or_insert() call the private
+_put_async() and _get_or_insert_async(); Key.get(), the queries
+and get_or_insert call the public methods they call in the real ndb;
+and every transaction goes through Context.transaction().  db_hooks
+depends on all of this.
+"""
+
+from google.appengine.api import datastore
+from google.appengine.ext.ndb import context
+from google.appengine.ext.ndb import tasklets
+
+
+__all__ = ['Key', 'Model', 'Query', 'QueryIterator',
+           'get_multi', 'get_multi_async', 'put_multi', 'put_multi_async',
+           'delete_multi', 'delete_multi_async',
+           'in_transaction', 'transaction', 'transaction_async',
+           'transactional']
+
+
+# Map from kind to model class.
+_kind_map = {}
+
+
+class Key(object):
+    """A key: a kind and a string or integer id.  No parents."""
+    def __init__(self, kind, id):
+        if isinstance(kind, type):
+            kind = kind._get_kind()
+        self._pair = (kind, id)
+
+    def kind(self):
+        return self._pair[0]
+
+    def id(self):
+        return self._pair[1]
+
+    def string_id(self):
+        id = self._pair[1]
+        return id if isinstance(id, basestring) else None
+
+    def integer_id(self):
+        id = self._pair[1]
+        return id if isinstance(id, (int, long)) else None
+
+    def pairs(self):
+        return (self._pair,)
+
+    def __eq__(self, other):
+        return isinstance(other, Key) and self._pair == other._pair
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._pair)
+
+    def __repr__(self):
+        return 'Key(%r, %r)' % self._pair
+
+    def get_async(self, **ctx_options):
+        return _batcher().get(self)
+
+    def get(self, **ctx_options):
+        return self.get_async(**ctx_options).get_result()
+
+    def delete_async(self, **ctx_options):
+        datastore._entities.pop(self._pair, None)
+        return _batcher().finished(None)
+
+    def delete(self, **ctx_options):
+        return self.delete_async(**ctx_options).get_result()
+
+
+def _load(key):
+    """Return a new model for the entity with the given key, or None."""
+    values = datastore._entities.get(key._pair)
+    if values is None:
+        return None
+    cls = _kind_map[key.kind()]
+    model = cls.__new__(cls)
+    model.__dict__.update(values)
+    model.key = key
+    return model
+
+
+class _Batcher(object):
+    """Collects the rpcs made before the event loop runs into one batch."""
+    def __init__(self, event_loop):
+        self._event_loop = event_loop
+        self._pending = []      # (future, function returning its result)
+
+    def _add(self, future, result_fn):
+        if not self._pending:
+            self._event_loop.queue_rpc(self._flush)
+        self._pending.append((future, result_fn))
+        return future
+
+    def _flush(self):
+        (pending, self._pending) = (self._pending, [])
+        for (future, result_fn) in pending:
+            future.set_result(result_fn())
+
+    def get(self, key):
+        return self._add(tasklets.Future('get %r' % key), lambda: _load(key))
+
+    def finished(self, result):
+        return self._add(tasklets.Future(), lambda: result)
+
+
+def _batcher():
+    event_loop = tasklets.get_event_loop()
+    batcher = getattr(event_loop, 'batcher', None)
+    if batcher is None:
+        batcher = event_loop.batcher = _Batcher(event_loop)
+    return batcher
+
+
+class _MetaModel(type):
+    def __init__(cls, name, bases, dct):
+        super(_MetaModel, cls).__init__(name, bases, dct)
+        _kind_map[cls._get_kind()] = cls
+
+
+class Model(object):
+    __metaclass__ = _MetaModel
+
+    def __init__(self, id=None, key=None, **kwds):
+        if key is None and id is not None:
+            key = Key(self._get_kind(), id)
+        self.key = key
+        self.__dict__.update(kwds)
+
+    @classmethod
+    def _get_kind(cls):
+        return cls.__name__
+
+    def _put_async(self, **ctx_options):
+        if self.key is None:
+            self.key = Key(self._get_kind(), datastore._AllocateId())
+        datastore._entities[self.key._pair] = dict(
+            (name, value) for (name, value) in self.__dict__.iteritems()
+            if name != 'key' and not name.startswith('_'))
+        return _batcher().finished(self.key)
+    put_async = _put_async
+
+    def _put(self, **ctx_options):
+        return self._put_async(**ctx_options).get_result()
+    put = _put
+
+    @classmethod
+    def _get_by_id_async(cls, id, **ctx_options):
+        return Key(cls._get_kind(), id).get_async(**ctx_options)
+    get_by_id_async = _get_by_id_async
+
+    @classmethod
+    def _get_by_id(cls, id, **ctx_options):
+        return cls._get_by_id_async(id, **ctx_options).get_result()
+    get_by_id = _get_by_id
+
+    @classmethod
+    def _get_or_insert_async(cls, name, **kwds):
+        key = Key(cls._get_kind(), name)
+
+        @tasklets.tasklet
+        def txn():
+            ent = yield key.get_async()
+            if ent is None:
+                ent = cls(id=name, **kwds)
+                yield ent.put_async()
+            raise tasklets.Return(ent)
+
+        @tasklets.tasklet
+        def internal_tasklet():
+            if in_transaction():
+                ent = yield txn()
+            else:
+                ent = yield key.get_async()
+                if ent is None:
+                    ent = yield transaction_async(txn)
+            raise tasklets.Return(ent)
+
+        return internal_tasklet()
+    get_or_insert_async = _get_or_insert_async
+
+    @classmethod
+    def _get_or_insert(cls, name, **kwds):
+        return cls._get_or_insert_async(name, **kwds).get_result()
+    get_or_insert = _get_or_insert
+
+    @classmethod
+    def _query(cls, **q_options):
+        return Query(kind=cls._get_kind(), **q_options)
+    query = _query
+
+
+def get_multi_async(keys, **ctx_options):
+    return [key.get_async(**ctx_options) for key in keys]
+
+
+def get_multi(keys, **ctx_options):
+    return [future.get_result()
+            for future in get_multi_async(keys, **ctx_options)]
+
+
+def put_multi_async(entities, **ctx_options):
+    return [entity.put_async(**ctx_options) for entity in entities]
+
+
+def put_multi(entities, **ctx_options):
+    return [future.get_result()
+            for future in put_multi_async(entities, **ctx_options)]
+
+
+def delete_multi_async(keys, **ctx_options):
+    return [key.delete_async(**ctx_options) for key in keys]
+
+
+def delete_multi(keys, **ctx_options):
+    return [future.get_result()
+            for future in delete_multi_async(keys, **ctx_options)]
+
+
+def in_transaction():
+    return datastore.IsInTransaction()
+
+
+def transaction_async(callback, **ctx_options):
+    return context.get_context().transaction(callback, **ctx_options)
+
+
+def transaction(callback, **ctx_options):
+    return transaction_async(callback, **ctx_options).get_result()
+
+
+def transactional(func):
+    def transactional_wrapper(*args, **kwds):
+        return transaction(lambda: func(*args, **kwds))
+
+    return transactional_wrapper
+
+
+class Query(object):
+    def __init__(self, kind=None, keys_only=False):
+        self.kind = kind
+        self._keys_only = keys_only
+
+    def _matching_keys(self):
+        keys = [Key(kind, id) for (kind, id) in datastore._entities.keys()
+                if kind == self.kind]
+        keys.sort(key=Key.id)
+        return keys
+
+    def iter(self, **q_options):
+        return QueryIterator(self, **q_options)
+    __iter__ = iter
+
+    @tasklets.tasklet
+    def map_async(self, callback, pass_batch_into_callback=None,
+                  limit=None, offset=0, keys_only=None, **q_options):
+        # This stands in for the query rpc.
+        yield _batcher().finished(None)
+        keys_only = self._keys_only if keys_only is None else keys_only
+        keys = self._matching_keys()[offset:]
+        if limit is not None:
+            keys = keys[:limit]
+        results = []
+        for (i, key) in enumerate(keys):
+            result = key if keys_only else _load(key)
+            if callback is None:
+                results.append(result)
+            elif pass_batch_into_callback:
+                results.append(callback(None, i, result))
+            else:
+                results.append(callback(result))
+        raise tasklets.Return(results)
+
+    def map(self, callback, **q_options):
+        return self.map_async(callback, **q_options).get_result()
+
+    def fetch_async(self, limit=None, **q_options):
+        if limit is not None:
+            q_options['limit'] = limit
+        return self.map_async(None, **q_options)
+
+    def fetch(self, limit=None, **q_options):
+        return self.fetch_async(limit, **q_options).get_result()
+
+    @tasklets.tasklet
+    def get_async(self, **q_options):
+        results = yield self.fetch_async(1, **q_options)
+        raise tasklets.Return(results[0] if results else None)
+
+    def get(self, **q_options):
+        return self.get_async(**q_options).get_result()
+
+    @tasklets.tasklet
+    def fetch_page_async(self, page_size, start_cursor=None, **q_options):
+        """Like the real fetch_page, except cursors are just offsets."""
+        offset = start_cursor or 0
+        it = self.iter(limit=page_size + 1, offset=offset, **q_options)
+        results = []
+        more = False
+        while (yield it.has_next_async()):
+            if len(results) >= page_size:
+                more = True
+                break
+            results.append(it.next())
+        raise tasklets.Return((results, offset + len(results), more))
+
+    def fetch_page(self, page_size, **q_options):
+        return self.fetch_page_async(page_size, **q_options).get_result()
+
+    def count(self, limit=None, **q_options):
+        return len(self._matching_keys()[:limit])
+
+
+class QueryIterator(object):
+    def __init__(self, query, limit=None, offset=0, keys_only=None,
+                 **q_options):
+        self._keys_only = query._keys_only if keys_only is None else keys_only
+        self._keys = query._matching_keys()[offset:]
+        if limit is not None:
+            self._keys = self._keys[:limit]
+        self._index = 0
+
+    def __iter__(self):
+        return self
+
+    def has_next_async(self):
+        return _batcher().finished(self._index < len(self._keys))
+
+    def has_next(self):
+        return self.has_next_async().get_result()
+
+    def probably_has_next(self):
+        return self._index < len(self._keys)
+
+    def next(self):
+        if not self.has_next():
+            raise StopIteration()
+        key = self._keys[self._index]
+        self._index += 1
+        return key if self._keys_only else _load(key)
@@ -0,0 +1,268 @@
+"""Fake of ndb's event loop, futures and tasklets.
+
+As in the real ndb, futures only make progress while someone waits
+on one, and a tasklet runs until its first yield as soon as it's
+called.  Rpcs issued together (by Key.get_async(), say) all finish
+at once, the next time the event loop runs, which is how the real
+ndb batches them.
+"""
+
+import collections
+import functools
+import heapq
+import itertools
+import threading
+import time
+import types
+
+from google.appengine.api import apiproxy_stub_map
+
+
+__all__ = ['Future', 'MultiFuture', 'Return', 'tasklet', 'synctasklet',
+           'toplevel', 'sleep', 'get_event_loop']
+
+
+class _EventLoop(object):
+    def __init__(self):
+        self.current = collections.deque()     # (callback, args)
+        self.rpcs = []                         # callbacks
+        self.timers = []                       # heap of (when, seq, ...)
+        self._seq = itertools.count()
+
+    def queue_call(self, delay, callback, *args):
+        if delay is None:
+            self.current.append((callback, args))
+        else:
+            heapq.heappush(self.timers, (time.time() + delay, next(self._seq),
+                                         callback, args))
+
+    def queue_rpc(self, callback):
+        """Call callback when the rpcs issued so far finish."""
+        self.rpcs.append(callback)
+
+    def run0(self):
+        """Run one thing; return False if there was nothing to run."""
+        if self.current:
+            (callback, args) = self.current.popleft()
+            callback(*args)
+            return True
+        if self.rpcs:
+            (rpcs, self.rpcs) = (self.rpcs, [])
+            for callback in rpcs:
+                callback()
+            return True
+        if self.timers:
+            (when, _, callback, args) = heapq.heappop(self.timers)
+            delay = when - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            callback(*args)
+            return True
+        return False
+
+
+class _State(threading.local):
+    def __init__(self):
+        self.event_loop = _EventLoop()
+
+
+_state = _State()
+
+
+def get_event_loop():
+    return _state.event_loop
+
+
+class Future(object):
+    def __init__(self, info=None):
+        self._info = info
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def __repr__(self):
+        return '<Future %s%s>' % (self._info or '',
+                                  ' done' if self._done else '')
+
+    def done(self):
+        return self._done
+
+    def _finish(self):
+        self._done = True
+        for (callback, args) in self._callbacks:
+            get_event_loop().queue_call(None, callback, *args)
+        self._callbacks = None
+
+    def set_result(self, result):
+        assert not self._done, self
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        assert not self._done, self
+        self._exception = exception
+        self._finish()
+
+    def add_callback(self, callback, *args):
+        if self._done:
+            get_event_loop().queue_call(None, callback, *args)
+        else:
+            self._callbacks.append((callback, args))
+
+    def wait(self):
+        while not self._done:
+            if not get_event_loop().run0():
+                raise RuntimeError('Deadlock waiting for %s' % self)
+
+    def check_success(self):
+        self.wait()
+        if self._exception is not None:
+            raise self._exception
+
+    def get_result(self):
+        self.check_success()
+        return self._result
+
+    def get_exception(self):
+        self.wait()
+        return self._exception
+
+    @staticmethod
+    def wait_all(futures):
+        for future in futures:
+            future.wait()
+
+    @staticmethod
+    def wait_any(futures):
+        futures = list(futures)
+        while futures:
+            for future in futures:
+                if future.done():
+                    return future
+            if not get_event_loop().run0():
+                raise RuntimeError('Deadlock waiting for %s' % futures)
+        return None
+
+
+class MultiFuture(Future):
+    """A future for a list of futures, whose result is a list of results."""
+    def __init__(self, futures):
+        super(MultiFuture, self).__init__()
+        self._dependents = list(futures)
+        self._num_left = len(self._dependents)
+        if not self._dependents:
+            self.set_result([])
+        for future in self._dependents:
+            future.add_callback(self._dependent_done)
+
+    def _dependent_done(self):
+        self._num_left -= 1
+        if self._num_left == 0:
+            try:
+                self.set_result([future.get_result()
+                                 for future in self._dependents])
+            except Exception as e:
+                self.set_exception(e)
+
+
+class Return(StopIteration):
+    """Raise this from a tasklet to return a value."""
+    pass
+
+
+def _return_value(stop_iteration):
+    if not stop_iteration.args:
+        return None
+    if len(stop_iteration.args) == 1:
+        return stop_iteration.args[0]
+    return stop_iteration.args
+
+
+def _help_tasklet_along(future, gen, value=None, exception=None):
+    try:
+        if exception is not None:
+            yielded = gen.throw(exception)
+        else:
+            yielded = gen.send(value)
+    except StopIteration as e:
+        future.set_result(_return_value(e))
+        return
+    except Exception as e:
+        future.set_exception(e)
+        return
+
+    if isinstance(yielded, apiproxy_stub_map.UserRPC):
+        # Our UserRPCs are always done.
+        try:
+            value = yielded.get_result()
+        except Exception as e:
+            _help_tasklet_along(future, gen, exception=e)
+        else:
+            _help_tasklet_along(future, gen, value)
+        return
+    if isinstance(yielded, (list, tuple)):
+        yielded = MultiFuture(yielded)
+    if not isinstance(yielded, Future):
+        _help_tasklet_along(
+            future, gen,
+            exception=RuntimeError('A tasklet yielded %r' % (yielded,)))
+        return
+    yielded.add_callback(_on_future_completion, future, gen, yielded)
+
+
+def _on_future_completion(future, gen, yielded):
+    try:
+        value = yielded.get_result()
+    except Exception as e:
+        _help_tasklet_along(future, gen, exception=e)
+    else:
+        _help_tasklet_along(future, gen, value)
+
+
+def tasklet(func):
+    @functools.wraps(func)
+    def tasklet_wrapper(*args, **kwds):
+        future = Future(func.__name__)
+        try:
+            result = func(*args, **kwds)
+        except StopIteration as e:
+            result = _return_value(e)
+        if isinstance(result, types.GeneratorType):
+            _help_tasklet_along(future, result)
+        else:
+            future.set_result(result)
+        return future
+
+    return tasklet_wrapper
+
+
+def synctasklet(func):
+    taskletfunc = tasklet(func)
+
+    @functools.wraps(func)
+    def synctasklet_wrapper(*args, **kwds):
+        return taskletfunc(*args, **kwds).get_result()
+
+    return synctasklet_wrapper
+
+
+def toplevel(func):
+    """Like synctasklet, but then run everything func left running."""
+    synctaskletfunc = synctasklet(func)
+
+    @functools.wraps(func)
+    def toplevel_wrapper(*args, **kwds):
+        try:
+            return synctaskletfunc(*args, **kwds)
+        finally:
+            while get_event_loop().run0():
+                pass
+
+    return toplevel_wrapper
+
+
+def sleep(dt):
+    future = Future('sleep(%s)' % dt)
+    get_event_loop().queue_call(dt, future.set_result, None)
+    return future
@@ -0,0 +1,102 @@
+#!/usr/bin/env python2
+
+"""A script to summarize the most contended locks from lock_util metrics.
+
+lock_util can report, once per request, how often each class of lock
+was acquired, how long we waited for it, and how long we held it.  If
+you use lock_util.log_lock_metrics to report these, each request log
+will have a line that looks like
+   lock_util metrics: {"global_lock_write_lock_kaid_": {...}}
+
+This script reads logs containing such lines (from files named on the
+commandline, or from stdin), adds up the metrics across all requests,
+and prints the lock classes with the most total time spent waiting.
+
+We don't import lock_util since it depends on appengine, and you
+probably want to run this on your own machine.
+"""
+
+import json
+
+
+# This must match lock_util.LOCK_METRICS_LOG_PREFIX.
+_LOG_PREFIX = 'lock_util metrics: '
+
+# This must match lock_util.LOCK_METRICS_HISTOGRAM_BUCKETS.
+_HISTOGRAM_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+_COUNTERS = ('acquisitions', 'reacquisitions', 'timeouts', 'memcache_errors',
+             'wait_seconds', 'hold_seconds')
+
+
+def _combine(all_metrics, metrics):
+    """Add the metrics from one request into all_metrics."""
+    for (prefix, stats) in metrics.iteritems():
+        totals = all_metrics.setdefault(prefix, {})
+        for counter in _COUNTERS:
+            totals[counter] = totals.get(counter, 0) + stats.get(counter, 0)
+        for histogram in ('wait_histogram', 'hold_histogram'):
+            old = totals.get(histogram, [0] * len(stats[histogram]))
+            totals[histogram] = [a + b for (a, b) in zip(old,
+                                                          stats[histogram])]
+
+
+def _percentile(histogram, fraction):
+    """Return the upper bound of the bucket holding the given percentile."""
+    total = sum(histogram)
+    if not total:
+        return 0
+    seen = 0
+    for (i, count) in enumerate(histogram):
+        seen += count
+        if seen >= total * fraction:
+            if i < len(_HISTOGRAM_BUCKETS):
+                return _HISTOGRAM_BUCKETS[i]
+            return float('inf')
+    return float('inf')
+
+
+def read_metrics(lines):
+    all_metrics = {}
+    for line in lines:
+        pos = line.find(_LOG_PREFIX)
+        if pos == -1:
+            continue
+        try:
+            metrics = json.loads(line[pos + len(_LOG_PREFIX):])
+        except ValueError:      # probably a truncated log line
+            continue
+        _combine(all_metrics, metrics)
+    return all_metrics
+
+
+def main(lines, top):
+    all_metrics = read_metrics(lines)
+    by_contention = sorted(all_metrics.iteritems(),
+                           key=lambda (_, totals): (totals['wait_seconds'],
+                                                    totals['timeouts']),
+                           reverse=True)
+
+    print ('%-40s %8s %8s %8s %8s %9s %9s %9s'
+           % ('lock class', 'acquires', 'timeouts', 'errors', 'reentry',
+              'wait p50', 'wait p99', 'hold p99'))
+    for (prefix, totals) in by_contention[:top]:
+        print ('%-40s %8d %8d %8d %8d %8gs %8gs %8gs'
+               % (prefix, totals['acquisitions'], totals['timeouts'],
+                  totals['memcache_errors'], totals['reacquisitions'],
+                  _percentile(totals['wait_histogram'], 0.5),
+                  _percentile(totals['wait_histogram'], 0.99),
+                  _percentile(totals['hold_histogram'], 0.99)))
+
+
+if __name__ == '__main__':
+    import argparse
+    import fileinput
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--top", type=int, default=20,
+                        help="How many lock classes to show.")
+    parser.add_argument("logfiles", nargs="*",
+                        help="Log files to read (default: stdin).")
+    args = parser.parse_args()
+
+    main(fileinput.input(args.logfiles), args.top)
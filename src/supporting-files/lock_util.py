@@ -33,6 +33,32 @@ the lock multiple times, but a single release releases all of them.
 (This is for historical reasons.)  It is best to treat this API as
 non-reentrant.
 
+Within an instance, only one thread at a time competes for a given
+global lock; other threads wanting it wait locally, and get it handed
+to them directly when it's released.
+
+By default, processes waiting on a contended lock race for it, so an
+unlucky waiter can starve.  Pass `queued=True` to have waiters get the
+lock in the order they asked for it instead.  That costs more memcache
+operations per acquisition, though; see acquire_global_lock().
+
+If an instance dies while holding a lock, waiters normally have to
+wait for the lease to run out.  Call `set_instance_heartbeat_ttl()` at
+startup to have instances advertise that they're alive, and waiters
+break locks held by instances that aren't.
+
+To let up to N requests at a time in, rather than just one, use
+
+   with lock_util.global_semaphore(key, permits=N):
+       ...
+
+and to let requests in at most N times a second, use
+`take_rate_limit_token(key, rate=N)`.
+
+Global locks live in memcache by default, but you can store them
+elsewhere -- for instance, in a redis server, or in-process for tests
+-- by calling `set_lock_backend()` at startup with a `LockBackend`.
+
 HIGH-LEVEL API
 --------------
 
@@ -85,20 +111,47 @@ you would any other middleware:
 
     app = webapp2.WSGIApplication([...routes...])
     app = lock_util.LockUtilMiddleware(app)
+
+The middleware is also what reports lock metrics, if you ask for them
+via `set_lock_metrics_sink()`.  To find your most contended locks, use
+`log_lock_metrics` as the sink, and run lock_metrics_report.py over
+your request logs.  To find potential deadlocks between user locks,
+and locks held for too long, see `set_lock_order_analysis()` and
+`lock_order_report()`.
 """
 
-import UserDict
+import bisect
+import collections
 import contextlib
+import json
 import logging
 import os
 import random
+import re
+import sys
 import threading
 import time
 import traceback
 
-from google.appengine.api import memcache
-from google.appengine.ext import db
-from google.appengine.ext import ndb
+# Without appengine, you can still use lock_util with a non-memcache
+# lock backend; see set_lock_backend().
+try:
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.api import memcache
+    from google.appengine.ext import db
+    from google.appengine.ext import ndb
+except ImportError:
+    apiproxy_stub_map = memcache = db = ndb = None
+# Needed only for fetch_under_user_write_lock() and friends.
+try:
+    import db_hooks
+except ImportError:
+    db_hooks = None
+# Needed only for RedisLockBackend.
+try:
+    import redis
+except ImportError:
+    redis = None
 
 
 # Used when INSTANCE_ID is None (probably just for tests).
@@ -136,16 +189,100 @@ _DEFAULT_WAIT_TIMEOUT_FOR_INTERACTIVE = 10
 # timeout is 10 minutes instead of 60 seconds.
 _DEFAULT_WAIT_TIMEOUT_FOR_BATCH = _DEFAULT_HOLD_TIMEOUT_FOR_BATCH
 
+# How long appengine lets a request run before killing it.  No matter
+# what the wait-timeout is, we don't wait for a lock past the point
+# where the request couldn't finish once it got the lock: that just
+# wastes the work the request has done so far.  We leave the request
+# at least _REQUEST_DEADLINE_SAFETY_MARGIN seconds to use the lock.
+_REQUEST_TIMEOUT_FOR_INTERACTIVE = 60
+_REQUEST_TIMEOUT_FOR_BATCH = 600
+_REQUEST_DEADLINE_SAFETY_MARGIN = 5
 
-class LockAcquireFailure(Exception):
-    pass
+# When acquiring a lock in "queued" mode (see acquire_global_lock()),
+# this is how often a waiter polls memcache to see if it's its turn.
+# It's much shorter than the 1 second we wait between add() attempts
+# in the normal mode, since in a queue every waiter pays the handoff
+# latency of every waiter ahead of it.
+_QUEUED_LOCK_POLL_INTERVAL = 0.25
+
+# In queued mode, if the lock is free but the queue hasn't moved for
+# this many polls, we assume the waiter at the head of the queue has
+# given up (or died) and skip over it.
+_QUEUED_LOCK_STALL_POLLS = 4
 
+# While waiting for a lock, this is how often (in seconds) we check
+# whether the instance holding it is still alive.  This only matters
+# if you've called set_instance_heartbeat_ttl().
+_LIVENESS_CHECK_INTERVAL = 2
 
-# A per-request cache.  Each thread has a separate copy.
-class ThreadLocalDict(UserDict.UserDict, threading.local):
+
+# resolve_rpc_at_end_of_request() holds on to at most this many rpcs.
+# Past that, we resolve the oldest ones as we go, so long batch
+# requests don't pile up thousands of them.
+_MAX_PENDING_RPCS = 100
+
+
+class LockAcquireFailure(Exception):
     pass
 
-_request_cache = ThreadLocalDict()
+
+class _HeldUserLock(object):
+    """A user write lock this request holds; see _user_locks_held()."""
+    __slots__ = ('nonce', 'count')
+
+    def __init__(self, nonce):
+        self.nonce = nonce
+        self.count = 1
+
+
+class _RequestContext(object):
+    """Everything lock_util keeps track of for the current request."""
+    __slots__ = ('rpc_queue', 'rpc_write_keys', 'global_locks_held',
+                 'user_locks_held', 'semaphore_permits_held', 'deadline',
+                 'lock_metrics', 'lock_acquire_times', 'user_lock_order')
+
+    def __init__(self):
+        # RPCs to resolve at the end of the request, oldest first; see
+        # resolve_rpc_at_end_of_request().
+        self.rpc_queue = collections.deque()
+        # See resolve_write_at_end_of_request().
+        self.rpc_write_keys = set()
+        # Map from global-lock key to when our lease on it runs out;
+        # see _global_locks_held_by_request().
+        self.global_locks_held = {}
+        # See _user_locks_held_by_request().
+        self.user_locks_held = {}
+        # Map from semaphore key to the permit keys we hold for it; see
+        # acquire_global_semaphore().
+        self.semaphore_permits_held = {}
+        # See set_request_deadline().
+        self.deadline = None
+        # Map from key-prefix to stats; see set_lock_metrics_sink().
+        self.lock_metrics = {}
+        # Map from global-lock key to when we acquired it, for metrics.
+        self.lock_acquire_times = {}
+        # If we're analyzing this request's lock order, the user locks
+        # it holds, in the order it acquired them; see "Lock-order
+        # analysis".  Otherwise, None.  _reset_request_context()
+        # decides which requests to analyze.
+        self.user_lock_order = None
+
+
+# Each thread has its own request context, since each thread handles
+# its own request.  LockUtilMiddleware gives every request a fresh one.
+class _RequestLocal(threading.local):
+    def __init__(self):
+        self.context = _RequestContext()
+
+_request_local = _RequestLocal()
+
+
+def _reset_request_context():
+    context = _RequestContext()
+    if (_lock_order_sample_rate and
+            random.random() < _lock_order_sample_rate):
+        context.user_lock_order = []
+    _request_local.context = context
 
 
 # --------------- Memcache utilities
@@ -229,6 +366,25 @@ def memcache_util_add_multi_async_with_deadline(
                                              namespace=namespace, rpc=rpc)
 
 
+def memcache_util_offset_multi_async_with_deadline(
+        mapping, key_prefix='', namespace=None, initial_value=None,
+        deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+    """Like offset_multi_async(), but fails if it takes longer than deadline.
+
+    Asynchronously increments (or decrements) multiple keys' values at
+    once.  Deadline is in seconds and is defaulted to a reasonable
+    value unless set explicitly.
+
+    See memcache.Client().offset_multi_async documentation for details.
+    """
+    rpc = memcache.create_rpc(deadline=deadline)
+    return memcache.Client().offset_multi_async(mapping,
+                                                key_prefix=key_prefix,
+                                                namespace=namespace,
+                                                initial_value=initial_value,
+                                                rpc=rpc)
+
+
 def memcache_util_delete_with_deadline(
         key, seconds=0, namespace=None,
         deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
@@ -258,20 +414,856 @@ def resolve_rpc_at_end_of_request(rpc):
     that can take all request long, but you want to make sure finishes
     before this request does, you can add it to this queue, where it
     will be resolved in middleware.
+
+    We only keep _MAX_PENDING_RPCS rpcs around; if there are more, we
+    resolve the oldest one now.
     """
-    queue = _request_cache.get('rpc_async_queue', [])
+    queue = _request_local.context.rpc_queue
     queue.append(rpc)
-    _request_cache['rpc_async_queue'] = queue
+    if len(queue) > _MAX_PENDING_RPCS:
+        # The oldest rpc has most likely finished by now, so this
+        # probably doesn't actually wait.
+        queue.popleft().get_result()
+
+
+def resolve_write_at_end_of_request(key, issue_write):
+    """Like resolve_rpc_at_end_of_request(), for idempotent writes.
+
+    issue_write is a function that starts a write to key and returns
+    its rpc.  If we've already issued a write to key this way during
+    this request, we assume it was the same write and don't issue it
+    again.
+    """
+    context = _request_local.context
+    if key in context.rpc_write_keys:
+        return
+    context.rpc_write_keys.add(key)
+    resolve_rpc_at_end_of_request(issue_write())
 
 
 def resolve_all_rpcs():
-    queue = _request_cache.get('rpc_async_queue', [])
-    for rpc in queue:
+    queue = _request_local.context.rpc_queue
+    if apiproxy_stub_map:
+        # Wait for all the rpcs at once, rather than one at a time.
+        user_rpcs = []
+        for rpc in queue:
+            while isinstance(rpc, _TranslatedRpc):
+                rpc = rpc.rpc
+            if isinstance(rpc, apiproxy_stub_map.UserRPC):
+                user_rpcs.append(rpc)
+        apiproxy_stub_map.UserRPC.wait_all(user_rpcs)
+    while queue:
+        queue.popleft().get_result()
+
+
+# --------------- Lock backends
+# Global locks are just keys in some shared storage that supports an
+# atomic add().  By default that storage is memcache, but you can
+# use any LockBackend via set_lock_backend().
+
+
+class _FinishedRpc(object):
+    """An rpc-like object for backends whose operations are synchronous."""
+    def __init__(self, result):
+        self.result = result
+
+    def get_result(self):
+        return self.result
+
+
+class _TranslatedRpc(object):
+    """An rpc-like object that post-processes another rpc's result."""
+    def __init__(self, rpc, translate):
+        self.rpc = rpc
+        self.translate = translate
+
+    def get_result(self):
+        return self.translate(self.rpc.get_result())
+
+
+class LockBackend(object):
+    """The interface for storage that global locks can live in.
+
+    The API is modeled after memcache's: all the primitive operations
+    work on multiple keys, and are asynchronous, returning an object
+    with a get_result() method, like an appengine rpc.  Values are
+    strings, except for counters (see offset_multi_async), which are
+    ints.  `time` is the number of seconds until a key expires, with 0
+    meaning never.  `deadline` is how long to wait for the storage to
+    respond, in seconds; backends that cannot time out may ignore it.
+
+    Backends should never raise on errors talking to the storage;
+    instead they return None (or, for get_multi_async, {}), so that
+    lock_util can "fail permissive."
+    """
+    # Statuses for add/set/cas.
+    STORED = 'stored'
+    NOT_STORED = 'not-stored'   # for add: key exists; for cas: it doesn't
+    EXISTS = 'exists'           # for cas: the value isn't what we expected
+    ERROR = 'error'
+
+    # Statuses for delete.
+    DELETED = 'deleted'
+    DELETE_ITEM_MISSING = 'delete-item-missing'
+    DELETE_NETWORK_FAILURE = 'delete-network-failure'
+
+    def get_multi_async(self, keys, deadline=DEFAULT_MEMCACHE_GET_DEADLINE):
+        """Result is a dict from key to value, omitting missing keys."""
+        raise NotImplementedError()
+
+    def set_multi_async(self, mapping, time=0,
+                        deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        """Result is a dict from key to status, or None on error."""
+        raise NotImplementedError()
+
+    def add_multi_async(self, mapping, time=0,
+                        deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        """Like set, but only sets keys that do not already exist."""
+        raise NotImplementedError()
+
+    def cas_multi_async(self, mapping, time=0,
+                        deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        """Compare-and-set: mapping is from key to (old_value, new_value).
+
+        Each key is set to new_value only if its current value is
+        old_value.  Result is a dict from key to status, or None on
+        error.
+        """
+        raise NotImplementedError()
+
+    def delete_multi_async(self, keys, deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        """Result is a list of delete-statuses, in order, or None on error."""
+        raise NotImplementedError()
+
+    def offset_multi_async(self, mapping, initial_value=None,
+                           deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        """Atomically add mapping[key] to the counter at each key.
+
+        A missing counter starts at initial_value, or is left missing
+        if initial_value is None.  Result is a dict from key to the new
+        value (None if the key is missing), or None on error.
+        """
+        raise NotImplementedError()
+
+    # The rest are synchronous, single-key conveniences.
+
+    def get(self, key, deadline=DEFAULT_MEMCACHE_GET_DEADLINE):
+        return self.get_multi_async([key], deadline=deadline).get_result(
+            ).get(key)
+
+    def add(self, key, value, time=0, deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        """Return the status of the add, or None on error."""
+        retval = self.add_multi_async({key: value}, time=time,
+                                      deadline=deadline).get_result()
+        return retval.get(key) if retval else None
+
+    def cas(self, key, old_value, new_value, time=0,
+            deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        """Return the status of the cas, or None on error."""
+        retval = self.cas_multi_async({key: (old_value, new_value)},
+                                      time=time,
+                                      deadline=deadline).get_result()
+        return retval.get(key) if retval else None
+
+    def delete(self, key, deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        """Return the status of the delete."""
+        retval = self.delete_multi_async([key], deadline=deadline).get_result()
+        return retval[0] if retval else self.DELETE_NETWORK_FAILURE
+
+    def incr(self, key, delta=1, initial_value=None,
+             deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        """Return the new value of the counter, or None."""
+        retval = self.offset_multi_async({key: delta},
+                                         initial_value=initial_value,
+                                         deadline=deadline).get_result()
+        return retval.get(key) if retval else None
+
+
+class MemcacheLockBackend(LockBackend):
+    """Keep locks in appengine memcache.  This is the default."""
+    def _translate_statuses(self, retval):
+        if retval is None:
+            return None
+        statuses = {memcache.STORED: self.STORED,
+                    memcache.NOT_STORED: self.NOT_STORED,
+                    memcache.EXISTS: self.EXISTS,
+                    memcache.ERROR: self.ERROR}
+        return dict((k, statuses.get(v, self.ERROR))
+                    for (k, v) in retval.iteritems())
+
+    def get_multi_async(self, keys, deadline=DEFAULT_MEMCACHE_GET_DEADLINE):
+        return memcache_util_get_multi_async_with_deadline(keys,
+                                                           deadline=deadline)
+
+    def set_multi_async(self, mapping, time=0,
+                        deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        return _TranslatedRpc(
+            memcache_util_set_multi_async_with_deadline(mapping, time=time,
+                                                        deadline=deadline),
+            self._translate_statuses)
+
+    def add_multi_async(self, mapping, time=0,
+                        deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        return _TranslatedRpc(
+            memcache_util_add_multi_async_with_deadline(mapping, time=time,
+                                                        deadline=deadline),
+            self._translate_statuses)
+
+    def cas_multi_async(self, mapping, time=0,
+                        deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        # memcache's cas() works on cas-ids rather than values, and
+        # the cas-ids live in the Client object, so we need to do the
+        # gets() with the same client.  Only the cas itself is async.
+        client = memcache.Client()
+        current = client.get_multi_async(
+            mapping.keys(), for_cas=True,
+            rpc=memcache.create_rpc(deadline=DEFAULT_MEMCACHE_GET_DEADLINE)
+        ).get_result()
+        if current is None:
+            return _FinishedRpc(None)
+        retval = {}
+        to_cas = {}
+        for (key, (old_value, new_value)) in mapping.iteritems():
+            if key not in current:
+                retval[key] = self.NOT_STORED
+            elif current[key] != old_value:
+                retval[key] = self.EXISTS
+            else:
+                to_cas[key] = new_value
+        if not to_cas:
+            return _FinishedRpc(retval)
+
+        def translate(cas_retval):
+            cas_retval = self._translate_statuses(cas_retval)
+            if cas_retval is None:
+                return None
+            cas_retval.update(retval)
+            return cas_retval
+
+        rpc = client.cas_multi_async(
+            to_cas, time=time, rpc=memcache.create_rpc(deadline=deadline))
+        return _TranslatedRpc(rpc, translate)
+
+    def delete_multi_async(self, keys, deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        statuses = {memcache.DELETE_SUCCESSFUL: self.DELETED,
+                    memcache.DELETE_ITEM_MISSING: self.DELETE_ITEM_MISSING,
+                    memcache.DELETE_NETWORK_FAILURE:
+                        self.DELETE_NETWORK_FAILURE}
+        rpc = memcache.Client().delete_multi_async(
+            keys, rpc=memcache.create_rpc(deadline=deadline))
+        return _TranslatedRpc(
+            rpc,
+            lambda retval: (None if retval is None else
+                            [statuses.get(s, self.DELETE_NETWORK_FAILURE)
+                             for s in retval]))
+
+    def offset_multi_async(self, mapping, initial_value=None,
+                           deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        return memcache_util_offset_multi_async_with_deadline(
+            mapping, initial_value=initial_value, deadline=deadline)
+
+
+class InProcessLockBackend(LockBackend):
+    """Keep locks in a dict in this process.
+
+    This is useful for tests, and for apps that only ever run on a
+    single instance.  It is thread-safe.
+    """
+    def __init__(self):
+        self._data = {}      # key -> (value, expiration time or None)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _now():
+        # Our methods' `time` argument hides the time module.
+        return time.time()
+
+    def _get(self, key, now):
+        """Return the value of key, or None.  Must hold self._lock."""
+        (value, expires) = self._data.get(key, (None, None))
+        if expires is not None and expires <= now:
+            del self._data[key]
+            return None
+        return value
+
+    def _set(self, key, value, time, now):
+        """Must hold self._lock."""
+        self._data[key] = (value, now + time if time else None)
+
+    def get_multi_async(self, keys, deadline=DEFAULT_MEMCACHE_GET_DEADLINE):
+        now = self._now()
+        retval = {}
+        with self._lock:
+            for key in keys:
+                value = self._get(key, now)
+                if value is not None:
+                    retval[key] = value
+        return _FinishedRpc(retval)
+
+    def set_multi_async(self, mapping, time=0,
+                        deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        now = self._now()
+        with self._lock:
+            for (key, value) in mapping.iteritems():
+                self._set(key, value, time, now)
+        return _FinishedRpc(dict.fromkeys(mapping, self.STORED))
+
+    def add_multi_async(self, mapping, time=0,
+                        deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        now = self._now()
+        retval = {}
+        with self._lock:
+            for (key, value) in mapping.iteritems():
+                if self._get(key, now) is None:
+                    self._set(key, value, time, now)
+                    retval[key] = self.STORED
+                else:
+                    retval[key] = self.NOT_STORED
+        return _FinishedRpc(retval)
+
+    def cas_multi_async(self, mapping, time=0,
+                        deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        now = self._now()
+        retval = {}
+        with self._lock:
+            for (key, (old_value, new_value)) in mapping.iteritems():
+                current = self._get(key, now)
+                if current is None:
+                    retval[key] = self.NOT_STORED
+                elif current != old_value:
+                    retval[key] = self.EXISTS
+                else:
+                    self._set(key, new_value, time, now)
+                    retval[key] = self.STORED
+        return _FinishedRpc(retval)
+
+    def delete_multi_async(self, keys, deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        now = self._now()
+        retval = []
+        with self._lock:
+            for key in keys:
+                if self._get(key, now) is None:
+                    retval.append(self.DELETE_ITEM_MISSING)
+                else:
+                    del self._data[key]
+                    retval.append(self.DELETED)
+        return _FinishedRpc(retval)
+
+    def offset_multi_async(self, mapping, initial_value=None,
+                           deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        now = self._now()
+        retval = {}
+        with self._lock:
+            for (key, delta) in mapping.iteritems():
+                current = self._get(key, now)
+                if current is None:
+                    current = initial_value
+                if current is None:
+                    retval[key] = None
+                    continue
+                # Like memcache, counters never go below 0.
+                new_value = max(int(current) + delta, 0)
+                expires = self._data.get(key, (None, None))[1]
+                self._data[key] = (new_value, expires)
+                retval[key] = new_value
+        return _FinishedRpc(retval)
+
+
+class RedisLockBackend(LockBackend):
+    """Keep locks in a redis server (or anything that speaks its protocol).
+
+    This requires the `redis` python package.  Pass in a
+    redis.StrictRedis client, or the host and port to make one for.
+
+    Redis has no types, so get() returns any all-digit string as an int,
+    to match what memcache does for counters.
+    """
+    # Compare-and-set by value: returns 1 if set, 0 if the value didn't
+    # match, -1 if the key doesn't exist.
+    _CAS_SCRIPT = """
+        local current = redis.call('GET', KEYS[1])
+        if not current then return -1 end
+        if current ~= ARGV[1] then return 0 end
+        if ARGV[3] == '0' then
+            redis.call('SET', KEYS[1], ARGV[2])
+        else
+            redis.call('SET', KEYS[1], ARGV[2], 'PX', ARGV[3])
+        end
+        return 1
+    """
+
+    # memcache-style incr: returns the new value, or nil if the key
+    # doesn't exist and there's no initial value.  Never goes below 0.
+    _OFFSET_SCRIPT = """
+        local current = redis.call('GET', KEYS[1])
+        if not current then
+            if ARGV[2] == '' then return nil end
+            current = ARGV[2]
+        end
+        local new_value = math.max(tonumber(current) + tonumber(ARGV[1]), 0)
+        redis.call('SET', KEYS[1], new_value, 'KEEPTTL')
+        return new_value
+    """
+
+    def __init__(self, client=None, host='localhost', port=6379):
+        if redis is None:
+            raise ImportError("RedisLockBackend needs the redis package")
+        if client is None:
+            client = redis.StrictRedis(
+                host=host, port=port,
+                socket_timeout=DEFAULT_MEMCACHE_SET_DEADLINE)
+        self.client = client
+        self._cas = client.register_script(self._CAS_SCRIPT)
+        self._offset = client.register_script(self._OFFSET_SCRIPT)
+
+    def _run(self, fn):
+        """Run fn(); return _FinishedRpc of its result, or of None on error."""
+        try:
+            return _FinishedRpc(fn())
+        except redis.RedisError as e:
+            logging.warning("Redis error in lock backend: %s" % e)
+            return _FinishedRpc(None)
+
+    @staticmethod
+    def _ms(time):
+        return int(time * 1000) if time else None
+
+    def get_multi_async(self, keys, deadline=DEFAULT_MEMCACHE_GET_DEADLINE):
+        def get_multi():
+            retval = {}
+            for (key, value) in zip(keys, self.client.mget(keys)):
+                if value is not None:
+                    retval[key] = int(value) if value.isdigit() else value
+            return retval
+        rpc = self._run(get_multi)
+        if rpc.result is None:
+            rpc.result = {}
+        return rpc
+
+    def set_multi_async(self, mapping, time=0,
+                        deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        def set_multi():
+            pipe = self.client.pipeline()
+            for (key, value) in mapping.iteritems():
+                pipe.set(key, value, px=self._ms(time))
+            pipe.execute()
+            return dict.fromkeys(mapping, self.STORED)
+        return self._run(set_multi)
+
+    def add_multi_async(self, mapping, time=0,
+                        deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        def add_multi():
+            pipe = self.client.pipeline()
+            keys = mapping.keys()
+            for key in keys:
+                pipe.set(key, mapping[key], px=self._ms(time), nx=True)
+            return dict((key, self.STORED if stored else self.NOT_STORED)
+                        for (key, stored) in zip(keys, pipe.execute()))
+        return self._run(add_multi)
+
+    def cas_multi_async(self, mapping, time=0,
+                        deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        statuses = {1: self.STORED, 0: self.EXISTS, -1: self.NOT_STORED}
+
+        def cas_multi():
+            retval = {}
+            for (key, (old_value, new_value)) in mapping.iteritems():
+                result = self._cas(keys=[key],
+                                   args=[old_value, new_value,
+                                         self._ms(time) or 0])
+                retval[key] = statuses[result]
+            return retval
+        return self._run(cas_multi)
+
+    def delete_multi_async(self, keys, deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        def delete_multi():
+            pipe = self.client.pipeline()
+            for key in keys:
+                pipe.delete(key)
+            return [self.DELETED if deleted else self.DELETE_ITEM_MISSING
+                    for deleted in pipe.execute()]
+        return self._run(delete_multi)
+
+    def offset_multi_async(self, mapping, initial_value=None,
+                           deadline=DEFAULT_MEMCACHE_SET_DEADLINE):
+        def offset_multi():
+            initial = '' if initial_value is None else initial_value
+            return dict((key, self._offset(keys=[key], args=[delta, initial]))
+                        for (key, delta) in mapping.iteritems())
+        return self._run(offset_multi)
+
+
+if memcache is not None:
+    _lock_backend = MemcacheLockBackend()
+else:
+    _lock_backend = InProcessLockBackend()
+
+
+def set_lock_backend(backend):
+    """Use the given LockBackend for all global locks from now on.
+
+    Do this at startup: locks acquired in one backend can't be
+    released in another.
+    """
+    global _lock_backend
+    _lock_backend = backend
+
+
+# --------------- Lock metrics
+# To find out which locks are hot, register a sink with
+# set_lock_metrics_sink().  We aggregate lock activity over the course
+# of a request, and LockUtilMiddleware hands the aggregate to the sink
+# at the end of the request.  When no sink is registered, we don't
+# record anything.
+
+# The upper bounds, in seconds, of the buckets in the wait-time and
+# hold-time histograms.  There is one more bucket at the end, for
+# everything bigger than the last bound.
+LOCK_METRICS_HISTOGRAM_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+# The prefix of the log line written by log_lock_metrics().
+# lock_metrics_report.py looks for this, so keep them in sync!
+LOCK_METRICS_LOG_PREFIX = 'lock_util metrics: '
+
+_lock_metrics_sink = None
+
+
+def set_lock_metrics_sink(sink):
+    """Register a function to be given each request's lock metrics.
+
+    LockUtilMiddleware calls the sink at the end of every request that
+    used a global lock (including via a user write lock).  Its only
+    argument is a dict from key-prefix (see _lock_key_prefix) to a dict
+    of stats:
+        acquisitions: the number of times we acquired the lock
+        reacquisitions: the number of (semi-)re-entrant acquisitions
+        timeouts: the number of times we raised LockAcquireFailure
+        memcache_errors: the number of times memcache failed so we
+           pretended we acquired the lock
+        wait_seconds, hold_seconds: the total wait-time and hold-time
+        wait_histogram, hold_histogram: how many wait-times and
+           hold-times fell into each of LOCK_METRICS_HISTOGRAM_BUCKETS
+
+    log_lock_metrics is a sink that writes to the request log.  Pass
+    in None to stop collecting lock metrics.
+    """
+    global _lock_metrics_sink
+    _lock_metrics_sink = sink
+
+
+def log_lock_metrics(metrics):
+    """A lock-metrics sink that logs the metrics as a line of json."""
+    logging.info(LOCK_METRICS_LOG_PREFIX + json.dumps(metrics, sort_keys=True))
+
+
+def _lock_key_prefix(key):
+    """Map a lock key to the class of locks it belongs to.
+
+    We assume the key ends with an id, and strip it off: for instance,
+    global_lock_write_lock_kaid_1234 becomes global_lock_write_lock_kaid_.
+    """
+    return re.sub(r'[^_.:]+$', '', key) or key
+
+
+def _lock_metrics_for(key):
+    """Return the (mutable) stats dict for this key's prefix."""
+    metrics = _request_local.context.lock_metrics
+    prefix = _lock_key_prefix(key)
+    stats = metrics.get(prefix)
+    if stats is None:
+        num_buckets = len(LOCK_METRICS_HISTOGRAM_BUCKETS) + 1
+        stats = {
+            'acquisitions': 0,
+            'reacquisitions': 0,
+            'timeouts': 0,
+            'memcache_errors': 0,
+            'wait_seconds': 0.0,
+            'hold_seconds': 0.0,
+            'wait_histogram': [0] * num_buckets,
+            'hold_histogram': [0] * num_buckets,
+        }
+        metrics[prefix] = stats
+    return stats
+
+
+def _record_lock_acquisition(key, status, wait_seconds):
+    """Record an acquire_global_lock() call, given its status."""
+    if _lock_metrics_sink is None:
+        return
+    stats = _lock_metrics_for(key)
+    if status == _REACQUIRED:
+        stats['reacquisitions'] += 1
+        return
+
+    if status == _TIMED_OUT:
+        stats['timeouts'] += 1
+    else:
+        stats['acquisitions'] += 1
+        if status == _FAILED_PERMISSIVE:
+            stats['memcache_errors'] += 1
+        _request_local.context.lock_acquire_times[key] = time.time()
+
+    stats['wait_seconds'] += wait_seconds
+    bucket = bisect.bisect_left(LOCK_METRICS_HISTOGRAM_BUCKETS, wait_seconds)
+    stats['wait_histogram'][bucket] += 1
+
+
+def _record_lock_release(key):
+    """Record a release_global_lock() call."""
+    if _lock_metrics_sink is None:
+        return
+    acquire_time = _request_local.context.lock_acquire_times.pop(key, None)
+    if acquire_time is None:    # the sink was registered while we held it
+        return
+    hold_seconds = time.time() - acquire_time
+    stats = _lock_metrics_for(key)
+    stats['hold_seconds'] += hold_seconds
+    bucket = bisect.bisect_left(LOCK_METRICS_HISTOGRAM_BUCKETS, hold_seconds)
+    stats['hold_histogram'][bucket] += 1
+
+
+def flush_lock_metrics():
+    """Give this request's lock metrics to the sink, and reset them."""
+    context = _request_local.context
+    metrics = context.lock_metrics
+    context.lock_metrics = {}
+    context.lock_acquire_times = {}
+    if metrics and _lock_metrics_sink is not None:
+        try:
+            _lock_metrics_sink(metrics)
+        except Exception as e:
+            # Metrics are never worth failing a request over.
+            logging.error("Error in the lock metrics sink: %s" % e)
+
+
+# --------------- Instance liveness
+# An instance can die -- say, OOM-killed by appengine -- while holding
+# a global lock, and then everyone waiting for that lock has to wait
+# for the lease to run out.  To avoid that, each instance can keep a
+# heartbeat key in memcache, with a short expiry, which it refreshes
+# whenever it uses lock_util.  A waiter that sees that the holder's
+# instance has no heartbeat breaks the lock and takes it over.
+#
+# A request can hold a lock for a long time without calling into
+# lock_util, so while an instance holds any global locks, a background
+# thread also refreshes its heartbeat every third of a TTL.  That
+# thread exits once the instance's locks are released (or their leases
+# run out), so idle instances don't keep writing to memcache.
+#
+# This is off by default, since an instance so wedged that even that
+# thread can't run for a full TTL will look dead, and lose its locks.
+# See set_instance_heartbeat_ttl().
+
+_instance_heartbeat_ttl = None
+_last_instance_heartbeat = 0
+
+# Map from global-lock key to when its lease runs out, for every global
+# lock this instance holds while the heartbeat is on.  Protected by
+# _heartbeat_mutex, as is _heartbeat_thread: the thread refreshing our
+# heartbeat while we hold locks, or None if there isn't one.
+_heartbeat_leases = {}
+_heartbeat_mutex = threading.Lock()
+_heartbeat_thread = None
+
+
+def set_instance_heartbeat_ttl(ttl):
+    """Turn on breaking locks held by dead instances.
+
+    Each instance will keep a heartbeat that expires after ttl
+    seconds, and waiters will take over a lock whose holder's instance
+    has no heartbeat.  While the instance holds global locks, a
+    background thread refreshes the heartbeat every ttl/3 seconds, so
+    the ttl needs to be long enough only to ride out memcache hiccups
+    and stalls of the whole instance.  Pass in None to turn this off
+    again.
+    """
+    global _instance_heartbeat_ttl, _last_instance_heartbeat
+    _instance_heartbeat_ttl = ttl
+    _last_instance_heartbeat = 0
+
+
+def _this_instance_id():
+    return os.environ.get('INSTANCE_ID') or _INSTANCE_ID
+
+
+def _instance_heartbeat_key(instance_id):
+    return 'lock_util_instance_heartbeat_%s' % instance_id
+
+
+def _refresh_instance_heartbeat():
+    """Say this instance is alive, if we haven't said so recently."""
+    global _last_instance_heartbeat
+    if _instance_heartbeat_ttl is None:
+        return
+    now = time.time()
+    # We refresh at a third of the ttl so a slow or failed set doesn't
+    # make us look dead.
+    if now - _last_instance_heartbeat < _instance_heartbeat_ttl / 3.0:
+        return
+    _last_instance_heartbeat = now
+    rpc = _lock_backend.set_multi_async(
+        {_instance_heartbeat_key(_this_instance_id()): 1},
+        time=_instance_heartbeat_ttl)
+    resolve_rpc_at_end_of_request(rpc)
+
+
+def _note_lock_lease(key, lock_timeout):
+    """Keep our heartbeat going until key's lease runs out.
+
+    Call this whenever this instance acquires a global lock.
+    """
+    if _instance_heartbeat_ttl is None:
+        return
+    with _heartbeat_mutex:
+        _heartbeat_leases[key] = time.time() + lock_timeout
+        _ensure_heartbeat_thread()
+
+
+def _forget_lock_lease(key):
+    """Call this whenever this instance releases a global lock."""
+    if _heartbeat_leases:
+        with _heartbeat_mutex:
+            _heartbeat_leases.pop(key, None)
+
+
+def _ensure_heartbeat_thread():
+    """Start the heartbeat thread, if it isn't running.
+
+    Must hold _heartbeat_mutex.
+    """
+    global _heartbeat_thread
+    # The thread clears _heartbeat_thread when it decides to exit, but
+    # appengine can also kill it when the request that started it ends.
+    if _heartbeat_thread is None or not _heartbeat_thread.is_alive():
+        _heartbeat_thread = threading.Thread(
+            target=_wait_through,
+            args=(_heartbeat_steps(_this_instance_id()),),
+            name='lock_util instance heartbeat')
+        _heartbeat_thread.daemon = True
+        _heartbeat_thread.start()
+
+
+def _heartbeat_steps(instance_id):
+    """Steps that refresh our heartbeat while we hold global locks.
+
+    The heartbeat thread runs these with _wait_through().  We take the
+    instance id as an argument since the thread doesn't run in a
+    request, and so has no environment to find it in.
+    """
+    global _heartbeat_thread, _last_instance_heartbeat
+    while True:
+        ttl = _instance_heartbeat_ttl
+        if ttl is not None:
+            yield ttl / 3.0
+        with _heartbeat_mutex:
+            if _instance_heartbeat_ttl is None:
+                # Someone turned liveness tracking off.
+                _heartbeat_leases.clear()
+            now = time.time()
+            for (key, expires) in _heartbeat_leases.items():
+                if expires <= now:
+                    del _heartbeat_leases[key]
+            if not _heartbeat_leases:
+                # Anyone who takes a lock from now on starts a new thread.
+                _heartbeat_thread = None
+                return
+            ttl = _instance_heartbeat_ttl
+        rpc = _lock_backend.set_multi_async(
+            {_instance_heartbeat_key(instance_id): 1}, time=ttl)
         rpc.get_result()
+        _last_instance_heartbeat = time.time()
+
+
+def _holder_instance_is_dead(holder):
+    """Given a lock's value, say if the instance that holds it is dead."""
+    m = re.search(r'\(instance (.*)\)$', holder)
+    if not m:
+        return False
+    heartbeat = _lock_backend.get(_instance_heartbeat_key(m.group(1)))
+    return heartbeat is None
+
+
+def _take_lock_from_dead_holder(key, value, lock_timeout):
+    """If key's lock is held by a dead instance, take it over.
+
+    We use a cas() so that if the lock changes hands while we're
+    looking at it -- or someone else breaks it first -- we don't break
+    the new holder's lock.
+
+    Returns the dead holder's lock-value if we took over its lock, or
+    None if we didn't.
+    """
+    if _instance_heartbeat_ttl is None:
+        return None
+    holder = _lock_backend.get(key)
+    if not holder or not _holder_instance_is_dead(holder):
+        return None
+    status = _lock_backend.cas(key, holder, value, time=lock_timeout)
+    if status != LockBackend.STORED:
+        return None
+    logging.warning('Broke the %s lock held by %s, whose instance is dead'
+                    % (key, holder))
+    return holder
 
 
 # --------------- Global lock code
 
+def _global_locks_held_by_request():
+    """Return a map from the global-lock keys this request holds to
+    when our lease on each runs out.
+
+    Modifying the map modifies it in the request context.  This lets
+    us notice a request re-acquiring a lock it already holds without a
+    round trip to memcache; see _request_holds_global_lock().
+    """
+    return _request_local.context.global_locks_held
+
+
+def _request_holds_global_lock(key):
+    """Return True if this request holds key's lock, and its lease is live.
+
+    Once the lease runs out, memcache may have given the lock to
+    someone else, so we forget we had it and make the caller ask the
+    backend again.
+    """
+    locks_held = _global_locks_held_by_request()
+    lease_end = locks_held.get(key)
+    if lease_end is None:
+        return False
+    if time.time() < lease_end:
+        return True
+    logging.warning('Lease on the %s lock expired while this request held it'
+                    % key)
+    del locks_held[key]
+    return False
+
+
+def _default_wait_timeout():
+    if os.environ.get('HTTP_X_APPENGINE_QUEUENAME'):
+        return _DEFAULT_WAIT_TIMEOUT_FOR_BATCH
+    else:
+        return _DEFAULT_WAIT_TIMEOUT_FOR_INTERACTIVE
+
+
+def set_request_deadline(deadline):
+    """Say when this request must finish, as a time.time() value.
+
+    Lock acquisition will not wait past this deadline (minus a safety
+    margin), raising LockAcquireFailure instead, though it still takes
+    a lock that's free when it asks.  LockUtilMiddleware
+    sets this for you, based on when the request started; you only
+    need to call it if you know better (or if you are not using the
+    middleware).  None means there is no deadline.
+    """
+    _request_local.context.deadline = deadline
+
+
+# The possible outcomes of trying to acquire a global lock.
+_ACQUIRED = 'acquired'
+_REACQUIRED = 'reacquired'    # we already held it: see "semi-reentrant"
+_FAILED_PERMISSIVE = 'failed-permissive'    # memcache failed; see below
+_TIMED_OUT = 'timed-out'
+
 def _global_lock_key(key):
     assert isinstance(key, basestring), (
         "Key '%s' must be a string, not a %s" % (key, type(key)))
@@ -279,62 +1271,217 @@ def _global_lock_key(key):
 
 
 def _global_lock_value_for_this_request():
+    """Return our value for a lock key.
+
+    _holder_instance_is_dead() parses this, so keep them in sync!
+    """
     request_id = os.environ.get('REQUEST_LOG_ID')
     instance_id = os.environ.get('INSTANCE_ID')
     if not request_id or not instance_id:
         logging.error('Missing request id "%s" and/or instance id "%s"',
                       request_id, instance_id)
         request_id = request_id or _REQUEST_ID
-        instance_id = instance_id or _INSTANCE_ID
-    return '%s (instance %s)' % (request_id, instance_id)
+    return '%s (instance %s)' % (request_id, _this_instance_id())
 
 
-def acquire_global_lock(key, lock_timeout=None, wait_timeout=None):
-    """Acquire a 'global' lock (across all instances) for the given key.
+def _lock_queue_keys(key, priority_class):
+    """Return the (tickets-issued, tickets-served) keys for a lock queue."""
+    return ('%s.queue.%s.issued' % (key, priority_class),
+            '%s.queue.%s.served' % (key, priority_class))
 
-    This is technically a 'lease' rather than a 'lock' because it can
-    time out.  The timeout should be the maximum length of a request,
-    which is 60 seconds for normal requests and 10 minutes for
-    taskqueue requests.  (10 minutes is really long, so make this
-    shorter if you can.)
 
-    This lock is 'global', meaning that if you acquire this lock no
-    other instance can acquire this lock.  (Neither can other requests
-    in this instance.)  It is semi-reentrant, meaning that if the same
-    request tries to acquire a lock it already has, this succeeds, but
-    a single release call will still release the lock.  That is, we
-    don't "nest" locks, instead subsequent locks by the same request
-    are just ignored.
+# Our lock-acquisition code is written as generators that yield how
+# long they want to sleep, rather than sleeping themselves.  That way
+# the same code can wait by blocking the thread (for
+# acquire_global_lock) or by letting other ndb tasklets run (for
+# acquire_global_lock_async).  Helpers that need to return a status
+# yield it as their last step.
 
-    TODO(csilvers): make it totally non-reentrant.
+def _wait_through(steps):
+    """Run lock-acquisition steps, sleeping whenever they ask us to."""
+    for delay in steps:
+        time.sleep(delay)
 
-    Ideally we'd implement this using a lockservice such as ZooKeeper
-    or Chubby.  But in the world we live in, we use the atomic
-    operations in memcache.
 
-    Arguments:
-        key: the key to the lock
-        lock_timeout: how long to hold onto the lock (actually a lease)
-           once it's acquired, in seconds.  None means to use a reasonable
-           default.  There is no way to acquire a global lock for forever.
-        wait_timeout: how long to wait to acquire the lock before aborting
-           this request, in seconds.
+def _wait_through_async(steps):
+    """Run lock-acquisition steps in an ndb tasklet, and return its future.
+
+    Instead of sleeping, we wait on ndb.sleep() futures, so other
+    tasklets -- and their RPCs -- keep making progress while we wait
+    for a lock.
     """
-    key = _global_lock_key(key)
-    value = _global_lock_value_for_this_request()
+    @ndb.tasklet
+    def run_steps():
+        for delay in steps:
+            yield ndb.sleep(delay)
+
+    return run_steps()
+
+
+def _acquire_global_lock_queued(key, value, lock_timeout, wait_timeout,
+                                is_interactive):
+    """The queued version of acquire_global_lock(); see its docstring.
+
+    `key` is the memcache key for the lock, not the user-supplied key.
+
+    Each waiter takes a ticket, via an atomic memcache incr, from the
+    queue for its priority class (interactive or batch).  Each queue
+    also has a "served" counter, which is the last ticket that was
+    granted the lock.  A waiter only tries to add() the lock when all
+    the tickets ahead of it have been served, and, if it's a batch
+    waiter, when there are no interactive waiters at all.  So waiters
+    get the lock in ticket order, with interactive requests jumping
+    ahead of batch ones.
+
+    If a waiter dies or gives up while at the head of the queue, the
+    queue would get stuck.  So if we see the lock is free but nobody
+    is taking it, we eventually skip the stalled ticket.  The waiter
+    closest to the head does the skipping, to keep us from skipping
+    more than one ticket at a time.  (A skipped waiter that's still
+    alive can still get the lock: "served" means "it's your turn, or
+    it was.")
+
+    If memcache loses our queue state (eviction, errors, etc), we
+    degrade to the non-queued behavior of racing for the add().
+
+    Like all our lock-acquisition steps, this yields how long it wants
+    to sleep between polls; see _wait_through().  Its last step is
+    _ACQUIRED, _REACQUIRED, or _FAILED_PERMISSIVE instead.
+    """
+    my_class = 'interactive' if is_interactive else 'batch'
+    (issued_key, served_key) = _lock_queue_keys(key, my_class)
+    (i_issued_key, i_served_key) = _lock_queue_keys(key, 'interactive')
+
+    def fetch_state():
+        return _lock_backend.get_multi_async(
+            [key, served_key, i_issued_key, i_served_key]).get_result()
+
+    def advance(queue_served_key):
+        # We don't need to wait for this: whoever is next in line will
+        # see it the next time they poll.
+        rpc = _lock_backend.offset_multi_async({queue_served_key: 1})
+        resolve_rpc_at_end_of_request(rpc)
 
-    if lock_timeout is None:
-        # TODO(csilvers): distinguish interactive from batch request
-        lock_timeout = _DEFAULT_HOLD_TIMEOUT_FOR_INTERACTIVE
+    start = time.time()
+    state = fetch_state()
 
-    is_interactive = not os.environ.get('HTTP_X_APPENGINE_QUEUENAME')
+    # acquire_global_lock() has already checked whether we hold this
+    # lock, but since we have the holder anyway, we double-check here:
+    # if we took a ticket for a lock we hold, nobody would serve it.
+    if state.get(key) == value:
+        yield _REACQUIRED
+        return
 
-    if wait_timeout is None:
+    # Take a ticket.  We also create the served-counter if it doesn't
+    # exist yet; incrementing it by 0 is otherwise a no-op that just
+    # tells us its current value.
+    retval = _lock_backend.offset_multi_async(
+        {issued_key: 1, served_key: 0}, initial_value=0).get_result()
+    ticket = retval.get(issued_key) if retval else None
+    if ticket is None:
+        logging.error('Unable to get a ticket for the (global) memcache '
+                      'lock queue on key %s; racing for the lock instead'
+                      % key)
+        ticket = 0     # which puts us at the head of the queue
+    else:
+        state[served_key] = retval.get(served_key)
+
+    other_id = '[nobody?]'
+    last_progress = None
+    stalled_polls = 0
+    next_liveness_check = start + _LIVENESS_CHECK_INTERVAL
+    while True:
+        now = time.time()
+        _refresh_instance_heartbeat()
+        served = state.get(served_key)
         if is_interactive:
-            wait_timeout = _DEFAULT_WAIT_TIMEOUT_FOR_INTERACTIVE
+            interactive_waiters = 0
+        else:
+            interactive_waiters = max((state.get(i_issued_key) or 0) -
+                                      (state.get(i_served_key) or 0),
+                                      0)
+
+        if served is None:
+            # We lost the queue state, so everyone is at the head.
+            position = 1
+        else:
+            position = ticket - served + interactive_waiters
+        my_turn = bool(ticket) and served is not None and ticket == served + 1
+
+        if position <= 1:
+            add_status = _lock_backend.add(key, value, time=lock_timeout)
+            if add_status == LockBackend.STORED:
+                if my_turn:
+                    advance(served_key)
+                logging.debug("Waited %.2f seconds for the %s lock on %s "
+                              "(ticket %s, held by %s)"
+                              % (now - start, key, value, ticket, other_id))
+                yield _ACQUIRED
+                return
+            elif not add_status or add_status == LockBackend.ERROR:
+                # We 'fail permissive' here, just like in the non-queued
+                # case.
+                logging.error('Memcache error or timeout acquiring (global) '
+                              'memcache lock on key %s (ticket %s)'
+                              % (key, ticket))
+                if my_turn:
+                    advance(served_key)
+                yield _FAILED_PERMISSIVE
+                return
+            other_id = state.get(key) or other_id
+
+            if now >= next_liveness_check:
+                next_liveness_check = now + _LIVENESS_CHECK_INTERVAL
+                if _take_lock_from_dead_holder(key, value, lock_timeout):
+                    if my_turn:
+                        advance(served_key)
+                    yield _ACQUIRED
+                    return
+
+        # Detect a stalled queue: the lock is free, but nobody's been
+        # served since the last time we looked.
+        progress = (served, state.get(i_served_key))
+        if key in state or progress != last_progress:
+            stalled_polls = 0
         else:
-            wait_timeout = _DEFAULT_WAIT_TIMEOUT_FOR_BATCH
+            stalled_polls += 1
+        last_progress = progress
+        if (position > 1 and
+                stalled_polls >= _QUEUED_LOCK_STALL_POLLS + position):
+            stalled_key = i_served_key if interactive_waiters else served_key
+            logging.info('Skipping a stalled waiter in the %s queue for the '
+                         '%s lock (we have ticket %s)'
+                         % (stalled_key, key, ticket))
+            advance(stalled_key)
+            stalled_polls = 0
+
+        if now - start >= wait_timeout:
+            # Don't make everyone behind us wait for us to be skipped.
+            if my_turn:
+                advance(served_key)
+            raise LockAcquireFailure("Timeout after %d seconds waiting for "
+                                     "the %s lock for %s (ticket %s, held "
+                                     "by %s)"
+                                     % (wait_timeout, key, value, ticket,
+                                        other_id))
+
+        to_wait = _QUEUED_LOCK_POLL_INTERVAL - (time.time() - now)
+        if to_wait > 0:
+            yield to_wait
+        state = fetch_state()
 
+
+def _acquire_global_lock_racing(key, value, lock_timeout, wait_timeout,
+                                is_interactive):
+    """The default version of acquire_global_lock(); see its docstring.
+
+    `key` is the memcache key for the lock, not the user-supplied key.
+    Waiters for a contended lock all race to add() it.
+
+    Like all our lock-acquisition steps, this yields how long it wants
+    to sleep between tries; see _wait_through().  Its last step is
+    _ACQUIRED or _FAILED_PERMISSIVE instead.
+    """
     # This section makes locking more 'fair'.  Basically, if you're a
     # batch job trying to acquire this lock, you have to give way for
     # any interactive requests that are currently running.  So if we
@@ -346,80 +1493,89 @@ def acquire_global_lock(key, lock_timeout=None, wait_timeout=None):
     if is_interactive:
         # We say the interactive process is "active" for 5 minutes
         # after the last interactive request.  We resolve this async()
-        # late since we don't care when the set completes.
-
-        rpc = memcache_util_set_multi_async_with_deadline(
-            {key + '.interactive': 1}, time=300)
-        resolve_rpc_at_end_of_request(rpc)
+        # late since we don't care when the set completes.  (And
+        # once per request is plenty.)
+        resolve_write_at_end_of_request(
+            key + '.interactive',
+            lambda: _lock_backend.set_multi_async({key + '.interactive': 1},
+                                                  time=300))
     else:
         # We use a fairly big deadline since we don't want to start
         # hogging the lock whenever memcache gets slow.
-        if memcache_util_get_with_deadline(key + '.interactive',
-                                           deadline=0.2):
+        if _lock_backend.get(key + '.interactive', deadline=0.2):
             # Sleep for 1.05 second.  Since the code below waits at
             # most a second between lock tries, this will guarantee
             # that any interactive task waiting for the lock will have
             # a chance to acquire it.
-            time.sleep(1.05)
+            yield 1.05
             logging.info('Batch job %s waiting a sec for concurrent '
                          'interactive jobs that also want the lock' % key)
 
-    # add() is atomic.  We use the multi-async version because it's
-    # the only one whose return value distinguishes failure and error.
-    # For timeout and error, we retry a few times.
+    # add() is atomic.  Its return value distinguishes failure and
+    # error.  For timeout and error, we retry a few times.
     for _ in xrange(2):
-        retval = memcache_util_add_multi_async_with_deadline(
-            {key: value}, time=lock_timeout).get_result()
-        # retval is None on error, or a {key: <status>} dict.
-        add_status = retval.values()[0] if retval else None
-        if add_status and add_status != memcache.ERROR:
+        # add_status is None on timeout or network error.
+        add_status = _lock_backend.add(key, value, time=lock_timeout)
+        if add_status and add_status != LockBackend.ERROR:
             break
 
-    if add_status == memcache.STORED:
+    if add_status == LockBackend.STORED:
         # Common case: no concurrent insert is going on.
+        yield _ACQUIRED
         return
 
-    if not add_status or add_status == memcache.ERROR:
+    if not add_status or add_status == LockBackend.ERROR:
         # means a memcache error: HTTP error, timeout, etc.  We 'fail
         # permissive' and pretend the lock was acquired.
-        if add_status == memcache.ERROR:
+        if add_status == LockBackend.ERROR:
             msg = ('Memcache error acquiring (global) memcache lock on key %s'
                    % (key))
         else:
             msg = ('Timeout or HTTP error acquiring (global) memcache lock on '
                    'key %s' % (key))
         logging.error(msg)
+        yield _FAILED_PERMISSIVE
         return
 
     # https://github.com/memcached/memcached/blob/master/doc/protocol.txt#L194
     # sez that EXISTS is only used for cas(), so we should see NOT_STORED.
     # But who knows what google actually implements?  We treat them the same.
-    assert add_status in (memcache.NOT_STORED, memcache.EXISTS), (
+    assert add_status in (LockBackend.NOT_STORED, LockBackend.EXISTS), (
         'unknown status %s' % add_status)
 
-    # Check if it's just us just re-acquiring a lock we already have.
-    other_id = memcache_util_get_with_deadline(key) or '[nobody?]'
-    if other_id == value:
-        return
+    # Someone else has the lock.  (We know it's not us re-acquiring a
+    # lock we already have: acquire_global_lock() checks for that.)
+    # We just have to busy-wait for them to finish.  We look up who
+    # has it only for logging, so we do that in parallel with our
+    # first wait rather than as an extra round trip.
+    holder_rpc = _lock_backend.get_multi_async([key])
+
+    def other_id():
+        return holder_rpc.get_result().get(key) or '[nobody?]'
 
-    # Someone else has the lock.  We just have to busy-wait for them
-    # to finish.
-    # TODO(csilvers): it's possible that the lock is held by a process
-    # that was killed by appengine (due to OOM).  In that case we
-    # should treat this lock as released.  We could do that by keeping
-    # an up-to-date list of active instance-id's in memcache, and
-    # checking that list here (and comparing it to other_id).
+    # It's possible that the lock is held by a process that was killed
+    # by appengine (due to OOM).  If we're tracking instance liveness,
+    # we notice that and take the lock over; see "Instance liveness".
     for i in xrange(wait_timeout):
         now = time.time()
-        retval = memcache_util_add_multi_async_with_deadline(
-            {key: value}, time=lock_timeout).get_result()
-        add_status = retval.values()[0] if retval else None
-        if add_status == memcache.STORED:
+        _refresh_instance_heartbeat()
+        if i and i % _LIVENESS_CHECK_INTERVAL == 0:
+            dead_holder = _take_lock_from_dead_holder(key, value,
+                                                      lock_timeout)
+            if dead_holder:
+                logging.debug("Waited %d seconds for the %s lock on %s "
+                              "(held by dead %s)"
+                              % (i, key, value, dead_holder))
+                yield _ACQUIRED
+                return
+        add_status = _lock_backend.add(key, value, time=lock_timeout)
+        if add_status == LockBackend.STORED:
             logging.debug("Waited %d seconds for the %s lock on %s "
                           "(held by %s)"
-                          % (i, key, value, other_id))
+                          % (i, key, value, other_id()))
+            yield _ACQUIRED
             return
-        elif not add_status or add_status == memcache.ERROR:
+        elif not add_status or add_status == LockBackend.ERROR:
             # We 'fail permissive' here as well, and pretend that the
             # lock was acquired even though memcache errored.
             # TODO(sean): optimistic permissiveness will sometimes
@@ -431,30 +1587,343 @@ def acquire_global_lock(key, lock_timeout=None, wait_timeout=None):
             #    when we receive errors. When we (hopefully) eventually
             #    *do* get a STORED/NOT_STORED answer from memcache, we
             #    can check if we're the ones that hold the lock.
-            if add_status == memcache.ERROR:
+            if add_status == LockBackend.ERROR:
                 logging.debug("Memcache error acquiring (global) memcache "
                               "lock after waiting %d seconds for the %s lock "
-                              "on %s (held by %s)" % (i, key, value, other_id))
+                              "on %s (held by %s)"
+                              % (i, key, value, other_id()))
             else:
                 logging.debug("Memcache timeout/network error acquiring "
                               "(global) memcache lock after waiting %d "
                               "seconds for the %s lock on %s (held by %s)" %
-                              (i, key, value, other_id))
+                              (i, key, value, other_id()))
+            yield _FAILED_PERMISSIVE
             return
 
         to_wait = 1 - (time.time() - now)
         if to_wait > 0:
-            time.sleep(to_wait)
+            yield to_wait
 
     raise LockAcquireFailure("Timeout after %d seconds waiting for the %s "
                              "lock for %s (held by %s)"
-                             % (wait_timeout, key, value, other_id))
+                             % (wait_timeout, key, value, other_id()))
+
+
+# --------------- Local lock arbitration
+# Threads in the same instance that want the same global lock don't
+# all need to poll memcache for it.  Instead, only one thread per
+# instance competes for the global lock, and the others wait on a
+# condition variable.  When the holder releases the lock and there's
+# a local waiter, we hand the lock to that waiter directly, without
+# ever releasing it in memcache.  (Tasklets can't block on a condition
+# variable, so acquire_global_lock_async() polls instead, and doesn't
+# get handoffs.)
+
+# To keep an instance with lots of local contention from hogging a
+# lock forever, after this many local handoffs in a row we release the
+# lock in memcache and let everyone compete for it again.
+_MAX_LOCAL_HANDOFFS = 10
+
+# How often acquire_global_lock_async() checks whether another thread
+# in this instance has released a lock.
+_LOCAL_LOCK_POLL_INTERVAL = 0.05
+
+# All the local-lock bookkeeping is protected by this one mutex.  The
+# critical sections are tiny, so there's no need for anything finer.
+_local_locks_mutex = threading.Lock()
+
+# Map from global-lock key to a _LocalLock, for every lock that some
+# thread in this instance holds or is waiting for.
+_local_locks = {}
+
+
+class _LocalLock(object):
+    def __init__(self):
+        self.condition = threading.Condition(_local_locks_mutex)
+        # The lock-value (see _global_lock_value_for_this_request) of
+        # the request that holds, or is acquiring, the global lock.
+        self.owner = None
+        # When the owner's lease runs out.  A request can exit without
+        # releasing a global lock, so we can't wait for it forever.
+        self.owner_expires = None
+        # How many threads are waiting on self.condition.
+        self.waiters = 0
+        # When the previous owner handed the lock off without
+        # releasing it, its lock-value (which is what's in memcache).
+        self.handoff_value = None
+        # How many handoffs in a row this lock has had.
+        self.handoffs = 0
+
+
+def _acquire_local_lock(key, value, lock_timeout, wait_timeout):
+    """Become the one thread in this instance that may hold key's lock.
+
+    Returns the lock-value of the previous owner if it handed the
+    global lock off to us, meaning we already hold it in memcache (but
+    under the wrong name).  Returns None if we need to acquire the
+    global lock ourselves.
+
+    Raises LockAcquireFailure if we wait more than wait_timeout seconds.
+    """
+    deadline = time.time() + wait_timeout
+    with _local_locks_mutex:
+        local_lock = _local_locks.get(key)
+        if local_lock is None:
+            local_lock = _local_locks[key] = _LocalLock()
+
+        while local_lock.owner is not None:
+            now = time.time()
+            if now >= local_lock.owner_expires:
+                logging.warning('Lease on the %s lock expired while %s held '
+                                'it' % (key, local_lock.owner))
+                local_lock.owner = None
+                local_lock.handoff_value = None
+                continue
+            if now >= deadline:
+                break
+            # Note that every waiter re-checks the owner after waking
+            # up, even if it timed out, so a handed-off lock is never
+            # left with nobody to take it.
+            local_lock.waiters += 1
+            local_lock.condition.wait(
+                min(deadline, local_lock.owner_expires) - now)
+            local_lock.waiters -= 1
+        else:
+            local_lock.owner = value
+            local_lock.owner_expires = time.time() + lock_timeout
+            handoff_value = local_lock.handoff_value
+            local_lock.handoff_value = None
+            return handoff_value
+
+    raise LockAcquireFailure("Timeout after %d seconds waiting for the %s "
+                             "lock for %s (held in this instance by %s)"
+                             % (wait_timeout, key, value, local_lock.owner))
+
+
+def _hand_off_local_lock(key, value):
+    """Hand our global lock to a local waiter, if there is one.
+
+    Returns True if we handed it off, in which case the caller should
+    *not* release the lock in memcache.
+    """
+    with _local_locks_mutex:
+        local_lock = _local_locks.get(key)
+        if (local_lock is None or local_lock.owner != value or
+                not local_lock.waiters or
+                local_lock.handoffs >= _MAX_LOCAL_HANDOFFS):
+            return False
+        local_lock.owner = None
+        local_lock.handoff_value = value
+        local_lock.handoffs += 1
+        local_lock.condition.notify()
+        return True
+
+
+def _release_local_lock(key, value):
+    """Stop being the thread in this instance that may hold key's lock.
+
+    Call this after releasing the global lock (or failing to acquire it).
+    """
+    with _local_locks_mutex:
+        local_lock = _local_locks.get(key)
+        if local_lock is None or local_lock.owner != value:
+            return     # probably a release of a lock we don't hold
+        local_lock.owner = None
+        local_lock.handoffs = 0
+        if local_lock.waiters:
+            local_lock.condition.notify()
+        else:
+            del _local_locks[key]
+
+
+def _take_over_handed_off_lock(key, old_value, new_value, lock_timeout):
+    """Rename a lock that was handed off to us, and renew its lease.
+
+    We do this asynchronously, since we already have the lock.
+    """
+    def check_status(status):
+        if not status or status[key] != LockBackend.STORED:
+            logging.error('Lost the %s lock while taking it over from %s '
+                          '(status %s)' % (key, old_value, status))
+        return status
+
+    rpc = _lock_backend.cas_multi_async({key: (old_value, new_value)},
+                                        time=lock_timeout)
+    resolve_rpc_at_end_of_request(_TranslatedRpc(rpc, check_status))
+
+
+def acquire_global_lock(key, lock_timeout=None, wait_timeout=None,
+                        queued=False):
+    """Acquire a 'global' lock (across all instances) for the given key.
+
+    This is technically a 'lease' rather than a 'lock' because it can
+    time out.  The timeout should be the maximum length of a request,
+    which is 60 seconds for normal requests and 10 minutes for
+    taskqueue requests.  (10 minutes is really long, so make this
+    shorter if you can.)
+
+    This lock is 'global', meaning that if you acquire this lock no
+    other instance can acquire this lock.  (Neither can other requests
+    in this instance.)  It is semi-reentrant, meaning that if the same
+    request tries to acquire a lock it already has, this succeeds, but
+    a single release call will still release the lock.  That is, we
+    don't "nest" locks, instead subsequent locks by the same request
+    are just ignored.
+
+    TODO(csilvers): make it totally non-reentrant.
+
+    Ideally we'd implement this using a lockservice such as ZooKeeper
+    or Chubby.  But in the world we live in, we use the atomic
+    operations in memcache (or whatever LockBackend you've set).
+
+    Arguments:
+        key: the key to the lock
+        lock_timeout: how long to hold onto the lock (actually a lease)
+           once it's acquired, in seconds.  None means to use a reasonable
+           default.  There is no way to acquire a global lock for forever.
+        wait_timeout: how long to wait to acquire the lock before aborting
+           this request, in seconds.  We never wait past the request's
+           deadline, though; see set_request_deadline().
+        queued: if True, waiters for a contended lock get it in
+           first-come first-served order (with interactive requests
+           going before batch requests), rather than racing for it.
+           This avoids starving unlucky waiters, but it costs more
+           memcache operations per acquisition, and more the longer
+           the queue: in benchmark_supporting_files.py's simulation,
+           about 21 per acquisition (vs. about 8 racing) with 10
+           waiters, and about 156 (vs. about 34) with 100.  Nor does
+           it shorten the typical wait, only the worst one.
+    """
+    _wait_through(_acquire_global_lock_steps(key, lock_timeout, wait_timeout,
+                                             queued, wait_locally=True))
+
+
+def acquire_global_lock_async(key, lock_timeout=None, wait_timeout=None,
+                              queued=False):
+    """Like acquire_global_lock(), but returns an ndb future.
+
+    While this waits for a contended lock, other ndb tasklets in this
+    request keep running.  The future's result is None; if we time out
+    waiting for the lock, get_result() raises LockAcquireFailure.
+    Release the lock with release_global_lock(), as usual.
+
+    Note that locks are held by requests, not tasklets: two tasklets in
+    the same request don't exclude each other.
+    """
+    return _wait_through_async(_acquire_global_lock_steps(
+        key, lock_timeout, wait_timeout, queued, wait_locally=False))
+
+
+def _out_of_time_failure(kind, key, value):
+    return LockAcquireFailure("The %s %s is taken, and %s doesn't have "
+                              "enough time left in the request to wait for it"
+                              % (key, kind, value))
+
+
+def _acquire_global_lock_steps(key, lock_timeout, wait_timeout, queued,
+                               wait_locally):
+    """The guts of acquire_global_lock(), as steps for _wait_through().
+
+    If wait_locally is True, we block on other threads in this instance
+    that hold the lock.  Otherwise we poll for them, so we can run
+    under _wait_through_async().
+    """
+    key = _global_lock_key(key)
+    value = _global_lock_value_for_this_request()
+
+    if lock_timeout is None:
+        # TODO(csilvers): distinguish interactive from batch request
+        lock_timeout = _DEFAULT_HOLD_TIMEOUT_FOR_INTERACTIVE
+
+    is_interactive = not os.environ.get('HTTP_X_APPENGINE_QUEUENAME')
+
+    if wait_timeout is None:
+        wait_timeout = _default_wait_timeout()
+
+    start = time.time()
+    _refresh_instance_heartbeat()
+    if _request_holds_global_lock(key):
+        # We're just re-acquiring a lock we already have.  We know
+        # that without asking memcache.
+        _record_lock_acquisition(key, _REACQUIRED, 0)
+        return
+
+    # With no time left in the request we can't wait, but we still
+    # take the lock if it's free.
+    out_of_time = False
+    request_deadline = _request_local.context.deadline
+    if request_deadline is not None:
+        budget = request_deadline - start - _REQUEST_DEADLINE_SAFETY_MARGIN
+        if budget <= 0:
+            out_of_time = True
+            # A single try doesn't need a place in the queue.
+            queued = False
+        wait_timeout = max(min(wait_timeout, budget), 0)
+
+    while True:
+        try:
+            handoff_value = _acquire_local_lock(
+                key, value, lock_timeout,
+                wait_timeout if wait_locally else 0)
+            break
+        except LockAcquireFailure:
+            if wait_locally or time.time() - start >= wait_timeout:
+                _record_lock_acquisition(key, _TIMED_OUT,
+                                         time.time() - start)
+                if out_of_time:
+                    raise _out_of_time_failure('lock', key, value)
+                raise
+        yield _LOCAL_LOCK_POLL_INTERVAL
+        if _request_holds_global_lock(key):
+            # Another tasklet in this request got the lock while we
+            # were waiting for it.
+            _record_lock_acquisition(key, _REACQUIRED, time.time() - start)
+            return
+
+    if handoff_value is not None:
+        _take_over_handed_off_lock(key, handoff_value, value, lock_timeout)
+        status = _ACQUIRED
+    else:
+        wait_timeout = max(int(wait_timeout - (time.time() - start)), 0)
+        if queued:
+            # The queue handles interactive-vs-batch priority itself.
+            steps = _acquire_global_lock_queued(
+                key, value, lock_timeout, wait_timeout, is_interactive)
+        else:
+            steps = _acquire_global_lock_racing(
+                key, value, lock_timeout, wait_timeout, is_interactive)
+        try:
+            for step in steps:
+                if isinstance(step, basestring):
+                    status = step
+                else:
+                    yield step
+        except LockAcquireFailure:
+            _release_local_lock(key, value)
+            _record_lock_acquisition(key, _TIMED_OUT, time.time() - start)
+            if out_of_time:
+                raise _out_of_time_failure('lock', key, value)
+            raise
+    _record_lock_acquisition(key, status, time.time() - start)
+    if status != _REACQUIRED:
+        # We take the lease as starting now, after memcache's started,
+        # so we never think we hold the lock after memcache has let it go.
+        _global_locks_held_by_request()[key] = time.time() + lock_timeout
+        _note_lock_lease(key, lock_timeout)
 
 
 def release_global_lock(key):
     # TODO(jlfwong): Make this asynchronous, since we don't need to
     # block until the lock is released.
     key = _global_lock_key(key)
+    value = _global_lock_value_for_this_request()
+    _record_lock_release(key)
+    _global_locks_held_by_request().pop(key, None)
+    _forget_lock_lease(key)
+    _refresh_instance_heartbeat()
+
+    if _hand_off_local_lock(key, value):
+        return
 
     # TODO(csilvers): there's a race condition here where we do the
     # get above, then the key expires in memcache, another process
@@ -467,35 +1936,460 @@ def release_global_lock(key):
     # should not commonly be expiring.
 
     for _ in xrange(3):      # retry a bit to release the lock
-        delete_status = memcache_util_delete_with_deadline(key)
-        if delete_status != memcache.DELETE_NETWORK_FAILURE:
+        delete_status = _lock_backend.delete(key)
+        if delete_status != LockBackend.DELETE_NETWORK_FAILURE:
             break
         time.sleep(0.5)
     else:
         logging.error("Failed to release_lock() on %s: network failure" % key)
 
+    _release_local_lock(key, value)
+
 
 @contextlib.contextmanager
-def global_lock(key, lock_timeout=None, wait_timeout=None):
-    acquire_global_lock(key, lock_timeout, wait_timeout)
+def global_lock(key, lock_timeout=None, wait_timeout=None, queued=False):
+    acquire_global_lock(key, lock_timeout, wait_timeout, queued=queued)
     try:
         yield
     finally:
         release_global_lock(key)
 
 
+# --------------- Semaphores and rate limits
+# A global lock lets one request at a time do something.  Sometimes
+# you want to let N requests at a time do it, or let requests do it N
+# times a second.  For those, use a global semaphore or a rate limit.
+
+# How often a waiter polls for a free semaphore permit.
+_SEMAPHORE_POLL_INTERVAL = 0.25
+
+
+def _semaphore_permit_key(key, i):
+    assert isinstance(key, basestring), (
+        "Key '%s' must be a string, not a %s" % (key, type(key)))
+    return 'global_semaphore_%s.permit.%d' % (key.encode('utf-8'), i)
+
+
+def _acquire_global_semaphore_steps(key, permits, lock_timeout,
+                                    wait_timeout):
+    """The guts of acquire_global_semaphore(), for _wait_through()."""
+    value = _global_lock_value_for_this_request()
+    if lock_timeout is None:
+        lock_timeout = _DEFAULT_HOLD_TIMEOUT_FOR_INTERACTIVE
+    if wait_timeout is None:
+        wait_timeout = _default_wait_timeout()
+    start = time.time()
+    # As for global locks, we take a free permit even with no time left.
+    out_of_time = False
+    request_deadline = _request_local.context.deadline
+    if request_deadline is not None:
+        budget = request_deadline - start - _REQUEST_DEADLINE_SAFETY_MARGIN
+        out_of_time = budget <= 0
+        wait_timeout = max(min(wait_timeout, budget), 0)
+
+    permit_keys = [_semaphore_permit_key(key, i) for i in xrange(permits)]
+    while True:
+        holders = _lock_backend.get_multi_async(permit_keys).get_result()
+        free_keys = [k for k in permit_keys if k not in holders]
+        # Go for the free permits in random order, so waiters don't all
+        # fight over the same one.
+        random.shuffle(free_keys)
+        for permit_key in free_keys:
+            add_status = _lock_backend.add(permit_key, value,
+                                           time=lock_timeout)
+            if add_status == LockBackend.STORED:
+                break
+            elif not add_status or add_status == LockBackend.ERROR:
+                # Just like global locks, we 'fail permissive' and
+                # pretend we got a permit.  We don't record it as held,
+                # though, since we don't know that we hold it.
+                logging.error('Memcache error acquiring (global) '
+                              'semaphore permit %s' % permit_key)
+                return
+        else:
+            if time.time() - start >= wait_timeout:
+                if out_of_time:
+                    raise _out_of_time_failure('semaphore', key, value)
+                raise LockAcquireFailure("Timeout after %d seconds waiting "
+                                         "for one of %d permits of the %s "
+                                         "semaphore for %s"
+                                         % (wait_timeout, permits, key,
+                                            value))
+            yield _SEMAPHORE_POLL_INTERVAL
+            continue
+        held = _request_local.context.semaphore_permits_held
+        held.setdefault(key, []).append(permit_key)
+        return
+
+
+def acquire_global_semaphore(key, permits, lock_timeout=None,
+                             wait_timeout=None):
+    """Acquire one of `permits` permits for key, across all instances.
+
+    This is like acquire_global_lock(), but up to `permits` requests
+    can hold the semaphore at once.  Each permit is a lease, just like
+    a global lock, and we 'fail permissive' on memcache errors, just
+    like global locks.  Unlike global locks, a request that acquires
+    the semaphore twice holds two permits, and must release it twice.
+    LockUtilMiddleware releases any permits still held at the end of
+    the request.
+
+    Every caller must use the same value of `permits` for a given key.
+
+    Arguments:
+        key: the key to the semaphore
+        permits: how many requests may hold the semaphore at once
+        lock_timeout, wait_timeout: as for acquire_global_lock()
+    """
+    _wait_through(_acquire_global_semaphore_steps(key, permits,
+                                                  lock_timeout, wait_timeout))
+
+
+def release_global_semaphore(key):
+    """Release one of this request's permits for the key semaphore."""
+    held = _request_local.context.semaphore_permits_held
+    permit_keys = held.get(key)
+    if not permit_keys:
+        # We probably failed permissive when acquiring it.
+        logging.warning('Releasing the %s semaphore, but we hold no permit '
+                        'for it' % key)
+        return
+    permit_key = permit_keys.pop()
+    if not permit_keys:
+        del held[key]
+    if _lock_backend.delete(permit_key) == LockBackend.DELETE_NETWORK_FAILURE:
+        logging.error("Failed to release semaphore permit %s: network "
+                      "failure" % permit_key)
+
+
+def release_all_global_semaphores_held_by_request():
+    """Release all semaphore permits held in the current request."""
+    held = _request_local.context.semaphore_permits_held
+    for (key, permit_keys) in held.items():
+        for _ in xrange(len(permit_keys)):
+            release_global_semaphore(key)
+
+
+@contextlib.contextmanager
+def global_semaphore(key, permits, lock_timeout=None, wait_timeout=None):
+    acquire_global_semaphore(key, permits, lock_timeout, wait_timeout)
+    try:
+        yield
+    finally:
+        release_global_semaphore(key)
+
+
+def _rate_limit_key(key):
+    assert isinstance(key, basestring), (
+        "Key '%s' must be a string, not a %s" % (key, type(key)))
+    return 'rate_limit_' + key.encode('utf-8')
+
+
+def take_rate_limit_token(key, rate, burst=1, wait_timeout=0):
+    """Take a token from key's token bucket, if it has one.
+
+    The bucket holds up to `burst` tokens, and refills at `rate` tokens
+    per second, across all instances.  If the bucket is empty, we wait
+    up to wait_timeout seconds for a token; by default we don't wait
+    at all.  We never wait past the request's deadline, though; see
+    set_request_deadline().  Returns True if we got a token, False if
+    not.  On memcache errors, we 'fail permissive' and return True.
+
+    Every caller must use the same rate and burst for a given key.
+
+    Rather than storing a count of tokens, which would have to be
+    refilled, we store the time at which the bucket would be full
+    again, known as the 'theoretical arrival time' (this is the
+    'generic cell rate algorithm').  Taking a token pushes that time
+    1/rate seconds later; we can take one if the result is no more
+    than burst/rate seconds from now.
+    """
+    if rate <= 0:
+        raise ValueError("A rate limit's rate must be positive, not %s"
+                         % rate)
+    if burst < 1:
+        raise ValueError("A rate limit's burst must be at least 1, not %s"
+                         % burst)
+    backend_key = _rate_limit_key(key)
+    interval = 1.0 / rate
+    capacity = burst * interval
+    deadline = time.time() + wait_timeout
+    request_deadline = _request_local.context.deadline
+    if request_deadline is not None:
+        deadline = min(deadline,
+                       request_deadline - _REQUEST_DEADLINE_SAFETY_MARGIN)
+    while True:
+        now = time.time()
+        old_tat = _lock_backend.get(backend_key)
+        new_tat = max(float(old_tat or 0), now) + interval
+        if new_tat - now > capacity:
+            # Empty bucket; wait until there's a token.
+            to_wait = new_tat - now - capacity
+            if now + to_wait > deadline:
+                return False
+            time.sleep(to_wait)
+            continue
+
+        # The bucket is full by the time new_tat comes around, so
+        # nobody needs to remember it after that.
+        expires = int(new_tat - now) + 1
+        if old_tat is None:
+            status = _lock_backend.add(backend_key, new_tat, time=expires)
+        else:
+            status = _lock_backend.cas(backend_key, old_tat, new_tat,
+                                       time=expires)
+        if status == LockBackend.STORED:
+            return True
+        elif not status or status == LockBackend.ERROR:
+            logging.error('Memcache error taking a token from the %s rate '
+                          'limit' % key)
+            return True
+        # Otherwise someone else took a token at the same time; retry.
+
+
+# --------------- Lock-order analysis
+# Two requests that take the same two user locks in opposite orders
+# can deadlock (until one of them times out).  To find such places
+# before they bite, turn on the lock-order analyzer via
+# set_lock_order_analysis().  For a sample of requests, it notes which
+# user locks each request acquires while holding which others, and
+# merges that into a graph of lock classes for the instance.  (A lock
+# class is a lock-id with the id part stripped off, as for lock
+# metrics, plus its scope.)  A cycle in that graph is a potential
+# deadlock.  Taking two locks of the same class is fine as long as
+# everyone takes them in lock-id order, like
+# fetch_multi_under_user_write_lock() does, so we only complain about
+# that if someone doesn't.
+#
+# The analyzer also notes locks held for more than some fraction of
+# their lease, which are at risk of expiring while in use.
+#
+# We log a warning the first time we see each problem, and
+# lock_order_report() summarizes everything seen so far.
+
+_lock_order_sample_rate = 0.0
+_lock_order_hold_fraction = 0.5
+
+# Protects the two maps below, which are shared by all threads.
+_lock_order_mutex = threading.Lock()
+
+# Map from (held lock class, acquired lock class) to a list
+# [times seen, times seen with the lock-ids out of order].
+_lock_order_edges = {}
+
+# Map from lock class to a list [number of long holds, longest hold].
+_lock_long_holds = {}
+
+
+def set_lock_order_analysis(sample_rate, hold_fraction=0.5):
+    """Analyze the user-lock usage of a fraction of requests.
+
+    sample_rate is the fraction of requests to analyze; 0 turns the
+    analyzer off.  It's cheap enough to leave on for a small fraction
+    of production requests.  We complain about any user lock held for
+    more than hold_fraction of its lease.
+    """
+    global _lock_order_sample_rate, _lock_order_hold_fraction
+    _lock_order_sample_rate = sample_rate
+    _lock_order_hold_fraction = hold_fraction
+
+
+def _user_lock_class(lock_id, scope):
+    lock_class = _lock_key_prefix(lock_id)
+    if scope is not None:
+        lock_class += '[%s]' % scope
+    return lock_class
+
+
+def _lock_class_reaches(start, goal):
+    """True if there's a path from start to goal in the lock-order graph.
+
+    Call this with _lock_order_mutex held.
+    """
+    seen = set()
+    todo = [start]
+    while todo:
+        lock_class = todo.pop()
+        if lock_class == goal:
+            return True
+        if lock_class in seen:
+            continue
+        seen.add(lock_class)
+        todo.extend(after for (before, after) in _lock_order_edges
+                    if before == lock_class)
+    return False
+
+
+def _note_user_lock_acquired(map_key, lock_id, scope, lock_timeout):
+    """Add this acquisition to the lock-order graph, if we're sampling."""
+    held = _request_local.context.user_lock_order
+    if held is None:
+        return
+    lock_class = _user_lock_class(lock_id, scope)
+    with _lock_order_mutex:
+        for (_, held_class, held_id, _, _) in held:
+            edge_key = (held_class, lock_class)
+            edge = _lock_order_edges.get(edge_key)
+            if edge is None:
+                if (held_class != lock_class and
+                        _lock_class_reaches(lock_class, held_class)):
+                    logging.warning('Potential deadlock: acquired a %s lock '
+                                    'while holding a %s lock, but elsewhere '
+                                    'they are acquired in the other order'
+                                    % (lock_class, held_class))
+                edge = _lock_order_edges[edge_key] = [0, 0]
+            edge[0] += 1
+            if held_class == lock_class and lock_id < held_id:
+                if not edge[1]:
+                    logging.warning('Potential deadlock: acquired %s lock '
+                                    '%s while holding %s; acquire them in '
+                                    'sorted order instead'
+                                    % (lock_class, lock_id, held_id))
+                edge[1] += 1
+    if lock_timeout is None:
+        lock_timeout = _DEFAULT_HOLD_TIMEOUT_FOR_INTERACTIVE
+    held.append((map_key, lock_class, lock_id, time.time(), lock_timeout))
+
+
+def _note_user_lock_released(map_key):
+    """Check how long we held this lock, if we're sampling."""
+    held = _request_local.context.user_lock_order
+    if not held:
+        return
+    for (i, entry) in enumerate(held):
+        if entry[0] == map_key:
+            break
+    else:
+        return     # we acquired it before we started sampling
+    (_, lock_class, lock_id, acquire_time, lock_timeout) = held.pop(i)
+    hold_seconds = time.time() - acquire_time
+    if hold_seconds <= lock_timeout * _lock_order_hold_fraction:
+        return
+    with _lock_order_mutex:
+        stats = _lock_long_holds.setdefault(lock_class, [0, 0.0])
+        stats[0] += 1
+        stats[1] = max(stats[1], hold_seconds)
+    logging.warning('Held the user lock for %s for %.1f seconds, of a '
+                    '%d-second lease' % (lock_id, hold_seconds, lock_timeout))
+
+
+def lock_order_report():
+    """Summarize what the lock-order analyzer has seen in this instance.
+
+    Returns a dict with:
+        edges: a list of dicts, one per pair of lock classes acquired
+           one while holding the other, with `held` and `acquired`
+           lock classes, the `count` of times we saw that, and how many
+           of those were `out_of_order` (only for same-class pairs)
+        cycles: a list of sets of lock classes that are acquired in
+           inconsistent orders, and so could deadlock
+        long_holds: a dict from lock class to the `count` of holds
+           that were too long, and the `max_seconds` of any of them
+    """
+    with _lock_order_mutex:
+        edges = sorted(_lock_order_edges.iteritems())
+        lock_classes = set(c for ((before, after), _) in edges
+                           for c in (before, after))
+        cycles = []
+        for lock_class in sorted(lock_classes):
+            if any(lock_class in cycle for cycle in cycles):
+                continue
+            cycle = set(c for c in lock_classes
+                        if c != lock_class and
+                        _lock_class_reaches(lock_class, c) and
+                        _lock_class_reaches(c, lock_class))
+            if cycle:
+                cycle.add(lock_class)
+                cycles.append(cycle)
+        cycles.extend(set([before]) for ((before, after), (_, unordered))
+                      in edges if before == after and unordered)
+        long_holds = dict((lock_class, {'count': count,
+                                        'max_seconds': max_seconds})
+                          for (lock_class, (count, max_seconds))
+                          in _lock_long_holds.iteritems())
+
+    return {
+        'edges': [{'held': before, 'acquired': after, 'count': count,
+                   'out_of_order': unordered}
+                  for ((before, after), (count, unordered)) in edges],
+        'cycles': cycles,
+        'long_holds': long_holds,
+    }
+
+
 # --------------- User lock code
 
+# When a request acquires a second user lock, we log the stack, to
+# help find lock-ordering problems.  Formatting a stack is expensive,
+# and hot handlers can take multiple locks from the same place over
+# and over, so we only log the full stack the first time we see a
+# given call-stack, and then for this fraction of the later times.
+# See set_multi_lock_stack_sample_rate().
+_multi_lock_stack_sample_rate = 0.0
+
+# Map from call-stack fingerprint (see _call_site_fingerprint) to the
+# number of times a request has acquired multiple user locks there.
+# We clear it if it gets too big, which just means we'll log some
+# stacks again.
+_multi_lock_call_sites = {}
+_MAX_MULTI_LOCK_CALL_SITES = 10000
+
+# Scopes let unrelated writes to the same user's data -- say, progress
+# vs. settings -- hold separate locks, so they don't serialize against
+# each other.  The whole-user lock (no scope) conflicts with every
+# scope.  Since a whole-user lock has to check every scope, all scopes
+# must be registered, via register_user_write_lock_scope(), at import
+# time in every instance.
+_user_write_lock_scopes = set()
+
+# How often a whole-user lock checks whether the scoped locks it
+# conflicts with have been released, and vice versa.
+_SCOPE_POLL_INTERVAL = 0.25
+
+
+def set_multi_lock_stack_sample_rate(sample_rate):
+    """Log the stack for this fraction of repeated multi-user-lock calls.
+
+    We always log the stack the first time a request acquires a second
+    user lock from a given call-stack.  After that, we log it for
+    sample_rate of the times; 0, the default, means never.
+    """
+    global _multi_lock_stack_sample_rate
+    _multi_lock_stack_sample_rate = sample_rate
 
-_WRITE_LOCK_REQUEST_CACHE_KEY = "user_write_locks_held"
 
+def register_user_write_lock_scope(scope):
+    """Say that `scope` may be passed to user_write_lock() and friends."""
+    assert isinstance(scope, basestring), (scope, type(scope))
+    _user_write_lock_scopes.add(scope)
 
-def _user_write_lock_global_key(lock_id):
-    return "write_lock_%s" % lock_id
 
+def _user_write_lock_global_key(lock_id, scope=None):
+    if scope is None:
+        return "write_lock_%s" % lock_id
+    return "scoped_write_lock_%s_%s" % (scope, lock_id)
 
-def _lock_id_map_from_request_cache():
-    """Return a map s.t. if you modify the map, it modifies in the cache.
+
+def _lock_id_map_key(lock_id, scope):
+    """Whole-user locks are keyed by lock_id, scoped by (lock_id, scope)."""
+    return lock_id if scope is None else (lock_id, scope)
+
+
+def _call_site_fingerprint(frame):
+    """Return a cheap, hashable identifier of the stack ending at frame.
+
+    Unlike traceback.extract_stack(), this doesn't look at filenames
+    or source lines, so it is fast enough to do on every call.
+    """
+    fingerprint = []
+    while frame is not None:
+        fingerprint.append((frame.f_code, frame.f_lineno))
+        frame = frame.f_back
+    return tuple(fingerprint)
+
+
+def _user_locks_held_by_request():
+    """Return a map s.t. if you modify the map, it modifies the request's.
 
     The lock_id_map is what controls locks being re-entrant (from the
     same request).  It also assigns a unique nonce to each lock
@@ -504,36 +2398,49 @@ def _lock_id_map_from_request_cache():
     from the first.  Note that a single lock_id will always have at
     most one lock active for it at a time.
 
-    lock_id_map is a map from lock_id -> (unique nonce, lock-count)
+    lock_id_map is a map from lock_id -> _HeldUserLock for whole-user
+    locks, and from (lock_id, scope) -> _HeldUserLock for scoped locks.
     """
-    retval = _request_cache.get(_WRITE_LOCK_REQUEST_CACHE_KEY, None)
-    if retval is None:
-        retval = {}
-        _request_cache[_WRITE_LOCK_REQUEST_CACHE_KEY] = retval
-    return retval
+    return _request_local.context.user_locks_held
 
 
 def release_all_user_write_locks_held_by_request():
     """Release all user write locks held in the current request."""
-    lock_id_map = _lock_id_map_from_request_cache()
-    for (lock_id, (_, lock_count)) in lock_id_map.items():
-        for _ in xrange(lock_count):
-            release_user_write_lock(lock_id)
+    lock_id_map = _user_locks_held_by_request()
+    for (map_key, held) in lock_id_map.items():
+        if isinstance(map_key, tuple):
+            (lock_id, scope) = map_key
+        else:
+            (lock_id, scope) = (map_key, None)
+        for _ in xrange(held.count):
+            release_user_write_lock(lock_id, scope=scope)
 
 
-def user_write_lock_is_held_by_request(lock_id):
+def user_write_lock_is_held_by_request(lock_id, scope=None):
     """Return True if the user write lock is held for the given lock_id.
 
-    Does not attempt to acquire the lock if it is not held.
+    If scope is specified, the lock for that scope counts as well as
+    the whole-user lock.  Does not attempt to acquire the lock if it is
+    not held.
     """
-    lock_id_map = _lock_id_map_from_request_cache()
-    return lock_id in lock_id_map
+    return nonce_of_user_write_lock_held_by_request(lock_id, scope) is not None
 
 
-def nonce_of_user_write_lock_held_by_request(lock_id):
-    """Return lock-nonce, or None if no lock is held for this lock_id."""
-    lock_id_map = _lock_id_map_from_request_cache()
-    return lock_id_map.get(lock_id, (None, 0))[0]
+def nonce_of_user_write_lock_held_by_request(lock_id, scope=None):
+    """Return lock-nonce, or None if no lock is held for this lock_id.
+
+    If scope is specified, and we hold the lock for that scope, we
+    return its nonce.  Otherwise, we return the whole-user lock's.
+    """
+    # This runs on every get and put of a user-specific model, so we
+    # keep it lean.
+    lock_id_map = _request_local.context.user_locks_held
+    if scope is not None:
+        held = lock_id_map.get((lock_id, scope))
+        if held is not None:
+            return held.nonce
+    held = lock_id_map.get(lock_id)
+    return held.nonce if held is not None else None
 
 
 def nonce_of_any_user_write_lock_held_by_request():
@@ -549,12 +2456,88 @@ def nonce_of_any_user_write_lock_held_by_request():
     held by this request doesn't change, the return value won't change
     either.
     """
-    lock_id_map = _lock_id_map_from_request_cache()
-    all_nonces = [nonce for (nonce, _) in lock_id_map.itervalues()]
+    lock_id_map = _user_locks_held_by_request()
+    all_nonces = [held.nonce for held in lock_id_map.itervalues()]
     return min(all_nonces) if all_nonces else None
 
 
-def acquire_user_write_lock(lock_id, lock_timeout=None, wait_timeout=None):
+def _user_write_lock_wait_deadline(wait_timeout):
+    """Return the time.time() at which a user-lock acquisition gives up.
+
+    Acquiring a user lock can take several waits in a row, for the
+    whole-user lock and then the scoped ones, or vice versa.  They all
+    share one deadline, so that together they wait at most
+    wait_timeout, and never past the request's deadline (minus the
+    safety margin; see set_request_deadline()).
+    """
+    if wait_timeout is None:
+        wait_timeout = _default_wait_timeout()
+    deadline = time.time() + wait_timeout
+    request_deadline = _request_local.context.deadline
+    if request_deadline is not None:
+        deadline = min(deadline,
+                       request_deadline - _REQUEST_DEADLINE_SAFETY_MARGIN)
+    return deadline
+
+
+def _wait_for_scoped_user_write_locks(lock_id, deadline):
+    """Steps to wait until nobody else holds a scoped lock for lock_id.
+
+    We call this after acquiring the whole-user lock, which keeps
+    anyone from getting a new scoped lock (see
+    _acquire_scoped_user_write_lock), so we just need to wait for the
+    existing holders to finish, or for the deadline to pass.
+    """
+    keys = [_global_lock_key(_user_write_lock_global_key(lock_id, scope))
+            for scope in _user_write_lock_scopes]
+    value = _global_lock_value_for_this_request()
+    start = time.time()
+    while True:
+        holders = _lock_backend.get_multi_async(keys).get_result()
+        # We don't need to wait for scoped locks that we hold ourselves.
+        others = sorted(k for (k, v) in holders.iteritems() if v != value)
+        if not others:
+            return
+        if time.time() >= deadline:
+            raise LockAcquireFailure("Timeout after %d seconds waiting for "
+                                     "the scoped locks %s for %s"
+                                     % (time.time() - start, others, value))
+        yield min(_SCOPE_POLL_INTERVAL, max(deadline - time.time(), 0))
+
+
+def _acquire_scoped_user_write_lock(lock_id, scope, lock_timeout,
+                                    deadline, wait_locally):
+    """Steps to acquire the lock for one scope of lock_id's data.
+
+    Besides the lock for the scope itself, we need to make sure nobody
+    else holds the whole-user lock.  If someone does, we back off: we
+    release our scoped lock (since the whole-user lock holder is
+    waiting for it) and try again, until the deadline passes.
+    """
+    scoped_key = _user_write_lock_global_key(lock_id, scope)
+    whole_user_key = _global_lock_key(_user_write_lock_global_key(lock_id))
+    value = _global_lock_value_for_this_request()
+    start = time.time()
+    while True:
+        for delay in _acquire_global_lock_steps(
+                scoped_key, lock_timeout, max(deadline - time.time(), 0),
+                False, wait_locally):
+            yield delay
+        other_id = _lock_backend.get(whole_user_key)
+        if other_id is None or other_id == value:
+            return
+        release_global_lock(scoped_key)
+        if time.time() >= deadline:
+            raise LockAcquireFailure("Timeout after %d seconds waiting for "
+                                     "the %s lock for %s (whole-user lock "
+                                     "held by %s)"
+                                     % (time.time() - start, scoped_key,
+                                        value, other_id))
+        yield min(_SCOPE_POLL_INTERVAL, max(deadline - time.time(), 0))
+
+
+def acquire_user_write_lock(lock_id, lock_timeout=None, wait_timeout=None,
+                            scope=None):
     """Acquire the user write lock for the user with the given lock_id.
 
     This lock is re-entrant: multiple acquires of the same key by the
@@ -563,6 +2546,12 @@ def acquire_user_write_lock(lock_id, lock_timeout=None, wait_timeout=None):
 
     This lock must be held while writing to any user-specific models.
 
+    If scope is specified, we only lock that part of the user's data:
+    two requests can hold locks for different scopes of the same user
+    at the same time.  The whole-user lock (scope=None) conflicts with
+    all scopes, and if you already hold it, acquiring a scoped lock is
+    a no-op.
+
     Arguments:
         lock_id: an identifier of the user (or other abstract entity)
            to acquire the lock for
@@ -571,56 +2560,177 @@ def acquire_user_write_lock(lock_id, lock_timeout=None, wait_timeout=None):
            default.  There is no way to acquire a global lock for forever.
         wait_timeout: how long to wait to acquire the lock before aborting
            this request, in seconds.
+        scope: which part of the user's data to lock, or None for all
+           of it.  The scope must have been registered via
+           register_user_write_lock_scope().
+
+    """
+    # Exclude this frame; our caller is the interesting one for logging.
+    _wait_through(_acquire_user_write_lock_steps(
+        lock_id, lock_timeout, wait_timeout, scope, sys._getframe(1),
+        wait_locally=True))
+
+
+def acquire_user_write_lock_async(lock_id, lock_timeout=None,
+                                  wait_timeout=None, scope=None):
+    """Like acquire_user_write_lock(), but returns an ndb future.
+
+    While this waits for a contended lock, other ndb tasklets in this
+    request keep running.  The future's result is None; if we time out
+    waiting for the lock, get_result() raises LockAcquireFailure.
+    Release the lock with release_user_write_lock(), as usual.
 
+    Like all user write locks, this is re-entrant across the request:
+    tasklets in the same request share the lock rather than excluding
+    each other.
+    """
+    return _wait_through_async(_acquire_user_write_lock_steps(
+        lock_id, lock_timeout, wait_timeout, scope, sys._getframe(1),
+        wait_locally=False))
+
+
+def _user_write_lock_already_held(lock_id_map, lock_id, scope):
+    """If this request holds the lock already, count us as holding it too.
+
+    Returns True if so, False if we actually need to acquire the lock.
+    """
+    map_key = _lock_id_map_key(lock_id, scope)
+    if map_key in lock_id_map:
+        # Just increment the lock count.
+        lock_id_map[map_key].count += 1
+        return True
+    if scope is not None and lock_id in lock_id_map:
+        # The whole-user lock covers every scope, so we piggyback on
+        # it.  release_user_write_lock() knows to look for this.
+        lock_id_map[lock_id].count += 1
+        return True
+    return False
+
+
+def _acquire_user_write_lock_steps(lock_id, lock_timeout, wait_timeout,
+                                   scope, caller, wait_locally):
+    """The guts of acquire_user_write_lock(), as steps for _wait_through().
+
+    caller is the frame that asked for the lock, for logging.  See
+    _acquire_global_lock_steps() for wait_locally.
     """
     # TODO(jlfwong): Enforce that locks are acquired in lexicographical order?
     assert isinstance(lock_id, basestring), (lock_id, type(lock_id))
-    lock_id_map = _lock_id_map_from_request_cache()
-    if lock_id in lock_id_map:
-        # Just increment the lock count.
-        lock_id_map[lock_id][1] += 1
+    assert scope is None or scope in _user_write_lock_scopes, (
+        "Unregistered user-lock scope", scope)
+    lock_id_map = _user_locks_held_by_request()
+    map_key = _lock_id_map_key(lock_id, scope)
+    if _user_write_lock_already_held(lock_id_map, lock_id, scope):
         return
 
-    acquire_global_lock(_user_write_lock_global_key(lock_id),
-                        lock_timeout=lock_timeout,
-                        wait_timeout=wait_timeout)
-    logging.debug("Acquired user lock for %s" % lock_id)
+    deadline = _user_write_lock_wait_deadline(wait_timeout)
+    if scope is None:
+        whole_user_key = _user_write_lock_global_key(lock_id)
+        for delay in _acquire_global_lock_steps(
+                whole_user_key, lock_timeout,
+                max(deadline - time.time(), 0), False, wait_locally):
+            yield delay
+        if _user_write_lock_scopes:
+            try:
+                for delay in _wait_for_scoped_user_write_locks(lock_id,
+                                                               deadline):
+                    yield delay
+            except LockAcquireFailure:
+                # Don't keep everyone else out while we give up.
+                release_global_lock(whole_user_key)
+                raise
+    else:
+        for delay in _acquire_scoped_user_write_lock(
+                lock_id, scope, lock_timeout, deadline, wait_locally):
+            yield delay
+
+    # If we waited, another tasklet in this request may have gotten
+    # the lock in the meantime; if so, we share it.
+    if not wait_locally and _user_write_lock_already_held(lock_id_map,
+                                                          lock_id, scope):
+        return
+    logging.debug("Acquired user lock for %s" % (map_key,))
 
     # This is to help us find requests that want to acquire locks for
     # multiple users simultaneously.  This can be useful when needing
     # to avoid deadlock due to lock-aquisition order.
     if lock_id_map:
-        # Exclude the last line as it's this one.
-        tb = ''.join(traceback.format_stack()[:-1])
-        logging.info('Already held user-lock for %s and just added %s:\n'
-                     '%s\n' % (sorted(lock_id_map), lock_id, tb))
+        fingerprint = _call_site_fingerprint(caller)
+        if len(_multi_lock_call_sites) >= _MAX_MULTI_LOCK_CALL_SITES:
+            _multi_lock_call_sites.clear()
+        count = _multi_lock_call_sites.get(fingerprint, 0) + 1
+        _multi_lock_call_sites[fingerprint] = count
+        if count == 1 or random.random() < _multi_lock_stack_sample_rate:
+            tb = ''.join(traceback.format_stack(caller))
+            logging.info('Already held user-lock for %s and just added %s '
+                         '(seen %d times from here):\n%s\n'
+                         % (sorted(lock_id_map), map_key, count, tb))
 
     lock_nonce = hex(random.randint(1, 1 << 32))[2:]    # get rid of the '0x'
-    lock_id_map[lock_id] = [lock_nonce, 1]
+    lock_id_map[map_key] = _HeldUserLock(lock_nonce)
+    _note_user_lock_acquired(map_key, lock_id, scope, lock_timeout)
 
 
-def release_user_write_lock(lock_id):
+def release_user_write_lock(lock_id, scope=None):
     """Release the user write lock for the user with the given lock_id."""
     assert isinstance(lock_id, basestring), (lock_id, type(lock_id))
-    lock_id_map = _lock_id_map_from_request_cache()
-    assert lock_id in lock_id_map, (
+    lock_id_map = _user_locks_held_by_request()
+    map_key = _lock_id_map_key(lock_id, scope)
+    if map_key not in lock_id_map:
+        # We acquired this scope while holding the whole-user lock.
+        map_key = lock_id
+        scope = None
+    assert map_key in lock_id_map, (
         "Attempted to release unheld write lock for %s" % lock_id)
-    assert lock_id_map[lock_id][1] > 0, ("Non-positive lock count?", lock_id)
+    held = lock_id_map[map_key]
+    assert held.count > 0, ("Non-positive lock count?", map_key)
 
-    lock_id_map[lock_id][1] -= 1
-    if lock_id_map[lock_id][1] == 0:
-        release_global_lock(_user_write_lock_global_key(lock_id))
-        logging.debug("Released user lock for %s" % lock_id)
-        lock_id_map.pop(lock_id)
+    held.count -= 1
+    if held.count == 0:
+        release_global_lock(_user_write_lock_global_key(lock_id, scope))
+        logging.debug("Released user lock for %s" % (map_key,))
+        lock_id_map.pop(map_key)
+        _note_user_lock_released(map_key)
 
 
 @contextlib.contextmanager
-def user_write_lock(lock_id, lock_timeout=None, wait_timeout=None):
-    acquire_user_write_lock(lock_id, lock_timeout, wait_timeout)
+def user_write_lock(lock_id, lock_timeout=None, wait_timeout=None,
+                    scope=None):
+    acquire_user_write_lock(lock_id, lock_timeout, wait_timeout, scope=scope)
     try:
         yield
     finally:
-        release_user_write_lock(lock_id)
+        release_user_write_lock(lock_id, scope=scope)
+
+
+def _user_write_lock_for_entity(entity):
+    """Return (lock_id, scope, needs_refetch) for a user-lock-model entity.
+
+    needs_refetch is False if the entity was already retrieved under
+    the lock we hold now, or can't be re-fetched because it has never
+    been stored.
+    """
+    assert callable(entity._transaction_safety_kaid_fn), (
+        "Cannot acquire the user-lock for %s; it's missing a kaid-fn"
+        % entity.__name__)
+    lock_id = entity._transaction_safety_kaid_fn()
+    scope = getattr(entity, '_transaction_safety_lock_scope', None)
+    # This is None if txn_safety has never seen the entity -- which it
+    # can't have, if we couldn't import db_hooks.
+    if db_hooks is None:
+        state = None
+    else:
+        state = db_hooks.entity_hook_state(entity, create=False)
+    entity_lock_nonce = getattr(state, 'user_lock_nonce', None)
+    current_lock_nonce = nonce_of_user_write_lock_held_by_request(lock_id,
+                                                                  scope)
+    under_same_lock = (entity_lock_nonce and
+                           entity_lock_nonce == current_lock_nonce)
+    # If the entity is newly created (has never been get) and also has
+    # never been put, we can't even re-fetch it.
+    never_get_or_put = (not hasattr(state, 'get_nonce') and
+                        not hasattr(state, 'has_been_put'))
+    return (lock_id, scope, not (under_same_lock or never_get_or_put))
 
 
 @contextlib.contextmanager
@@ -634,7 +2744,8 @@ def fetch_under_user_write_lock(entity, lock_timeout=None, wait_timeout=None,
     datastore, and yield that.
 
     This can only be used by models decorated with
-    @db_decorators.written_with_user_lock_model.
+    @db_decorators.written_with_user_lock_model.  If the model
+    declares a lock scope there, we acquire the lock for that scope.
 
     If null_ok is True, then we just return None if the input is None.
     """
@@ -643,22 +2754,12 @@ def fetch_under_user_write_lock(entity, lock_timeout=None, wait_timeout=None,
             yield None
             return
         raise ValueError("Cannot acquire the user-lock for None")
-    assert callable(entity._transaction_safety_kaid_fn), (
-        "Cannot acquire the user-lock for %s; it's missing a kaid-fn"
-        % entity.__name__)
-    lock_id = entity._transaction_safety_kaid_fn()
-    entity_lock_nonce = getattr(entity, '_ts_user_lock_id', None)
-    current_lock_nonce = nonce_of_user_write_lock_held_by_request(lock_id)
-    under_same_lock = (entity_lock_nonce and
-                           entity_lock_nonce == current_lock_nonce)
-    # If the entity is newly created (has never been get) and also has
-    # never been put, we can't even re-fetch it.
-    never_get_or_put = (not hasattr(entity, '_ts_get_id') and
-                        not hasattr(entity, '_ts_has_been_put'))
-    if under_same_lock or never_get_or_put:
+    (lock_id, scope, needs_refetch) = _user_write_lock_for_entity(entity)
+    if not needs_refetch:
         yield entity
     else:
-        with user_write_lock(lock_id):
+        with user_write_lock(lock_id, lock_timeout, wait_timeout,
+                             scope=scope):
             # Re-fetch now that we have the lock.
             if isinstance(entity, db.Model):
                 yield db.get(entity.key())
@@ -669,6 +2770,66 @@ def fetch_under_user_write_lock(entity, lock_timeout=None, wait_timeout=None,
                                  % type(entity))
 
 
+@contextlib.contextmanager
+def fetch_multi_under_user_write_lock(entities, lock_timeout=None,
+                                      wait_timeout=None, null_ok=False):
+    """Like fetch_under_user_write_lock, but for a list of entities.
+
+    Yields a list of the entities, in the same order as the input, each
+    retrieved under its user write lock.  We acquire each lock we need
+    just once, in sorted order so we can't deadlock with another
+    request doing the same, and then re-fetch all the entities that
+    need it with a single db.get() and a single ndb.get_multi(), run in
+    parallel.
+
+    If null_ok is True, then Nones in the input are yielded as None.
+    """
+    entities = list(entities)
+    locks_needed = set()
+    db_indices = []
+    ndb_indices = []
+    for (i, entity) in enumerate(entities):
+        if entity is None:
+            if null_ok:
+                continue
+            raise ValueError("Cannot acquire the user-lock for None")
+        (lock_id, scope, needs_refetch) = _user_write_lock_for_entity(entity)
+        if not needs_refetch:
+            continue
+        if isinstance(entity, db.Model):
+            db_indices.append(i)
+        elif isinstance(entity, ndb.Model):
+            ndb_indices.append(i)
+        else:
+            raise ValueError("Do not know how to fetch type %s"
+                             % type(entity))
+        locks_needed.add((lock_id, scope))
+
+    locks_acquired = []
+    try:
+        for (lock_id, scope) in sorted(locks_needed):
+            acquire_user_write_lock(lock_id, lock_timeout, wait_timeout,
+                                    scope=scope)
+            locks_acquired.append((lock_id, scope))
+
+        # Re-fetch now that we have the locks.
+        results = list(entities)
+        if db_indices:
+            db_rpc = db.get_async([entities[i].key() for i in db_indices])
+        ndb_futures = ndb.get_multi_async([entities[i].key
+                                           for i in ndb_indices])
+        if db_indices:
+            for (i, refetched) in zip(db_indices, db_rpc.get_result()):
+                results[i] = refetched
+        for (i, future) in zip(ndb_indices, ndb_futures):
+            results[i] = future.get_result()
+
+        yield results
+    finally:
+        for (lock_id, scope) in reversed(locks_acquired):
+            release_user_write_lock(lock_id, scope=scope)
+
+
 class LockUtilMiddleware(object):
     """When using lock_util, wrap your WSGI app with this!"""
     def __init__(self, app):
@@ -676,19 +2837,30 @@ class LockUtilMiddleware(object):
 
     def __call__(self, environ, start_response):
         try:
-            _request_cache.clear()    # just to be extra-safe
+            _reset_request_context()    # just to be extra-safe
+            if environ.get('HTTP_X_APPENGINE_QUEUENAME'):
+                request_timeout = _REQUEST_TIMEOUT_FOR_BATCH
+            else:
+                request_timeout = _REQUEST_TIMEOUT_FOR_INTERACTIVE
+            set_request_deadline(time.time() + request_timeout)
+            _refresh_instance_heartbeat()
+
             for retval in self.app(environ, start_response):
                 yield retval
         finally:
             # Now that the request is over, release all global locks
             # that the request may have acquired, in order to modify
-            # per-user data.  Since these are global locks (in
-            # memcache), we can't depend on the normal request_cache
-            # middleware to clean them up.
+            # per-user data, and any semaphore permits.  Since these
+            # are global locks (in memcache), we can't depend on the
+            # normal request_cache middleware to clean them up.
             release_all_user_write_locks_held_by_request()
+            release_all_global_semaphores_held_by_request()
 
             # Also finish up the "no rush" RPC calls we made
             resolve_all_rpcs()
 
-            # Finally, clear the per-request cache
-            _request_cache.clear()
+            # Report on what locks we used, if anyone's listening.
+            flush_lock_metrics()
+
+            # Finally, clear the per-request context
+            _reset_request_context()
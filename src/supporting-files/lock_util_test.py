@@ -0,0 +1,637 @@
+"""Tests for lock_util.py, run on top of fake_appengine/.
+
+Run these from this directory with
+    python -m unittest discover -p '*_test.py'
+"""
+
+import logging
+import os
+import random
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'fake_appengine'))
+# lock_util puts these in its lock values, and complains without them.
+os.environ.setdefault('INSTANCE_ID', 'test-instance')
+os.environ.setdefault('REQUEST_LOG_ID', 'test-request')
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb import tasklets
+
+import db_hooks
+import lock_util
+
+
+class _LockBackendConformanceTests(object):
+    """Tests that every LockBackend must pass.
+
+    Subclasses say which backend to test by defining make_backend().
+    They should also subclass unittest.TestCase.
+    """
+    def make_backend(self):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.backend = self.make_backend()
+        # Make sure we don't see keys from earlier runs, for backends
+        # that outlive this process.
+        prefix = 'lock_util_test_%s_' % random.randint(1, 1000000000)
+        self.key = prefix + 'key'
+        self.other_key = prefix + 'other_key'
+
+    def tearDown(self):
+        self.backend.delete_multi_async([self.key, self.other_key]
+                                        ).get_result()
+
+    def test_add(self):
+        self.assertEqual(lock_util.LockBackend.STORED,
+                         self.backend.add(self.key, 'first'))
+        self.assertEqual(lock_util.LockBackend.NOT_STORED,
+                         self.backend.add(self.key, 'second'))
+        self.assertEqual('first', self.backend.get(self.key))
+
+    def test_add_multi(self):
+        self.backend.add(self.key, 'first')
+        retval = self.backend.add_multi_async(
+            {self.key: 'second', self.other_key: 'second'}).get_result()
+        self.assertEqual({self.key: lock_util.LockBackend.NOT_STORED,
+                          self.other_key: lock_util.LockBackend.STORED},
+                         retval)
+        self.assertEqual(
+            {self.key: 'first', self.other_key: 'second'},
+            self.backend.get_multi_async([self.key, self.other_key]
+                                         ).get_result())
+
+    def test_get_multi_omits_missing_keys(self):
+        self.backend.add(self.key, 'value')
+        self.assertEqual(
+            {self.key: 'value'},
+            self.backend.get_multi_async([self.key, self.other_key]
+                                         ).get_result())
+
+    def test_cas(self):
+        self.assertEqual(lock_util.LockBackend.NOT_STORED,
+                         self.backend.cas(self.key, 'old', 'new'))
+        self.assertEqual(None, self.backend.get(self.key))
+
+        self.backend.add(self.key, 'old')
+        self.assertEqual(lock_util.LockBackend.EXISTS,
+                         self.backend.cas(self.key, 'wrong', 'new'))
+        self.assertEqual('old', self.backend.get(self.key))
+        self.assertEqual(lock_util.LockBackend.STORED,
+                         self.backend.cas(self.key, 'old', 'new'))
+        self.assertEqual('new', self.backend.get(self.key))
+
+    def test_delete(self):
+        self.assertEqual(lock_util.LockBackend.DELETE_ITEM_MISSING,
+                         self.backend.delete(self.key))
+        self.backend.add(self.key, 'value')
+        self.assertEqual(lock_util.LockBackend.DELETED,
+                         self.backend.delete(self.key))
+        self.assertEqual(None, self.backend.get(self.key))
+        self.assertEqual(lock_util.LockBackend.STORED,
+                         self.backend.add(self.key, 'value'))
+
+    def test_incr(self):
+        self.assertEqual(None, self.backend.incr(self.key))
+        self.assertEqual(5, self.backend.incr(self.key, 5, initial_value=0))
+        self.assertEqual(4, self.backend.incr(self.key, -1))
+        # Like memcache, counters never go below 0.
+        self.assertEqual(0, self.backend.incr(self.key, -10))
+        self.assertEqual(0, self.backend.get(self.key))
+
+    def test_expiry(self):
+        self.backend.add(self.key, 'add', time=1)
+        self.backend.add(self.other_key, 'cas')
+        self.backend.cas(self.other_key, 'cas', 'cas', time=1)
+        self.assertEqual(lock_util.LockBackend.NOT_STORED,
+                         self.backend.add(self.key, 'again', time=1))
+        time.sleep(1.1)
+        self.assertEqual({}, self.backend.get_multi_async(
+            [self.key, self.other_key]).get_result())
+        self.assertEqual(lock_util.LockBackend.STORED,
+                         self.backend.add(self.key, 'again'))
+        self.assertEqual(lock_util.LockBackend.NOT_STORED,
+                         self.backend.cas(self.other_key, 'cas', 'new'))
+
+
+class InProcessLockBackendTest(_LockBackendConformanceTests,
+                               unittest.TestCase):
+    def make_backend(self):
+        return lock_util.InProcessLockBackend()
+
+
+class MemcacheLockBackendTest(_LockBackendConformanceTests,
+                              unittest.TestCase):
+    def make_backend(self):
+        memcache.reset()
+        return lock_util.MemcacheLockBackend()
+
+
+class RedisLockBackendTest(_LockBackendConformanceTests, unittest.TestCase):
+    def make_backend(self):
+        if lock_util.redis is None:
+            self.skipTest('the redis package is not installed')
+        backend = lock_util.RedisLockBackend()
+        try:
+            backend.client.ping()
+        except lock_util.redis.RedisError:
+            self.skipTest('there is no redis server on localhost')
+        return backend
+
+
+class _LockUtilTestCase(unittest.TestCase):
+    """Gives each test its own in-process lock backend and request."""
+    def setUp(self):
+        self.saved_backend = lock_util._lock_backend
+        lock_util.set_lock_backend(lock_util.InProcessLockBackend())
+        lock_util._reset_request_context()
+
+    def tearDown(self):
+        lock_util._reset_request_context()
+        lock_util._local_locks.clear()
+        lock_util.set_lock_backend(self.saved_backend)
+
+
+class _FakeClock(object):
+    """Stands in for lock_util's time module: sleeping takes no time."""
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class _FakeClockTestCase(_LockUtilTestCase):
+    """Runs lock_util -- and its in-process backend -- on a _FakeClock."""
+    def setUp(self):
+        super(_FakeClockTestCase, self).setUp()
+        self.clock = _FakeClock()
+        self.saved_time = lock_util.time
+        lock_util.time = self.clock
+
+    def tearDown(self):
+        lock_util.time = self.saved_time
+        super(_FakeClockTestCase, self).tearDown()
+
+    def hold_elsewhere(self, key, seconds):
+        """Have another request hold global-lock key for seconds."""
+        lock_util._lock_backend.add(lock_util._global_lock_key(key),
+                                    'other-request (instance other)',
+                                    time=seconds)
+
+
+class _LogCollector(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class MultiLockStackSamplingTest(_LockUtilTestCase):
+    def setUp(self):
+        super(MultiLockStackSamplingTest, self).setUp()
+        lock_util._multi_lock_call_sites.clear()
+        self.logs = _LogCollector()
+        # lock_util logs to the root logger.  We take over its
+        # handlers, so the stacks don't clutter the test output.
+        self.logger = logging.getLogger()
+        self.saved_level = self.logger.level
+        self.saved_handlers = self.logger.handlers
+        self.logger.setLevel(logging.INFO)
+        self.logger.handlers = [self.logs]
+
+    def tearDown(self):
+        self.logger.handlers = self.saved_handlers
+        self.logger.setLevel(self.saved_level)
+        lock_util.set_multi_lock_stack_sample_rate(0.0)
+        super(MultiLockStackSamplingTest, self).tearDown()
+
+    def take_two_user_locks(self, times):
+        for _ in xrange(times):
+            with lock_util.user_write_lock('u1'):
+                with lock_util.user_write_lock('u2'):
+                    pass
+
+    def stacks_logged(self):
+        return [m for m in self.logs.messages
+                if m.startswith('Already held user-lock')]
+
+    def test_logs_only_the_first_stack_by_default(self):
+        self.take_two_user_locks(3)
+        self.assertEqual(1, len(self.stacks_logged()))
+
+    def test_logs_every_stack_at_rate_1(self):
+        lock_util.set_multi_lock_stack_sample_rate(1.0)
+        self.take_two_user_locks(3)
+        stacks = self.stacks_logged()
+        self.assertEqual(3, len(stacks))
+        self.assertIn('seen 3 times from here', stacks[-1])
+        self.assertIn('take_two_user_locks', stacks[-1])
+
+
+class InstanceHeartbeatTest(_LockUtilTestCase):
+    """The heartbeat keeps an idle lock-holder from looking dead.
+
+    These run in real time, with a short heartbeat ttl.
+    """
+    def setUp(self):
+        super(InstanceHeartbeatTest, self).setUp()
+        lock_util.set_instance_heartbeat_ttl(0.3)
+        self.key = lock_util._global_lock_key('heartbeat')
+        self.value = lock_util._global_lock_value_for_this_request()
+
+    def tearDown(self):
+        lock_util.set_instance_heartbeat_ttl(None)
+        thread = lock_util._heartbeat_thread
+        if thread is not None:
+            thread.join()
+        super(InstanceHeartbeatTest, self).tearDown()
+
+    def try_to_break_lock(self):
+        """Try to take our lock over from another instance."""
+        return lock_util._take_lock_from_dead_holder(
+            self.key, 'other-request (instance other)', 60)
+
+    def test_idle_holder_keeps_its_lock(self):
+        lock_util.acquire_global_lock('heartbeat')
+        # We don't call into lock_util for two ttls.
+        time.sleep(0.7)
+        self.assertIsNone(self.try_to_break_lock())
+        self.assertEqual(self.value, lock_util._lock_backend.get(self.key))
+        lock_util.release_global_lock('heartbeat')
+
+    def test_heartbeat_thread_exits_after_release(self):
+        lock_util.acquire_global_lock('heartbeat')
+        thread = lock_util._heartbeat_thread
+        self.assertTrue(thread.is_alive())
+        lock_util.release_global_lock('heartbeat')
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(lock_util._heartbeat_thread)
+        # Once the heartbeat runs out, we look dead, as we should.
+        time.sleep(0.4)
+        lock_util._lock_backend.add(self.key, self.value, time=60)
+        self.assertEqual(self.value, self.try_to_break_lock())
+
+    def test_heartbeat_thread_exits_when_the_lease_runs_out(self):
+        lock_util.acquire_global_lock('heartbeat', lock_timeout=0.2)
+        thread = lock_util._heartbeat_thread
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual({}, lock_util._heartbeat_leases)
+
+    def test_acquiring_again_restarts_the_heartbeat_thread(self):
+        lock_util.acquire_global_lock('heartbeat')
+        lock_util.release_global_lock('heartbeat')
+        lock_util._heartbeat_thread.join(1)
+        lock_util.acquire_global_lock('heartbeat')
+        self.assertTrue(lock_util._heartbeat_thread.is_alive())
+        time.sleep(0.7)
+        self.assertIsNone(self.try_to_break_lock())
+        lock_util.release_global_lock('heartbeat')
+
+
+class ScopedUserWriteLockDeadlineTest(_FakeClockTestCase):
+    def setUp(self):
+        super(ScopedUserWriteLockDeadlineTest, self).setUp()
+        lock_util.register_user_write_lock_scope('progress')
+        self.scoped_key = lock_util._user_write_lock_global_key('u1',
+                                                                'progress')
+        self.whole_user_key = lock_util._user_write_lock_global_key('u1')
+
+    def tearDown(self):
+        lock_util._user_write_lock_scopes.discard('progress')
+        super(ScopedUserWriteLockDeadlineTest, self).tearDown()
+
+    def assert_times_out_after(self, max_seconds):
+        start = self.clock.time()
+        with self.assertRaises(lock_util.LockAcquireFailure):
+            lock_util.acquire_user_write_lock('u1', wait_timeout=10)
+        self.assertLessEqual(self.clock.time() - start, max_seconds)
+        # We let go of the whole-user lock when we gave up.
+        self.assertIsNone(lock_util._lock_backend.get(
+            lock_util._global_lock_key(self.whole_user_key)))
+        self.assertFalse(lock_util.user_write_lock_is_held_by_request('u1'))
+
+    def test_both_waits_share_the_wait_timeout(self):
+        self.hold_elsewhere(self.whole_user_key, 4)
+        self.hold_elsewhere(self.scoped_key, 60)
+        self.assert_times_out_after(10)
+
+    def test_scoped_wait_stops_at_the_request_deadline(self):
+        self.hold_elsewhere(self.scoped_key, 60)
+        lock_util.set_request_deadline(
+            self.clock.time() + 3 + lock_util._REQUEST_DEADLINE_SAFETY_MARGIN)
+        self.assert_times_out_after(3)
+
+    def test_scoped_acquire_stops_at_the_request_deadline(self):
+        self.hold_elsewhere(self.whole_user_key, 60)
+        lock_util.set_request_deadline(
+            self.clock.time() + 3 + lock_util._REQUEST_DEADLINE_SAFETY_MARGIN)
+        start = self.clock.time()
+        with self.assertRaises(lock_util.LockAcquireFailure):
+            lock_util.acquire_user_write_lock('u1', wait_timeout=10,
+                                              scope='progress')
+        self.assertLessEqual(self.clock.time() - start, 3)
+        self.assertIsNone(lock_util._lock_backend.get(
+            lock_util._global_lock_key(self.scoped_key)))
+
+    def test_acquires_once_the_scoped_lock_is_free(self):
+        self.hold_elsewhere(self.scoped_key, 2)
+        lock_util.acquire_user_write_lock('u1', wait_timeout=10)
+        self.assertTrue(lock_util.user_write_lock_is_held_by_request('u1'))
+        lock_util.release_user_write_lock('u1')
+
+
+class GlobalLockTaskletTest(_FakeClockTestCase):
+    """acquire_global_lock_async() waits without blocking other tasklets."""
+    def setUp(self):
+        super(GlobalLockTaskletTest, self).setUp()
+        # ndb's timers run on our clock too.
+        self.saved_tasklets_time = tasklets.time
+        tasklets.time = self.clock
+        self.key = lock_util._global_lock_key('tasklet')
+        self.value = lock_util._global_lock_value_for_this_request()
+
+    def tearDown(self):
+        while tasklets.get_event_loop().run0():
+            pass
+        tasklets.time = self.saved_tasklets_time
+        super(GlobalLockTaskletTest, self).tearDown()
+
+    @ndb.tasklet
+    def ticker(self, ticks, until):
+        """A tasklet that notes the time every half-second."""
+        while not until.done():
+            ticks.append(self.clock.time())
+            yield ndb.sleep(0.5)
+
+    def wait_for_lock(self, wait_timeout=10):
+        """Acquire the lock async, returning (elapsed time, ticks)."""
+        start = self.clock.time()
+        ticks = []
+        future = lock_util.acquire_global_lock_async(
+            'tasklet', wait_timeout=wait_timeout)
+        ticking = self.ticker(ticks, future)
+        try:
+            future.get_result()
+        finally:
+            self.elapsed = self.clock.time() - start
+            ticking.get_result()
+            self.ticks = ticks
+
+    def hold_in_this_instance(self, seconds):
+        """Have another request in this instance hold the lock for a bit.
+
+        We release the lock from a tasklet, after `seconds`.
+        """
+        other_value = 'other-request (instance %s)' % (
+            lock_util._this_instance_id())
+        self.assertIsNone(lock_util._acquire_local_lock(
+            self.key, other_value, 60, 0))
+        lock_util._lock_backend.add(self.key, other_value, time=60)
+
+        @ndb.tasklet
+        def release_later():
+            yield ndb.sleep(seconds)
+            lock_util._lock_backend.delete(self.key)
+            lock_util._release_local_lock(self.key, other_value)
+
+        return release_later()
+
+    def test_waits_for_another_instance_without_blocking(self):
+        self.hold_elsewhere('tasklet', 3)
+        self.wait_for_lock()
+        self.assertGreaterEqual(self.elapsed, 3)
+        self.assertEqual(self.value, lock_util._lock_backend.get(self.key))
+        # The ticker kept ticking while we waited.
+        self.assertGreaterEqual(len(self.ticks), 6)
+        lock_util.release_global_lock('tasklet')
+        self.assertIsNone(lock_util._lock_backend.get(self.key))
+
+    def test_gets_the_lock_when_this_instance_lets_go(self):
+        releasing = self.hold_in_this_instance(2)
+        self.wait_for_lock()
+        releasing.get_result()
+        # We poll the local lock often, not once a second like memcache.
+        self.assertLess(self.elapsed, 2.1)
+        self.assertGreaterEqual(len(self.ticks), 4)
+        self.assertEqual(self.value, lock_util._lock_backend.get(self.key))
+        self.assertEqual(self.value, lock_util._local_locks[self.key].owner)
+        lock_util.release_global_lock('tasklet')
+        self.assertNotIn(self.key, lock_util._local_locks)
+
+    def test_takes_over_a_lock_handed_off_to_this_instance(self):
+        # Another request handed the lock off to a thread in this
+        # instance that has since given up on it.
+        other_value = 'other-request (instance %s)' % (
+            lock_util._this_instance_id())
+        lock_util._acquire_local_lock(self.key, other_value, 60, 0)
+        lock_util._lock_backend.add(self.key, other_value, time=60)
+        local_lock = lock_util._local_locks[self.key]
+        local_lock.owner = None
+        local_lock.handoff_value = other_value
+
+        self.wait_for_lock()
+        self.assertEqual(0, self.elapsed)
+        # We renamed the lock in memcache after the fact.
+        lock_util.resolve_all_rpcs()
+        self.assertEqual(self.value, lock_util._lock_backend.get(self.key))
+        lock_util.release_global_lock('tasklet')
+
+    def test_tasklets_in_one_request_share_the_lock(self):
+        self.hold_elsewhere('tasklet', 3)
+        futures = [lock_util.acquire_global_lock_async('tasklet')
+                   for _ in xrange(3)]
+        ndb.Future.wait_all(futures)
+        for future in futures:
+            future.check_success()
+        self.assertEqual([self.key],
+                         lock_util._global_locks_held_by_request().keys())
+        lock_util.release_global_lock('tasklet')
+        self.assertIsNone(lock_util._lock_backend.get(self.key))
+
+    def test_reacquires_locally_while_the_lease_is_live(self):
+        lock_util.acquire_global_lock('tasklet', lock_timeout=5)
+        self.clock.sleep(4)
+        lock_util._lock_backend.delete(self.key)
+        self.hold_elsewhere('tasklet', 60)
+        # We don't ask memcache, so we don't see the other holder.
+        lock_util.acquire_global_lock('tasklet', wait_timeout=0)
+
+    def test_reacquire_asks_memcache_once_the_lease_runs_out(self):
+        lock_util.acquire_global_lock('tasklet', lock_timeout=5)
+        self.clock.sleep(6)
+        self.hold_elsewhere('tasklet', 60)
+        with self.assertRaises(lock_util.LockAcquireFailure):
+            lock_util.acquire_global_lock('tasklet', wait_timeout=1)
+        self.assertEqual({}, lock_util._global_locks_held_by_request())
+
+    def test_times_out_without_blocking(self):
+        self.hold_elsewhere('tasklet', 60)
+        with self.assertRaises(lock_util.LockAcquireFailure):
+            self.wait_for_lock(wait_timeout=3)
+        self.assertGreaterEqual(self.elapsed, 3)
+        self.assertLess(self.elapsed, 4)
+        self.assertGreaterEqual(len(self.ticks), 6)
+        # We didn't keep anyone else in this instance out.
+        self.assertNotIn(self.key, lock_util._local_locks)
+        self.assertEqual({}, lock_util._global_locks_held_by_request())
+
+    def test_times_out_waiting_for_this_instance(self):
+        releasing = self.hold_in_this_instance(5)
+        with self.assertRaises(lock_util.LockAcquireFailure):
+            self.wait_for_lock(wait_timeout=2)
+        self.assertLess(self.elapsed, 2.1)
+        self.assertGreaterEqual(len(self.ticks), 4)
+        releasing.get_result()
+
+
+class SemaphoreAndRateLimitTest(_FakeClockTestCase):
+    def set_time_left(self, seconds):
+        """Give the request `seconds` to wait, after the safety margin."""
+        lock_util.set_request_deadline(
+            self.clock.time() + seconds +
+            lock_util._REQUEST_DEADLINE_SAFETY_MARGIN)
+
+    def test_rate_limit_rejects_bad_rates(self):
+        for (rate, burst) in ((0, 1), (-1, 1), (1, 0), (1, 0.5)):
+            with self.assertRaises(ValueError):
+                lock_util.take_rate_limit_token('limit', rate, burst)
+
+    def test_rate_limit_waits_for_a_token(self):
+        self.assertTrue(lock_util.take_rate_limit_token('limit', rate=1))
+        start = self.clock.time()
+        self.assertTrue(lock_util.take_rate_limit_token('limit', rate=1,
+                                                        wait_timeout=10))
+        self.assertAlmostEqual(1, self.clock.time() - start)
+
+    def test_rate_limit_stops_at_the_request_deadline(self):
+        self.assertTrue(lock_util.take_rate_limit_token('limit', rate=1))
+        self.set_time_left(0.5)
+        start = self.clock.time()
+        self.assertFalse(lock_util.take_rate_limit_token('limit', rate=1,
+                                                         wait_timeout=10))
+        self.assertEqual(start, self.clock.time())
+
+    def test_rate_limit_takes_a_free_token_with_no_time_left(self):
+        self.set_time_left(-1)
+        self.assertTrue(lock_util.take_rate_limit_token('limit', rate=1,
+                                                        wait_timeout=10))
+
+    def hold_permits_elsewhere(self, permits):
+        for i in xrange(permits):
+            lock_util._lock_backend.add(
+                lock_util._semaphore_permit_key('semaphore', i),
+                'other-request (instance other)', time=60)
+
+    def test_semaphore_fails_fast_with_no_time_left(self):
+        self.hold_permits_elsewhere(2)
+        self.set_time_left(0)
+        start = self.clock.time()
+        with self.assertRaisesRegexp(lock_util.LockAcquireFailure,
+                                     'enough time left'):
+            lock_util.acquire_global_semaphore('semaphore', 2)
+        self.assertEqual(start, self.clock.time())
+        self.assertEqual(
+            {}, lock_util._request_local.context.semaphore_permits_held)
+
+    def test_semaphore_takes_a_free_permit_with_no_time_left(self):
+        self.set_time_left(-1)
+        lock_util.acquire_global_semaphore('semaphore', 2)
+        self.assertEqual(
+            1, len(lock_util._request_local.context.semaphore_permits_held[
+                'semaphore']))
+
+    def test_lock_fails_fast_with_no_time_left(self):
+        self.hold_elsewhere('lock', 60)
+        self.set_time_left(0)
+        start = self.clock.time()
+        with self.assertRaisesRegexp(lock_util.LockAcquireFailure,
+                                     'enough time left'):
+            lock_util.acquire_global_lock('lock', queued=True)
+        self.assertEqual(start, self.clock.time())
+        self.assertEqual({}, lock_util._global_locks_held_by_request())
+
+    def test_lock_takes_a_free_lock_with_no_time_left(self):
+        self.set_time_left(-1)
+        for queued in (False, True):
+            start = self.clock.time()
+            lock_util.acquire_global_lock('lock', queued=queued)
+            self.assertEqual(start, self.clock.time())
+            self.assertEqual(
+                lock_util._global_lock_value_for_this_request(),
+                lock_util._lock_backend.get(
+                    lock_util._global_lock_key('lock')))
+            lock_util.release_global_lock('lock')
+
+    def test_semaphore_stops_at_the_request_deadline(self):
+        self.hold_permits_elsewhere(2)
+        self.set_time_left(2)
+        start = self.clock.time()
+        with self.assertRaises(lock_util.LockAcquireFailure):
+            lock_util.acquire_global_semaphore('semaphore', 2,
+                                               wait_timeout=10)
+        self.assertLessEqual(self.clock.time() - start, 2.25)
+
+
+class _UserModel(ndb.Model):
+    """Stands in for a model written with a user lock."""
+    def _transaction_safety_kaid_fn(self):
+        return self.user
+
+
+class FetchUnderUserWriteLockTest(_LockUtilTestCase):
+    def setUp(self):
+        super(FetchUnderUserWriteLockTest, self).setUp()
+        self.entity = _UserModel(id='entity', user='u1')
+        self.entity.put()
+
+    def tearDown(self):
+        db_hooks.clear_entity_hook_states()
+        super(FetchUnderUserWriteLockTest, self).tearDown()
+
+    def test_leaves_an_entity_txn_safety_never_saw(self):
+        with lock_util.fetch_under_user_write_lock(self.entity) as entity:
+            self.assertIs(self.entity, entity)
+
+    def test_refetches_an_entity_got_without_the_lock(self):
+        db_hooks.entity_hook_state(self.entity).get_nonce = 1
+        with lock_util.fetch_under_user_write_lock(self.entity) as entity:
+            self.assertIsNot(self.entity, entity)
+            self.assertEqual(self.entity.key, entity.key)
+            self.assertTrue(
+                lock_util.nonce_of_user_write_lock_held_by_request('u1'))
+
+    def test_leaves_an_entity_got_under_the_lock(self):
+        with lock_util.user_write_lock('u1'):
+            state = db_hooks.entity_hook_state(self.entity)
+            state.get_nonce = 1
+            state.user_lock_nonce = (
+                lock_util.nonce_of_user_write_lock_held_by_request('u1'))
+            with lock_util.fetch_under_user_write_lock(
+                    self.entity) as entity:
+                self.assertIs(self.entity, entity)
+
+    def test_works_without_db_hooks(self):
+        saved_db_hooks = lock_util.db_hooks
+        lock_util.db_hooks = None
+        try:
+            with lock_util.fetch_under_user_write_lock(
+                    self.entity) as entity:
+                self.assertIs(self.entity, entity)
+        finally:
+            lock_util.db_hooks = saved_db_hooks
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -33,8 +33,6 @@ import random
 import threading
 import traceback
 
-from google.appengine.api import datastore
-
 import db_hooks
 # lock_util defines KA-style write locks, and is needed to guarantee
 # txn-safety for them.  If you don't use write locks, then you don't
@@ -63,7 +61,9 @@ def _user_lock_nonce_for(entity):
     else:
         lock_id = None
     if lock_id is not None:
-        return lock_util.nonce_of_user_write_lock_held_by_request(lock_id)
+        scope = getattr(entity, '_transaction_safety_lock_scope', None)
+        return lock_util.nonce_of_user_write_lock_held_by_request(lock_id,
+                                                                  scope)
     else:
         # This can happen when we haven't written the lockid-fn for this
         # entity yet (it's a TODO).  We just log it and just store
@@ -76,16 +76,6 @@ def _user_lock_nonce_for(entity):
         return lock_util.nonce_of_any_user_write_lock_held_by_request()
 
 
-def _transaction_object():
-    """Return the transaction this entity is currently under, or None."""
-    try:
-        return getattr(datastore._GetConnection(), 'transaction', None)
-    except Exception as e:
-        # Probably means the internal _GetConnection() function went away.
-        logging.error("datastore._GetConnection() isn't working!: %s" % e)
-        return None
-
-
 _REQUEST_STATE = threading.local()
 
 
@@ -167,18 +157,19 @@ def _truncated_backtrace():
     return traceback.format_list(stack)
 
 
-def _add_to_get_put_list(entity, get_or_put):
+def _add_to_get_put_list(entity, state, get_or_put):
     """Add this entity to the per-request get-and-put list if it has a key.
 
-    get_or_put is either the string 'get' or the string 'put'.  Returns
-    the newly updated get-put-list, or None if we couldn't add this entity
-    to the list (because it's a put without a corresponding get).
+    state is the entity's db_hooks.entity_hook_state().  get_or_put is
+    either the string 'get' or the string 'put'.  Returns the newly
+    updated get-put-list, or None if we couldn't add this entity to the
+    list (because it's a put without a corresponding get).
     """
-    get_nonce = getattr(entity, '_ts_get_nonce', None)
+    get_nonce = getattr(state, 'get_nonce', None)
     if get_nonce is None:
         return None
 
-    # The entity should definitely have a key if _ts_get_nonce is set,
+    # The entity should definitely have a key if get_nonce is set,
     # since that means this entity was retrieved via a get().
     entity_key = entity.key() if callable(entity.key) else entity.key
 
@@ -201,23 +192,22 @@ def _store_get_state(entity):
     to make sure that the get and put were in the same transaction,
     say.
 
-    We store the data on the entity itself, in a protected field named
-    '_ts_<whatever>'.  ('ts' == 'transaction safety')
+    We store the data in the entity's db_hooks.entity_hook_state(),
+    rather than on the entity itself.
     """
-    entity._ts_get_nonce = random.random()
+    state = db_hooks.entity_hook_state(entity)
+    state.get_nonce = random.random()
 
     # If this entity is for a user-specific db model, store whether
     # the user lock for this user is currently set.
-    # NOTE: for historical reasons, the thing holding the lock-nonce
-    # is (very confusingly) called _ts_user_lock_id.
     if getattr(entity, '_transaction_safety_policy', None) == 'user-specific':
-        entity._ts_user_lock_id = _user_lock_nonce_for(entity)
-    elif hasattr(entity, '_ts_user_lock_id'):
-        del entity._ts_user_lock_id
+        state.user_lock_nonce = _user_lock_nonce_for(entity)
+    elif hasattr(state, 'user_lock_nonce'):
+        del state.user_lock_nonce
 
     # Add this get to our list of get's and put's for this entity, so
     # we can detect bad interleaving of get's and puts.
-    _add_to_get_put_list(entity, 'get')
+    _add_to_get_put_list(entity, state, 'get')
 
 
 class TransactionSafetyViolation(Exception):
@@ -233,8 +223,11 @@ def _ts_violation(msg):
         logging.error(msg)
 
 
-def _examine_ts_policy(entity):
-    """What invariant we check for depends on the ts-policy."""
+def _examine_ts_policy(entity, state):
+    """What invariant we check for depends on the ts-policy.
+
+    state is the entity's db_hooks.entity_hook_state().
+    """
     if _get_transaction_safety_enforcement_policy() == 'ts-enforce-none':
         return
 
@@ -271,22 +264,20 @@ def _examine_ts_policy(entity):
                       '%s' % type(entity))
 
     elif policy == 'written-once':
-        if hasattr(entity, '_ts_get_nonce'):   # we did a get() on it first
+        if hasattr(state, 'get_nonce'):   # we did a get() on it first
             _ts_violation('Seeing a get() before put() for a written-once '
                           'model: %s' % type(entity))
 
     elif policy == 'user-specific':
-        # NOTE: for historical reasons, the thing holding the
-        # lock-nonce is (very confusingly) called _ts_user_lock_id.
-        newly_created = not hasattr(entity, '_ts_user_lock_id')
+        newly_created = not hasattr(state, 'user_lock_nonce')
         if not newly_created:
-            get_lock_nonce = getattr(entity, '_ts_user_lock_id')
+            get_lock_nonce = state.user_lock_nonce
         put_lock_nonce = _user_lock_nonce_for(entity)
         if newly_created and put_lock_nonce:
-            # If it's newly created, we didn't set the _ts_user_lock_id
+            # If it's newly created, we didn't set the user_lock_nonce
             # when creating it, which was unfortunate (but hard to avoid).
             # Let's put it now, so at least we know for the future.
-            entity._ts_user_lock_id = put_lock_nonce
+            state.user_lock_nonce = put_lock_nonce
 
         skip_check = (_get_transaction_safety_enforcement_policy() ==
                       'ts-enforce-all-except-user-lock')
@@ -309,7 +300,7 @@ def _examine_ts_policy(entity):
             # For a newly created entity, only the put() needs to be
             # under a lock.  (A newly created entity is one made via
             # constructor and not via a get call; it won't have any of
-            # the _ts_* vars set.)
+            # its entity_hook_state() fields set.)
             if not put_lock_nonce:
                 _ts_violation('Did not acquire user-lock for put() of a new '
                               'entity %s: %s' % (lock_id, type(entity)))
@@ -339,10 +330,10 @@ def _examine_ts_policy(entity):
             return
 
         # For a newly created entity, we don't need a transaction.
-        if not hasattr(entity, '_ts_get_nonce'):    # not created via a get()
+        if not hasattr(state, 'get_nonce'):    # not created via a get()
             return
-        get_transaction = getattr(entity, '_transaction_at_request_time', None)
-        put_transaction = _transaction_object()
+        get_transaction = getattr(state, 'transaction_at_request_time', None)
+        put_transaction = db_hooks.current_transaction()
         if not get_transaction and not put_transaction:
             _ts_violation('Did not use a transaction: %s' % type(entity))
         elif not get_transaction:
@@ -372,7 +363,7 @@ def _examine_ts_policy(entity):
         return
 
 
-def _examine_tainted_put(entity):
+def _examine_tainted_put(entity, state):
     """Ensure we don't put the same entity twice from different python objects.
 
     Here's the simple case we're protecting against:
@@ -388,6 +379,8 @@ def _examine_tainted_put(entity):
     own get/put list.)  When we see a put(), we match it up to its
     corresponding get().  If any put() happened from a different
     python object, we complain.
+
+    state is the entity's db_hooks.entity_hook_state().
     """
     policy = getattr(entity, '_transaction_safety_policy', None)
     # TODO(csilvers): it would be ideal to have this check for
@@ -397,36 +390,47 @@ def _examine_tainted_put(entity):
         return
 
     # Add this put() to the get-and-put list.
-    get_put_list = _add_to_get_put_list(entity, 'put')
+    get_put_list = _add_to_get_put_list(entity, state, 'put')
     if not get_put_list:      # means entity doesn't have a key, so is safe
         return
 
     # Find our matching get().
     try:
         matching_get_index = get_put_list.index(
-            ('get', entity._ts_get_nonce, None))
+            ('get', state.get_nonce, None))
     except ValueError:
         # This was a put() of a newly-created entity, it's definitely safe.
         return
 
     for (get_or_put, obj_nonce, tb) in get_put_list[matching_get_index + 1:]:
-        if get_or_put == 'put' and obj_nonce != entity._ts_get_nonce:
+        if get_or_put == 'put' and obj_nonce != state.get_nonce:
             _ts_violation("Did a put() of the same entity from two different "
                           "python objects: %s.  Other put:\n---\n%s---\n"
                           % (type(entity), tb))
 
 
 def _examine_put_state(entity):
+    state = db_hooks.entity_hook_state(entity)
     # Indicate we've done a put
-    entity._ts_has_been_put = True
+    state.has_been_put = True
+
+    _examine_ts_policy(entity, state)
+    _examine_tainted_put(entity, state)
 
-    _examine_ts_policy(entity)
-    _examine_tainted_put(entity)
+
+def _has_transaction_safety_policy(model_class):
+    # Models in third-party libraries don't have a policy, and we
+    # don't check them, so they can skip our hooks entirely.
+    return bool(getattr(model_class, '_transaction_safety_policy', None))
 
 
 def hook_transaction_safety_checks():
-    db_hooks.add_after_get_hook(_store_get_state)
-    db_hooks.add_before_put_hook(_examine_put_state)
+    db_hooks.add_after_get_hook(
+        _store_get_state, hook_set='txn_safety',
+        model_filter=_has_transaction_safety_policy)
+    db_hooks.add_before_put_hook(
+        _examine_put_state, hook_set='txn_safety',
+        model_filter=_has_transaction_safety_policy)
 
 
 @contextlib.contextmanager
@@ -503,8 +507,17 @@ class TransactionSafetyMiddleware(object):
             del _REQUEST_STATE.ts_enforcement_policy
         if hasattr(_REQUEST_STATE, 'ts_get_put_list'):
             _REQUEST_STATE.ts_get_put_list.clear()
+        db_hooks.clear_entity_hook_states()
+        db_hooks.clear_puts_awaiting_commit()
 
-        return self.app(environ, start_response)
+        try:
+            for retval in self.app(environ, start_response):
+                yield retval
+        finally:
+            # Entities that outlive the request (in a cache, say)
+            # shouldn't carry their gets and puts into the next one.
+            db_hooks.clear_entity_hook_states()
+            db_hooks.clear_puts_awaiting_commit()
 
 
 # -------------------------
@@ -548,7 +561,7 @@ def _set_transaction_safety(cls, value):
     return cls
 
 
-def written_with_user_lock_model(lockid_fn):
+def written_with_user_lock_model(lockid_fn, scope=None):
     """Decorator that says that a db or ndb model holds info about one user.
 
     The canonical example of a user-specific model is UserData, but many
@@ -565,10 +578,20 @@ def written_with_user_lock_model(lockid_fn):
     that takes an instance of this model as an argument, and returns
     the user's lock-id.  That is, it identifies "which" user this entity
     is associated with.
+
+    If the model is written often, and independently of the user's
+    other models, you can also give it a lock scope, e.g.
+    scope='progress'.  Then it may be written holding either the
+    whole-user lock or just the lock for that scope, and writes to
+    models in different scopes won't contend with each other.
     """
+    if scope is not None and lock_util:
+        lock_util.register_user_write_lock_scope(scope)
+
     def class_rebuilder(cls):
         _set_transaction_safety(cls, 'user-specific')
         cls._transaction_safety_kaid_fn = lockid_fn
+        cls._transaction_safety_lock_scope = scope
         return cls
 
     return class_rebuilder